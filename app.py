@@ -1,13 +1,24 @@
+import os
+import re
+import shutil
+import uuid
+
 import dash
 import dash_bootstrap_components as dbc
+import flask
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
 from dash_bootstrap_templates import load_figure_template
-from plotly import graph_objects as go
 
+import backgrounds
 import data
+import export
+import instrumentation
+import jobs
 import plotting
+import processing
 import utils
+from dataloader import derived, maps
 
 dbc_css = "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates@V1.0.4/dbc.min.css"
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.DARKLY, dbc_css])
@@ -17,111 +28,390 @@ load_figure_template(["darkly"])
 
 image_fig = plotting.make_empty_image_plot()
 spectra_fig = plotting.make_empty_spectra_fig()
-data.del_tmpfile_dir()
+
+
+UPLOAD_POLL_MS = 500
+UPLOAD_PROGRESS_FILES_SHOWN = 5  # Names of files still to go listed under the progress bar
+
+
+def make_upload_progress(progress):
+    num_finished = sum(status != "queued" for _, status in progress)
+    waiting = [fname for fname, status in progress if status == "queued"]
+    waiting_msg = ", ".join(waiting[:UPLOAD_PROGRESS_FILES_SHOWN])
+    if len(waiting) > UPLOAD_PROGRESS_FILES_SHOWN:
+        waiting_msg += f" and {len(waiting) - UPLOAD_PROGRESS_FILES_SHOWN} more"
+    return [dbc.Progress(value=num_finished, max=len(progress), label=f"{num_finished}/{len(progress)} files",
+                         style={"height": "20px"}),
+            html.Small(f"Converting {waiting_msg}" if waiting else "Finishing up")]
+
+
+def is_session_id(session_id):
+    # Session ids come back from the browser, so are checked before they go anywhere near the filesystem
+    return isinstance(session_id, str) and re.fullmatch("[0-9a-f]{32}", session_id) is not None
+
+
+def make_missing_data_alert(error):
+    # Shown when a callback finds one of its datasets gone, rather than it quietly not responding
+    return [html.Div(error.args[0])], True
+
+
+def make_channel_options(resource_data_store, upload_previews):
+    # Store entries list any spectral maps the session has made with their image channels
+    image_channels = utils.makedropdownopts(resource_data_store + upload_previews, "signal_metadata", "img_channels")
+    spectra_x_channels = utils.makedropdownopts(resource_data_store + upload_previews, "signal_metadata",
+                                                "spectra_x_channels")
+    spectra_y_channels = utils.makedropdownopts(resource_data_store + upload_previews, "signal_metadata",
+                                                "spectra_y_channels")
+    return image_channels, spectra_x_channels, spectra_y_channels
+
+
+@app.callback(Output('upload-jobs', 'data'),
+              Output('upload-previews', 'data'),
+              Output('image-channel-dropdown', 'options', allow_duplicate=True),
+              Output('spectra-x-channel-dropdown', 'options', allow_duplicate=True),
+              Output('spectra-y-channel-dropdown', 'options', allow_duplicate=True),
+              Output('upload-poll', 'disabled', allow_duplicate=True),
+              Output('alert-upload-errors', 'children', allow_duplicate=True),
+              Output('session-id', 'data'),
+              Input('upload-data-box', 'contents'),
+              State('upload-data-box', 'filename'),
+              State('upload-jobs', 'data'),
+              State('upload-previews', 'data'),
+              State('uploaded-data', 'data'),
+              State('session-id', 'data'),
+              prevent_initial_call=True)
+def start_upload(list_of_contents, list_of_names, upload_jobs, upload_previews, resource_data_store, session_id):
+    # Conversion happens in the background (see jobs.py), this only starts it. Kept apart from polling, as Dash
+    # sends every input and state with each call and the upload itself can be GBs. The session id is what this tab
+    # holds its files in the shared pool under. Each file's header is read first, so the channels can be picked and
+    # the spectra positions seen while the rest of it is still being converted
+    if not list_of_contents:
+        raise dash.exceptions.PreventUpdate
+
+    if not is_session_id(session_id):
+        session_id = uuid.uuid4().hex
+    previews = data.add_previews(list_of_contents, list_of_names)
+    job_id = jobs.submit_upload(list_of_contents, list_of_names, session_id)
+
+    upload_previews = (upload_previews or []) + [dict(store_entry, upload_job=job_id, upload_idx=i)
+                                                 for i, store_entry in previews]
+    return (upload_jobs or []) + [job_id], upload_previews, \
+        *make_channel_options(resource_data_store or [], upload_previews), False, [], session_id
 
 
 @app.callback(Output('uploaded-data', 'data'),
+              Output('upload-previews', 'data', allow_duplicate=True),
+              Output('upload-jobs', 'data', allow_duplicate=True),
               Output('image-channel-dropdown', 'options'),
               Output('spectra-x-channel-dropdown', 'options'),
               Output('spectra-y-channel-dropdown', 'options'),
-              Input('uploaded-data', 'data'),
-              Input('upload-data-box', 'contents'),
-              State('upload-data-box', 'filename'),
+              Output('alert-upload-errors', 'children'),
+              Output('alert-upload-errors', 'is_open'),
+              Output('upload-poll', 'disabled'),
+              Output('upload-progress', 'children'),
+              Output('btn-cancel-upload', 'disabled'),
+              Input('upload-poll', 'n_intervals'),
+              Input('btn-cancel-upload', 'n_clicks'),
+              State('uploaded-data', 'data'),
+              State('upload-previews', 'data'),
+              State('upload-jobs', 'data'),
+              State('alert-upload-errors', 'children'),
               prevent_initial_call=True)
-def load_files(resource_data_store, list_of_contents, list_of_names):
+def load_files(_, __, resource_data_store, upload_previews, upload_jobs, error_msg):
+    # Picks up each file of the running uploads as it finishes, so the image can show it straight away
     if resource_data_store is None:
         resource_data_store = data.make_empty_data_store()
-
-    # Load in the data from each file into a unified, jsonable dictionary to be stored
-    for contents, fname in zip(list_of_contents, list_of_names):
-        resource_data_store = data.add_file_to_datastore(contents, fname, resource_data_store)
-
-    # Populate the dropdown menu options
-    image_channels = utils.makedropdownopts(resource_data_store, "signal_metadata", "img_channels")
-    spectra_x_channels = utils.makedropdownopts(resource_data_store, "signal_metadata", "spectra_x_channels")
-    spectra_y_channels = utils.makedropdownopts(resource_data_store, "signal_metadata", "spectra_y_channels")
-
-    return resource_data_store, image_channels, spectra_x_channels, spectra_y_channels
+    upload_previews = upload_previews or []
+
+    new_entries, new_errors, progress, job_statuses, finished_jobs = [], [], [], {}, []
+    for job_id in upload_jobs or []:
+        try:
+            if dash.ctx.triggered_id == 'btn-cancel-upload':
+                jobs.cancel_job(job_id)
+            # Progress before taking, so a file seen as done here has its dataset in what's taken
+            job_progress = jobs.get_job_progress(job_id)
+            store_entries, errors, done = jobs.take_job(job_id)
+        except KeyError:
+            finished_jobs.append(job_id)
+            continue
+
+        if done:
+            finished_jobs.append(job_id)  # Everything it had has now been taken
+
+        if not done:
+            progress += job_progress
+            job_statuses[job_id] = [status for _, status in job_progress]
+        new_entries += store_entries
+        new_errors += errors
+
+    # A preview makes way once its file is done with, whether it's now a dataset or couldn't be loaded
+    kept_previews = [preview for preview in upload_previews if preview["upload_job"] in job_statuses and
+                     job_statuses[preview["upload_job"]][preview["upload_idx"]] == "queued"]
+
+    # Finished jobs are dropped so later polls don't go through them again. Patched out rather than the list being
+    # sent back, as an upload started meanwhile may have added its own
+    upload_jobs_patch = dash.no_update
+    if finished_jobs:
+        upload_jobs_patch = dash.Patch()
+        for job_id in finished_jobs:
+            upload_jobs_patch.remove(job_id)
+
+    error_msg = (error_msg or []) + [html.Div(f"Could not load {error}") for error in new_errors]
+    finished = not progress
+    progress_children = make_upload_progress(progress) if progress else None
+    if not new_entries and len(kept_previews) == len(upload_previews):
+        return dash.no_update, dash.no_update, upload_jobs_patch, dash.no_update, dash.no_update, dash.no_update, \
+            error_msg, len(error_msg) > 0, finished, progress_children, finished
+
+    resource_data_store += new_entries
+
+    return resource_data_store, kept_previews, upload_jobs_patch, \
+        *make_channel_options(resource_data_store, kept_previews), error_msg, len(error_msg) > 0, finished, \
+        progress_children, finished
 
 
 @app.callback(Output('fig-image', 'figure'),
+              Output('image-view', 'data'),
+              Output('alert-missing-data', 'children', allow_duplicate=True),
+              Output('alert-missing-data', 'is_open', allow_duplicate=True),
               Input('uploaded-data', 'data'),
+              Input('upload-previews', 'data'),
               Input('image-channel-dropdown', 'value'),
+              Input('fig-image', 'relayoutData'),
+              Input('image-render-mode', 'value'),
+              State('image-view', 'data'),
               prevent_initial_call=True)
-def update_image_spec_pos_figure(uploaded_data, image_channel):
-    img_fig = plotting.make_image_spec_position_plot(uploaded_data, image_channel)
-    return img_fig
+def update_image_spec_pos_figure(uploaded_data, upload_previews, image_channel, relayout_data, render_mode,
+                                 image_view):
+    # Zooming/panning swaps in the pyramid level that suits the new view, anything else on the figure is ignored.
+    # A new channel is drawn whole, as its axes start zoomed out (uirevision is the channel, see plotting). Anything
+    # else (an upload, a render mode) keeps the zoom, so is drawn at the level for the view already shown
+    if dash.ctx.triggered_id == 'fig-image':
+        image_view = utils.get_view_ranges(relayout_data)
+        if image_view is False:
+            raise dash.exceptions.PreventUpdate
+    elif dash.ctx.triggered_id == 'image-channel-dropdown':
+        image_view = None
+
+    try:
+        uploaded_data = data.resolve_datastore(uploaded_data or [])
+    except KeyError as e:
+        return dash.no_update, dash.no_update, *make_missing_data_alert(e)
+    try:
+        upload_previews = data.resolve_datastore(upload_previews or [])
+    except KeyError:
+        upload_previews = []  # Only ever there for a moment anyway
+
+    img_fig = plotting.make_image_spec_position_plot(uploaded_data, image_channel, image_view, render_mode,
+                                                     upload_previews)
+    return img_fig, image_view, dash.no_update, dash.no_update
+
+
+@app.callback(Output('uploaded-data', 'data', allow_duplicate=True),
+              Output('image-channel-dropdown', 'options', allow_duplicate=True),
+              Output('image-channel-dropdown', 'value'),
+              Output('alert-missing-data', 'children', allow_duplicate=True),
+              Output('alert-missing-data', 'is_open', allow_duplicate=True),
+              Input('btn-add-map', 'n_clicks'),
+              State('map-kind', 'value'),
+              State('map-from', 'value'),
+              State('map-to', 'value'),
+              State('uploaded-data', 'data'),
+              State('spectra-x-channel-dropdown', 'value'),
+              State('spectra-y-channel-dropdown', 'value'),
+              State('spectra-smoothing', 'value'),
+              prevent_initial_call=True)
+def add_spectral_maps(_, kind, map_from, map_to, uploaded_data, spectra_x_channel, spectra_y_channels, smoothing):
+    # A map of each selected spectra channel across every grid, shown straight away. Which maps a session has made is
+    # kept in its own store entries, so they're only ever added to its view of the shared datasets
+    if not all([kind, uploaded_data, spectra_x_channel, spectra_y_channels]) or map_from is None:
+        raise dash.exceptions.PreventUpdate
+    # Integrals need both ends of their window, a value or derivative only the one point
+    if kind == "integrate" and (map_to is None or map_to == map_from):
+        raise dash.exceptions.PreventUpdate
+    window = [map_from, map_to if kind == "integrate" else map_from]
+
+    try:
+        datasets = data.resolve_datastore(uploaded_data)
+    except KeyError as e:
+        return dash.no_update, dash.no_update, dash.no_update, *make_missing_data_alert(e)
+
+    # Patched in per file, so files a running upload adds meanwhile aren't lost
+    store_patch, map_names = dash.no_update, []
+    for file_idx, (store_entry, entry) in enumerate(zip(uploaded_data, datasets)):
+        for y_channel in utils.ensure_list(spectra_y_channels):
+            map_spec = {"x_channel": spectra_x_channel, "y_channel": y_channel, "kind": kind, "window": window,
+                        "smoothing": smoothing}
+            spectral_map = data.get_spectral_map(entry, **map_spec)
+            if spectral_map is None:
+                continue
+
+            map_names.append(spectral_map[0])
+            if spectral_map[0] not in store_entry["signal_metadata"]["img_channels"]:
+                store_entry["maps"] = store_entry.get("maps", []) + [map_spec]
+                store_entry["signal_metadata"]["img_channels"] = \
+                    store_entry["signal_metadata"]["img_channels"] + [spectral_map[0]]
+                store_patch = dash.Patch() if store_patch is dash.no_update else store_patch
+                store_patch[file_idx] = store_entry
+    if not map_names:
+        raise dash.exceptions.PreventUpdate
 
+    return store_patch, utils.makedropdownopts(uploaded_data, "signal_metadata", "img_channels"), map_names[-1], \
+        dash.no_update, dash.no_update
 
-# @app.callback(Output("download-spec", "data"),
-#               Input("btn-download-spec", "n_clicks"),
-#               State('fig-spectra', 'figure'),
-#               prevent_initial_call=True)
-# def download_spectra_as_json(_, fig_spectra):
-#     return dict(content=fig_spectra, filename="spectra_data.json")
+
+@app.callback(Output("download-spec", "href"),
+              Input("btn-download-spec", "n_clicks"),
+              State("download-format", "value"),
+              State('uploaded-data', 'data'),
+              State('spectra-state', 'data'),
+              State('background-dropdown', 'value'),
+              prevent_initial_call=True)
+def download_spectra(_, fmt, uploaded_data, spectra_state, background_id):
+    # Exports can be GBs, far too big for dcc.Download, so the browser is pointed at a route that streams the file
+    if not all([fmt, uploaded_data, spectra_state]) or not spectra_state["plotted"]:
+        raise dash.exceptions.PreventUpdate
+
+    token = export.add_pending_export(fmt=fmt,
+                                      datastore=uploaded_data,
+                                      plotted=spectra_state["plotted"],
+                                      x_channel=spectra_state["x_channel"],
+                                      y_channels=spectra_state["y_channels"],
+                                      background_id=background_id,
+                                      smoothing=spectra_state.get("smoothing"))
+    return f"/export/{token}"
+
+
+@app.server.route("/export/<token>")
+def stream_export(token):
+    try:
+        export_args = export.pop_pending_export(token)
+        # Resolved like in the callbacks, so the files keep the names this session gave them
+        data_entries = data.resolve_datastore(export_args.pop("datastore"))
+        background_id = export_args.pop("background_id", None)
+        export_args["background"] = None if background_id is None else backgrounds.get_background(background_id)
+    except KeyError as e:
+        return flask.Response(f"Could not export the spectra: {e.args[0]}", status=404, mimetype="text/plain")
+
+    try:
+        out_path = export.write_export(export_args.pop("fmt"), data_entries, **export_args)
+    except Exception as e:
+        # A missing library, a full disk, a dataset that can't be read... The browser shows this rather than a bare 500
+        app.logger.exception("Export %s failed", token)
+        return flask.Response(f"Could not export the spectra: {e}", status=500, mimetype="text/plain")
+    response = flask.send_file(out_path, as_attachment=True, download_name=os.path.basename(out_path))
+    response.call_on_close(lambda: shutil.rmtree(os.path.dirname(out_path), ignore_errors=True))
+    return response
+
+
+@app.callback(Output('clear-all-redirect', 'href'),
+              Input('btn-clear-all', 'n_clicks'),
+              State('session-id', 'data'),
+              State('upload-jobs', 'data'),
+              prevent_initial_call=True)
+def clear_all(_, session_id, upload_jobs):
+    # Lets go of this session's files in the shared pool, leaving every other session's be, then starts afresh
+    for job_id in upload_jobs or []:
+        try:
+            jobs.cancel_job(job_id)
+        except KeyError:
+            continue
+    if is_session_id(session_id):
+        data.release_session(session_id)
+
+    return "/"
 
 
 @app.callback(Output('fig-spectra', 'figure'),
+              Output('spectra-state', 'data'),
               Output('data-clear-spec-btn', 'data'),
-              Output('data-tabs-btn', 'data'),
+              Output('alert-missing-data', 'children', allow_duplicate=True),
+              Output('alert-missing-data', 'is_open', allow_duplicate=True),
               State('uploaded-data', 'data'),
               Input('spectra-x-channel-dropdown', 'value'),
               Input('spectra-y-channel-dropdown', 'value'),
               Input('fig-image', 'clickData'),
               Input('fig-image', 'selectedData'),
-              Input('fig-spectra', 'figure'),
               Input('btn-clear-spec', 'n_clicks'),
               State('data-clear-spec-btn', 'data'),
-              Input('background-data', 'data'),
+              Input('background-dropdown', 'value'),
               Input('tabs-spectra', 'value'),
-              State('data-tabs-btn', 'data'),
+              Input('spectra-smoothing', 'value'),
+              State('spectra-state', 'data'),
               prevent_initial_call=True)
 def update_spec_figure(uploaded_data, spectra_x_channel, spectra_y_channels, select_spectra, multi_select_spectra,
-                       old_fig, reset_presses, reset_presses_old, background_spec_data, tab, old_tab):
+                       reset_presses, reset_presses_old, background_id, tab, smoothing, spectra_state):
     # Reset if clear spectra button pressed
     if utils.is_button_pressed(reset_presses, reset_presses_old):
-        return plotting.make_empty_spectra_fig(), reset_presses, tab
-
-    if (old_fig is None) or (utils.is_button_pressed(tab, old_tab)):
-        spec_figure = plotting.make_empty_spectra_fig()
-    else:
-        spec_figure = go.Figure(old_fig)
+        return plotting.make_empty_spectra_fig(), None, reset_presses, dash.no_update, dash.no_update
 
     # Prevent execution if not enough options selected
-    all_selections = utils.combine_selection_events((select_spectra, multi_select_spectra))
-    if not all([all_selections, uploaded_data, spectra_x_channel, spectra_y_channels]):
+    if not all([select_spectra or multi_select_spectra, uploaded_data, spectra_x_channel, spectra_y_channels]):
         raise dash.exceptions.PreventUpdate
 
-    # Draw the main figure
-    spec_figure = plotting.make_spectra_fig(uploaded_data, spectra_x_channel, spectra_y_channels,
-                                            all_selections, background_spec_data, spec_figure, tab)
+    try:
+        uploaded_data = data.resolve_datastore(uploaded_data)
+    except KeyError as e:
+        return dash.no_update, dash.no_update, dash.no_update, *make_missing_data_alert(e)
 
-    return spec_figure, reset_presses, tab
+    all_selections = processing.resolve_selection(uploaded_data, select_spectra, multi_select_spectra)
+    if all_selections is None:
+        raise dash.exceptions.PreventUpdate
 
+    try:
+        background = None if background_id is None else backgrounds.get_background(background_id)
+    except KeyError:
+        background = None
+
+    # Only redraw everything if what is being plotted has changed, otherwise just patch in the new spectra
+    spectra_y_channels = utils.ensure_list(spectra_y_channels)
+    if dash.ctx.triggered_id == 'background-dropdown' or \
+            not plotting.is_same_spectra_settings(spectra_state, spectra_x_channel, spectra_y_channels, tab, smoothing):
+        spec_figure, spectra_state = plotting.make_spectra_fig(uploaded_data, spectra_x_channel, spectra_y_channels,
+                                                               all_selections, background, tab,
+                                                               spectra_state, smoothing)
+    else:
+        num_plotted = len(spectra_state["plotted"])
+        spec_figure, spectra_state = plotting.update_spectra_fig(uploaded_data, all_selections, background,
+                                                                 spectra_state)
+        if len(spectra_state["plotted"]) == num_plotted:  # Everything selected is already on the figure
+            raise dash.exceptions.PreventUpdate
 
-@app.callback(Output('background-data', 'data'),
-              Output('data-background-spec-btn', 'data'),
-              State('fig-spectra', 'figure'),
-              State('spectra-y-channel-dropdown', 'value'),
+    return spec_figure, spectra_state, reset_presses, dash.no_update, dash.no_update
+
+
+@app.callback(Output('background-dropdown', 'options'),
+              Output('background-dropdown', 'value'),
+              Output('alert-missing-data', 'children'),
+              Output('alert-missing-data', 'is_open'),
               Input('btn-background-spec', 'n_clicks'),
-              State('data-background-spec-btn', 'data'),
-              prevent_initial_call=True)
-def set_spectra_as_background(spec_figure, y_channels, reset_presses, reset_presses_old):
-    if len(spec_figure["data"]) == 0:
+              State('background-name', 'value'),
+              State('uploaded-data', 'data'),
+              State('spectra-state', 'data'))
+def set_spectra_as_background(_, name, uploaded_data, spectra_state):
+    # Mean of the plotted spectra, worked out from the data rather than pulled back off the figure, into the shared
+    # background library (see backgrounds.py) and used straight away. On page load this just lists the library
+    if dash.ctx.triggered_id is None:
+        return backgrounds.make_background_options(), dash.no_update, dash.no_update, dash.no_update
+    if not uploaded_data or not spectra_state or not spectra_state["plotted"]:
         raise dash.exceptions.PreventUpdate
 
-    if utils.is_button_pressed(reset_presses, reset_presses_old):
-        out = {}
-        spec_figure = go.Figure(spec_figure)
-        out["x"] = spec_figure.data[0]["x"]
-
-        for y_channel in y_channels:
-            for trace in spec_figure.data:
-                if trace.name == f"Mean ({y_channel})":
-                    out[y_channel] = trace["y"]
-        return out, reset_presses
-    else:
-        return None, reset_presses
+    try:
+        uploaded_data = data.resolve_datastore(uploaded_data)
+    except KeyError as e:
+        return dash.no_update, dash.no_update, *make_missing_data_alert(e)
+
+    x, ys, sources = backgrounds.mean_spectra(uploaded_data, spectra_state["plotted"], spectra_state["x_channel"],
+                                              spectra_state["y_channels"])
+    if not ys:
+        raise dash.exceptions.PreventUpdate
+
+    if not name:
+        names = sorted(uploaded_data[file_idx]["experiment_metadata"]["experiment_name"] for file_idx in sources)
+        name = f"Mean of {sum(sources.values())} spectra from {names[0]}" + \
+            (f" and {len(names) - 1} more" if len(names) > 1 else "")
+    background_id = backgrounds.save_background(name, spectra_state["x_channel"], x, ys)
+    return backgrounds.make_background_options(), background_id, dash.no_update, dash.no_update
 
 
 fig_layout = html.Div([
@@ -132,7 +422,7 @@ fig_layout = html.Div([
         children=html.Div([
             'Drag and Drop or ',
             html.A('Select Files.'),
-            ' (Formats Supported:  *.sxm,  *.dat,  *.3ds,  *.XX_mtrx)']),
+            ' (Formats Supported:  *.sxm,  *.dat,  *.3ds,  *.XX_mtrx with their *_0001.mtrx)']),
         style={
             'width': '1888px',
             'height': '60px',
@@ -142,6 +432,29 @@ fig_layout = html.Div([
             'borderRadius': '5px',
             'textAlign': 'center'
         })),
+    dbc.Alert(id="alert-upload-errors",
+              color="danger",
+              dismissable=True,
+              is_open=False,
+              style={'width': '1888px', "margin-top": "10px"}),
+    dbc.Alert(id="alert-missing-data",
+              color="warning",
+              dismissable=True,
+              is_open=False,
+              style={'width': '1888px', "margin-top": "10px"}),
+    html.Div([
+        html.Div(id="upload-progress",
+                 style={'width': '1720px',
+                        'display': 'inline-block'}),
+        dbc.Button("Cancel Upload", id="btn-cancel-upload",
+                   size="sm",
+                   color="secondary",
+                   disabled=True,
+                   style={'width': "150px",
+                          "margin-left": "18px",
+                          'vertical-align': 'top',
+                          'display': 'inline-block'})],
+        style={'width': '1888px', "margin-top": "10px"}),
     html.Hr(),
     html.Div([
         dcc.Markdown("**Image Channel:**",
@@ -174,6 +487,12 @@ fig_layout = html.Div([
                      multi=True,
                      style={'width': '300px',
                             'display': 'inline-block'}),
+        dcc.Dropdown(id="spectra-smoothing",
+                     options=[{"label": label, "value": value} for value, label in derived.SMOOTHING_OPTIONS.items()],
+                     value="none",
+                     clearable=False,
+                     style={'width': '220px',
+                            'display': 'inline-block'}),
         dbc.Button("Set as Background", id="btn-background-spec",
                    size="sm",
                    color="secondary",
@@ -190,33 +509,84 @@ fig_layout = html.Div([
                           "position": "relative", "bottom": "14px",  # This is misaligned for some reason.
                           'display': 'inline-block'}),
         dbc.Button("Clear All", id="btn-clear-all",
-                   href="/",
-                   external_link=True,
                    size="sm",
                    style={'width': "150px",
                           'height': "36px",
                           "position": "relative", "bottom": "14px",  # This is misaligned for some reason.
                           'display': 'inline-block'}),
-        # dbc.Button("Download Spectra", id="btn-download-spec",
-        #            size="sm",
-        #            style={'width': "150px",
-        #                   'height': "36px",
-        #                   "position": "relative", "bottom": "14px",  # This is misaligned for some reason.
-        #                   'display': 'inline-block'}),
+        dbc.Button("Download Spectra", id="btn-download-spec",
+                   size="sm",
+                   style={'width': "150px",
+                          'height': "36px",
+                          "position": "relative", "bottom": "14px",  # This is misaligned for some reason.
+                          'display': 'inline-block'}),
+        dcc.Dropdown(id="download-format",
+                     options=export.get_export_formats(),
+                     value=(export.get_export_formats() or [None])[0],
+                     clearable=False,
+                     style={'width': '110px',
+                            'display': 'inline-block'}),
     ]
     ),
+    html.Div([
+        dcc.Markdown("**Background:**",
+                     style={'width': '150px',
+                            'display': 'inline-block'}),
+        dcc.Dropdown(id="background-dropdown",
+                     placeholder="None (Set as Background adds the plotted mean here, for everyone)",
+                     style={'width': '640px',
+                            "margin-right": "25px",
+                            'display': 'inline-block'}),
+        dcc.Input(id="background-name",
+                  type="text",
+                  placeholder="Name for the next background",
+                  style={'width': '300px',
+                         "position": "relative", "bottom": "14px",  # Same misalignment as the buttons
+                         'display': 'inline-block'})],
+        style={'width': '1888px', "margin-top": "10px"}),
     html.Hr(),
     html.Div([
         dbc.Row([
             dbc.Col(
-                children=[dcc.Graph(
+                children=[dcc.RadioItems(
+                    id='image-render-mode',
+                    options=[{"label": "Values", "value": "heatmap"},
+                             {"label": "Raster (faster)", "value": "raster"}],
+                    value="heatmap",
+                    inline=True,
+                    inputStyle={"margin-left": "15px", "margin-right": "5px"},
+                    style={'height': '50px',
+                           'width': '640px',
+                           'text-align': 'center',
+                           'line-height': '50px'}),
+                    dcc.Graph(
                     id='fig-image',
                     figure=image_fig,
                     style={'height': '550px',
                            'width': '640px',
-                           "margin-top": '50px',
                            'display': 'inline-block'},
-                    config={"modeBarButtonsToRemove": ["toImage"]})],
+                    config={"modeBarButtonsToRemove": ["toImage"]}),
+                html.Div([
+                    dcc.Dropdown(id="map-kind",
+                                 options=[{"label": label, "value": kind} for kind, label in maps.MAP_KINDS.items()],
+                                 value="diff",
+                                 clearable=False,
+                                 style={'width': '180px',
+                                        'display': 'inline-block'}),
+                    dcc.Input(id="map-from", type="number", placeholder="From (x)",
+                              style={'width': '140px', "margin-left": "10px"}),
+                    dcc.Input(id="map-to", type="number", placeholder="To (x, integrals only)",
+                              style={'width': '140px', "margin-left": "10px"}),
+                    dbc.Button("Add Map", id="btn-add-map",
+                               size="sm",
+                               color="secondary",
+                               style={'width': "120px",
+                                      'height': "36px",
+                                      "margin-left": "10px",
+                                      "position": "relative", "bottom": "14px",  # Same misalignment as above
+                                      'display': 'inline-block'})],
+                    style={'width': '640px',
+                           'text-align': 'center'})],
                 width=4),
             dbc.Col(children=[
                 dcc.Tabs(id="tabs-spectra", value='orig', children=[
@@ -248,12 +618,16 @@ fig_layout = html.Div([
 ])
 
 datastore_layout = html.Div([dcc.Store(id='uploaded-data'),  # storage_type='session'
-                             dcc.Store(id='background-data'),
-                             dcc.Store(id='data-background-spec-btn'),
                              dcc.Store(id='data-clear-spec-btn'),
                              dcc.Store(id='data-clear-all-btn'),
-                             dcc.Store(id='data-tabs-btn'),
-                             dcc.Download(id="download-spec")])
+                             dcc.Store(id='spectra-state'),
+                             dcc.Store(id='image-view'),
+                             dcc.Store(id='upload-jobs'),
+                             dcc.Store(id='upload-previews'),
+                             dcc.Store(id='session-id', storage_type='session'),
+                             dcc.Interval(id='upload-poll', interval=UPLOAD_POLL_MS, disabled=True),
+                             dcc.Location(id="download-spec", refresh=True),
+                             dcc.Location(id="clear-all-redirect", refresh=True)])
 
 attribution_layout = html.Div(children=[
     html.A('💝 Made by Oliver Gordon for the University of Nottingham Nanoscience Group (2022). ',
@@ -276,6 +650,7 @@ app.layout = dbc.Container(
     fluid=True,
     className="dbc"
 )
+instrumentation.instrument_app(app)  # Only if SPECTRA_METRICS is set
 
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import data
+import processing
+
+LOADED_BACKGROUNDS = 32  # Kept in memory per process. Never stale, as a background's id is a hash of its contents
+MEAN_CHUNK_POINTS = 2048  # Spectra averaged at a time, so a background taken over a whole grid needn't fit in memory
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+def get_backgrounds_dir():
+    # Next to the conversion cache, so every session and worker process shares the one library. Never evicted
+    backgrounds_dir = os.path.join(data.conversion_cache.cache_dir, ".backgrounds")
+    os.makedirs(backgrounds_dir, exist_ok=True)
+    return backgrounds_dir
+
+
+def get_background_path(background_id, ext):
+    if not re.fullmatch("[0-9a-f]{32}", str(background_id)):
+        raise KeyError(f"{background_id} is not a background")  # Ids come from the browser, so never trusted as a path
+    return os.path.join(get_backgrounds_dir(), f"{background_id}.{ext}")
+
+
+def mean_spectra(data_entries, plotted, x_channel, y_channels):
+    # (x, {y channel: mean}, {file index: spectra used}) of the plotted points, straight from the data so it's the
+    # original spectra whatever tab or background they're shown with. Files on a different sweep are interpolated
+    # onto the first one's
+    x, sums, counts, sources = None, {}, {}, {}
+    for file_idx, point_idxs in processing.group_selection(
+            [{"customdata": file_idx, "pointIndex": point_idx} for file_idx, point_idx in plotted]).items():
+        entry = data_entries[file_idx]
+        for start in range(0, len(point_idxs), MEAN_CHUNK_POINTS):
+            chunk_idxs = point_idxs[start:start + MEAN_CHUNK_POINTS]
+            for y_channel in y_channels:
+                xdata, block = processing.gather_spectra(entry, x_channel, y_channel, chunk_idxs, None, "orig")
+                if block is None:
+                    continue
+                if x is None:
+                    x = np.asarray(xdata, dtype=float)
+                block = processing.interp_rows(x, xdata, block)
+                sums[y_channel] = sums.get(y_channel, 0) + block.sum(axis=0)
+                counts[y_channel] = counts.get(y_channel, 0) + block.shape[0]
+                sources[file_idx] = max(sources.get(file_idx, 0), start + block.shape[0])
+
+    return x, {y_channel: sums[y_channel] / counts[y_channel] for y_channel in sums}, sources
+
+
+def save_background(name, x_channel, x, ys):
+    # Stored once however many times it's saved, under a hash of its contents. Returns its id
+    x = np.asarray(x, dtype=float)
+    ys = {y_channel: np.asarray(y, dtype=float) for y_channel, y in ys.items()}
+    content_hash = hashlib.sha256(x_channel.encode() + x.tobytes())
+    for y_channel in sorted(ys):
+        content_hash.update(y_channel.encode() + ys[y_channel].tobytes())
+    background_id = content_hash.hexdigest()[:32]
+
+    metadata_path = get_background_path(background_id, "json")
+    if os.path.exists(metadata_path):
+        return background_id
+
+    # Arrays first and the metadata last, each renamed into place, so anything listed is complete
+    y_channels = sorted(ys)
+    arrays_path = get_background_path(background_id, "npz")
+    with open(f"{arrays_path}.tmp", "wb") as f:
+        np.savez(f, x=x, **{f"y{i}": ys[y_channel] for i, y_channel in enumerate(y_channels)})
+    os.replace(f"{arrays_path}.tmp", arrays_path)
+    with open(f"{metadata_path}.tmp", "w") as f:
+        json.dump({"name": name, "x_channel": x_channel, "y_channels": y_channels, "created": time.time()}, f)
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+
+    return background_id
+
+
+def get_background(background_id):
+    # {"id", "name", "x_channel", "x", "y": {y channel: spectrum}}. Raises KeyError if there's no such background
+    with _loaded_lock:
+        if background_id in _loaded:
+            _loaded.move_to_end(background_id)
+            return _loaded[background_id]
+
+    try:
+        with open(get_background_path(background_id, "json")) as f:
+            metadata = json.load(f)
+        with np.load(get_background_path(background_id, "npz")) as arrays:
+            background = {"id": background_id,
+                          "name": metadata["name"],
+                          "x_channel": metadata["x_channel"],
+                          "x": arrays["x"],
+                          "y": {y_channel: arrays[f"y{i}"] for i, y_channel in enumerate(metadata["y_channels"])}}
+    except (OSError, ValueError):
+        raise KeyError(f"Background {background_id} is not in the library")
+
+    with _loaded_lock:
+        _loaded[background_id] = background
+        while len(_loaded) > LOADED_BACKGROUNDS:
+            _loaded.popitem(last=False)
+    return background
+
+
+def list_backgrounds():
+    # [(id, metadata)] of the whole library, newest first
+    backgrounds = []
+    for fname in os.listdir(get_backgrounds_dir()):
+        background_id, ext = os.path.splitext(fname)
+        if ext != ".json":
+            continue
+        try:
+            with open(get_background_path(background_id, "json")) as f:
+                backgrounds.append((background_id, json.load(f)))
+        except (OSError, ValueError, KeyError):
+            continue
+    return sorted(backgrounds, key=lambda background: background[1]["created"], reverse=True)
+
+
+def make_background_options():
+    return [{"label": f"{metadata['name']} ({', '.join(metadata['y_channels'])} vs {metadata['x_channel']})",
+             "value": background_id} for background_id, metadata in list_backgrounds()]
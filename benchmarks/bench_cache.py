@@ -0,0 +1,51 @@
+import argparse
+import os
+import tempfile
+import time
+
+import data
+from benchmarks import synthetic
+from dataloader.cache import ConversionCache
+
+
+def time_upload(contents, name):
+    start = time.perf_counter()
+    datastore, errors = data.add_files_to_datastore([contents], [name], [], parallel=False)
+    elapsed = time.perf_counter() - start
+
+    assert not errors, errors
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold parse against warm conversion cache hit for one upload")
+    parser.add_argument("-t", "--filetype", choices=["dat", "3ds", "sxm"], default="3ds")
+    parser.add_argument("--nx", type=int, default=64, help="Grid/scan pixels per side")
+    parser.add_argument("--num-sweep", type=int, default=512)
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data.conversion_cache = ConversionCache(os.path.join(tmp_dir, "cache"))
+
+        path = os.path.join(tmp_dir, f"synthetic.{args.filetype}")
+        if args.filetype == "dat":
+            synthetic.write_dat(path, num_sweep=args.num_sweep)
+        elif args.filetype == "3ds":
+            synthetic.write_3ds(path, nx=args.nx, ny=args.nx, num_sweep=args.num_sweep)
+        else:
+            synthetic.write_sxm(path, nx=args.nx, ny=args.nx)
+        contents = synthetic.as_upload_contents(path)
+        file_bytes = os.path.getsize(path)
+
+        cold = time_upload(contents, os.path.basename(path))
+        warm = min(time_upload(contents, os.path.basename(path)) for _ in range(args.repeats))
+
+    print(f".{args.filetype} ({file_bytes / 1e6:.1f} MB)")
+    print(f"cold parse: {cold * 1e3:8.1f} ms")
+    print(f"warm hit:   {warm * 1e3:8.1f} ms ({cold / warm:.1f}x)")
+    print(f"cache:      {data.conversion_cache.stats}")
+
+
+if __name__ == '__main__':
+    main()
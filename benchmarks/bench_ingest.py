@@ -0,0 +1,63 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import data
+from benchmarks import synthetic
+from dataloader.cache import ConversionCache
+
+
+def make_uploads(tmp_dir, num_files, filetype):
+    contents, names = [], []
+    for i in range(num_files):
+        path = os.path.join(tmp_dir, f"synthetic_{i:04d}.{filetype}")
+        if filetype == "dat":
+            synthetic.write_dat(path, seed=i)
+        else:
+            synthetic.write_3ds(path, seed=i)
+        contents.append(synthetic.as_upload_contents(path))
+        names.append(os.path.basename(path))
+
+    return contents, names
+
+
+def time_ingest(contents, names, workers):
+    start = time.perf_counter()
+    if workers == 0:
+        datastore, errors = data.add_files_to_datastore(contents, names, [], parallel=False)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            datastore, errors = data.add_files_to_datastore(contents, names, [], executor=executor)
+    elapsed = time.perf_counter() - start
+
+    assert not errors, errors
+    assert [entry["experiment_metadata"]["experiment_name"] for entry in datastore] == names
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Files/sec of load_files style ingest against worker count")
+    parser.add_argument("-n", "--num-files", type=int, default=200)
+    parser.add_argument("-t", "--filetype", choices=["dat", "3ds"], default="dat")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[0, 1, 2, 4, 8],
+                        help="0 runs the serial path")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        contents, names = make_uploads(tmp_dir, args.num_files, args.filetype)
+
+        print(f"{args.num_files} x .{args.filetype}")
+        for workers in args.workers:
+            # A fresh cache each time, or every run after the first would just be cache hits
+            data.conversion_cache = ConversionCache(tempfile.mkdtemp(prefix="cache-", dir=tmp_dir))
+            elapsed = time_ingest(contents, names, workers)
+            shutil.rmtree(data.conversion_cache.cache_dir)
+            label = "serial" if workers == 0 else f"{workers} workers"
+            print(f"{label:>12}: {args.num_files / elapsed:8.1f} files/s ({elapsed:.2f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import synthetic
+from dataloader import maps
+from dataloader.filetypes import nanonis
+
+X_CHANNEL = "Bias (V)"
+Y_CHANNEL = "Current (A)"
+
+
+def per_point_map(xdata, ydata, bias):
+    # What a map costs done one spectrum at a time: differentiate, then interpolate at the bias
+    order = np.argsort(xdata)
+    return np.array([np.interp(bias, xdata[order], np.gradient(np.asarray(spectrum, dtype=float), xdata)[order])
+                     for spectrum in ydata])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dI/dV map of a grid, per spectrum against the map engine")
+    parser.add_argument("--nx", type=int, nargs="+", default=[32, 128])
+    parser.add_argument("--num-sweep", type=int, default=512)
+    args = parser.parse_args()
+
+    for nx in args.nx:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = synthetic.write_3ds(os.path.join(tmp_dir, "synthetic.3ds"), nx=nx, ny=nx,
+                                       num_sweep=args.num_sweep, channels=(Y_CHANNEL,))
+            data_entry = nanonis.convert_3ds(path, lazy=True)
+            xdata = np.asarray(data_entry["signals"]["spectra_x"][X_CHANNEL], dtype=float)
+            ydata = data_entry["signals"]["spectra_y"][Y_CHANNEL].reshape(-1, len(xdata))
+            bias = float(np.median(xdata))
+
+            start = time.perf_counter()
+            old = per_point_map(xdata, ydata, bias)
+            per_point = time.perf_counter() - start
+
+            start = time.perf_counter()
+            new = maps.compute_map(xdata, ydata, "diff", [bias])
+            engine = time.perf_counter() - start
+
+        print(f"{nx}x{nx} grid, {args.num_sweep} point sweeps: per spectrum {per_point * 1e3:8.1f} ms, "
+              f"map engine {engine * 1e3:6.1f} ms ({per_point / engine:.0f}x), "
+              f"max difference {np.nanmax(np.abs(old - new)):.1e}")
+
+
+if __name__ == '__main__':
+    main()
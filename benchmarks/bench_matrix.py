@@ -0,0 +1,53 @@
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import synthetic
+from dataloader.filetypes import omicron
+
+
+def open_each(paths):
+    # What opening each file on its own costs: access2thematrix re-reads the index for every one of them
+    from access2thematrix import MtrxData
+
+    for path in paths:
+        mtrx = MtrxData()
+        traces, _ = mtrx.open(path)
+        if "(" in mtrx.channel_name:
+            [mtrx.select_curve(trace) for trace in traces.values()]
+        else:
+            [mtrx.select_image(trace) for trace in traces.values()]
+
+
+def convert_indexed(paths):
+    omicron._indexes.clear()  # Include parsing the index once
+    for path in paths:
+        omicron.convert_mtrx(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Matrix session load time, index parsed per file against once")
+    parser.add_argument("-n", "--num-curves", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--num-images", type=int, default=4)
+    args = parser.parse_args()
+
+    for num_curves in args.num_curves:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = synthetic.write_mtrx_session(tmp_dir, num_images=args.num_images, num_curves=num_curves)
+            index_size = os.path.getsize(omicron.get_index_path(paths[0]))
+
+            start = time.perf_counter()
+            open_each(paths)
+            per_file = time.perf_counter() - start
+
+            start = time.perf_counter()
+            convert_indexed(paths)
+            indexed = time.perf_counter() - start
+
+        print(f"{len(paths):>6} files ({index_size / 1024:.0f} kB index): open each {per_file:6.2f} s, "
+              f"indexed conversion {indexed:6.2f} s ({len(paths) / indexed:.0f} files/s)")
+
+
+if __name__ == '__main__':
+    main()
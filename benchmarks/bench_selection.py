@@ -0,0 +1,92 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import plotting
+import processing
+from benchmarks import synthetic
+from dataloader.filetypes import nanonis
+
+X_CHANNEL = "Bias (V)"
+Y_CHANNEL = "Current (A)"
+
+
+def per_point_mean(data_entry, point_idxs, tab):
+    # How make_spectra_fig used to work: reshape and differentiate the whole grid for every selected point
+    xdata = np.array(data_entry["signals"]["spectra_x"][X_CHANNEL])
+    rows = []
+    for point_idx in point_idxs:
+        ydata = np.array(data_entry["signals"]["spectra_y"][Y_CHANNEL]).reshape(-1, len(xdata))
+        if tab == "diff":
+            ydata = np.diff(ydata)
+        rows.append(ydata[point_idx].copy())  # Plotly took a copy, so the whole grid wasn't kept alive
+
+    return np.array(rows).mean(axis=0)
+
+
+def batched_mean(data_entry, point_idxs, tab):
+    # What make_spectra_traces does for a selection: one gather, then the mean from the sum of the block
+    _, block = processing.gather_spectra(data_entry, X_CHANNEL, Y_CHANNEL, point_idxs, None, tab)
+    return block.sum(axis=0) / block.shape[0]
+
+
+def clear_derived(data_entry):
+    # So derived tabs are worked out in every run, as the per-point baseline does, rather than read back
+    data_entry["derived"] = {}
+
+
+def best_of(func, repeats, setup=None):
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-point against batched spectra processing for a grid selection")
+    parser.add_argument("--nx", type=int, default=80, help="Grid points per side")
+    parser.add_argument("--num-sweep", type=int, default=512)
+    parser.add_argument("-n", "--num-selected", type=int, nargs="+", default=[10, 100, 5000])
+    parser.add_argument("--max-per-point", type=int, default=1000,
+                        help="Skip the (very slow) per-point baseline above this many points")
+    parser.add_argument("--tab", choices=["orig", "diff"], default="diff")
+    parser.add_argument("--with-figure", action="store_true", help="Also time the full make_spectra_fig")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = synthetic.write_3ds(os.path.join(tmp_dir, "synthetic.3ds"), nx=args.nx, ny=args.nx,
+                                   num_sweep=args.num_sweep, channels=(Y_CHANNEL,))
+        data_entry = nanonis.convert_3ds(path)
+
+        rng = np.random.default_rng(0)
+        print(f"{args.nx}x{args.nx} grid, {args.num_sweep} point sweeps, tab={args.tab}")
+        for num_selected in args.num_selected:
+            point_idxs = rng.choice(args.nx * args.nx, size=min(num_selected, args.nx * args.nx), replace=False)
+
+            new = best_of(lambda: batched_mean(data_entry, point_idxs, args.tab), args.repeats,
+                          setup=lambda: clear_derived(data_entry))
+            line = f"{len(point_idxs):>6} points: batched {new * 1e3:7.2f} ms"
+            if len(point_idxs) <= args.max_per_point:
+                old = best_of(lambda: per_point_mean(data_entry, point_idxs, args.tab), args.repeats)
+                line += f", per-point {old * 1e3:9.1f} ms ({old / new:.0f}x)"
+
+            if args.with_figure:
+                selection = [{"customdata": 0, "pointIndex": int(idx)} for idx in point_idxs]
+                fig = best_of(lambda: plotting.make_spectra_fig([data_entry], X_CHANNEL, [Y_CHANNEL], selection,
+                                                                None, args.tab), 1,
+                              setup=lambda: clear_derived(data_entry))
+                line += f", figure {fig * 1e3:.0f} ms"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+HEAVY_MODULES = ["pandas", "nanonispy", "matplotlib", "PIL", "scipy", "pyarrow", "h5py", "access2thematrix",
+                 "plotly.express"]
+
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import {{module}}
+elapsed = time.perf_counter() - start
+print(json.dumps({{{{"seconds": elapsed, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}}}))
+"""
+
+
+def time_import(module):
+    # A fresh interpreter each time, otherwise everything after the first import is already loaded
+    out = subprocess.run([sys.executable, "-W", "ignore", "-c", IMPORT_SCRIPT.format(module=module)],
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of the app (and other modules) in fresh interpreters")
+    parser.add_argument("-m", "--modules", nargs="+", default=["app", "data"])
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        results = [time_import(module) for _ in range(args.repeats)]
+        seconds = [result["seconds"] for result in results]
+        print(f"import {module}: median {np.median(seconds):.2f} s (min {min(seconds):.2f} s), "
+              f"heavy modules loaded: {', '.join(results[-1]['loaded']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
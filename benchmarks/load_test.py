@@ -0,0 +1,229 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks import synthetic
+from dataloader.cache import ConversionCache
+
+X_CHANNEL = "Bias (V)"
+Y_CHANNEL = "Current (A)"
+GRID_SIZE = 1e-8  # synthetic.write_3ds default
+
+
+def serve(port, cache_dir):
+    # One worker process, as gunicorn would run them: its own registry and jobs, sharing only the cache directory
+    os.environ["SPECTRA_CACHE_DIR"] = cache_dir
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())  # Exit properly when stopped, so its own pools shut down
+    from werkzeug.serving import make_server
+
+    import app
+    import data
+    try:
+        make_server("127.0.0.1", port, app.app.server, threaded=True).serve_forever()
+    finally:
+        if data._ingest_executor is not None:
+            data._ingest_executor.shutdown(cancel_futures=True)
+
+
+def wait_for_workers(urls, timeout=60):
+    start = time.time()
+    for url in urls:
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/_dash-layout").read()
+                break
+            except OSError:
+                if time.time() - start > timeout:
+                    raise
+                time.sleep(0.2)
+
+
+def post_callback(url, dependencies, output, values, changed):
+    # A POST to Dash's update route, shaped like the one the browser sends
+    callback = next(callback for callback in dependencies if callback["output"].strip(".").startswith(output))
+    outputs = [dict(zip(("id", "property"), out.split("@")[0].rsplit(".", 1)))
+               for out in callback["output"].strip(".").split("...")]
+    payload = {"output": callback["output"],
+               "outputs": outputs if len(outputs) > 1 else outputs[0],
+               "inputs": [dict(arg, value=values.get(f"{arg['id']}.{arg['property']}")) for arg in callback["inputs"]],
+               "state": [dict(arg, value=values.get(f"{arg['id']}.{arg['property']}")) for arg in callback["state"]],
+               "changedPropIds": [changed]}
+    request = urllib.request.Request(f"{url}/_dash-update-component", data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    return json.loads(body)["response"] if body else {}
+
+
+class Session:
+    """One browser tab: uploads its files, waits for them, clicks around the grid, then clears everything. Every
+    request goes to a random worker, as there's no telling which one a load balancer picks."""
+
+    def __init__(self, session_idx, urls, dependencies, uploads, num_clicks, timings):
+        self.session_idx = session_idx
+        self.urls = urls
+        self.dependencies = dependencies
+        self.names = [name for _, name in uploads]
+        self.values = {"upload-data-box.contents": [contents for contents, _ in uploads],
+                       "upload-data-box.filename": self.names,
+                       "spectra-x-channel-dropdown.value": X_CHANNEL,
+                       "spectra-y-channel-dropdown.value": [Y_CHANNEL],
+                       "tabs-spectra.value": "orig",
+                       "spectra-smoothing.value": "none",
+                       "image-channel-dropdown.value": "topo",
+                       "image-render-mode.value": "raster"}
+        self.num_clicks = num_clicks
+        self.timings = timings
+        self.rng = random.Random(session_idx)
+
+    def call(self, action, output, changed, **values):
+        self.values.update(values)
+        start = time.perf_counter()
+        response = post_callback(self.rng.choice(self.urls), self.dependencies, output, self.values, changed)
+        self.timings.setdefault(action, []).append(time.perf_counter() - start)
+        return response
+
+    def upload(self):
+        response = self.call("start_upload", "upload-jobs.data", "upload-data-box.contents")
+        self.values["upload-jobs.data"] = response["upload-jobs"]["data"]
+        self.values["session-id.data"] = response["session-id"]["data"]
+        self.values["upload-previews.data"] = response["upload-previews"]["data"]
+        while True:
+            time.sleep(0.1)
+            response = self.call("poll_upload", "uploaded-data.data", "upload-poll.n_intervals")
+            if "uploaded-data" in response:
+                self.values["uploaded-data.data"] = response["uploaded-data"]["data"]
+                self.values["upload-previews.data"] = response["upload-previews"]["data"]
+            if "upload-jobs" in response:  # Finished jobs patched out, as the browser would
+                finished_jobs = [operation["params"]["value"]
+                                 for operation in response["upload-jobs"]["data"]["operations"]]
+                self.values["upload-jobs.data"] = [job_id for job_id in self.values["upload-jobs.data"]
+                                                   if job_id not in finished_jobs]
+            self.values["alert-upload-errors.children"] = response["alert-upload-errors"]["children"]
+            if response["upload-poll"]["disabled"]:
+                break
+
+        if self.values["upload-previews.data"]:
+            raise AssertionError(f"Session {self.session_idx} still has previews of its finished upload")
+        if self.values["upload-jobs.data"]:
+            raise AssertionError(f"Session {self.session_idx} still polls its finished upload")
+        store = self.values.get("uploaded-data.data") or []
+        names = sorted(store_entry["experiment_metadata"]["experiment_name"] for store_entry in store)
+        if names != sorted(self.names):
+            raise AssertionError(f"Session {self.session_idx} got {names}, uploaded {sorted(self.names)}")
+        return store
+
+    def click(self):
+        grid_idx = next(i for i, store_entry in enumerate(self.values["uploaded-data.data"])
+                        if store_entry["experiment_metadata"]["data_type"] == "spectra")
+        self.call("image", "fig-image.figure", "image-channel-dropdown.value")
+        for _ in range(self.num_clicks):
+            click = {"points": [{"customdata": grid_idx, "x": self.rng.uniform(0, GRID_SIZE),
+                                 "y": self.rng.uniform(0, GRID_SIZE)}]}
+            response = self.call("spectra_click", "fig-spectra.figure", "fig-image.clickData",
+                                 **{"fig-image.clickData": click, "spectra-state.data": None})
+            if not response["fig-spectra"]["figure"]["data"]:
+                raise AssertionError(f"Session {self.session_idx} clicked {click} and got no spectra")
+
+    def clear(self):
+        self.call("clear_all", "clear-all-redirect.href", "btn-clear-all.n_clicks", **{"btn-clear-all.n_clicks": 1})
+
+
+def make_uploads(tmp_dir, num_sessions, num_files, grid_nx):
+    # Everyone uploads the same grid (under their own name), plus files of their own
+    shared_path = synthetic.write_3ds(os.path.join(tmp_dir, "shared.3ds"), nx=grid_nx, ny=grid_nx)
+    shared_contents = synthetic.as_upload_contents(shared_path)
+    uploads = []
+    for session_idx in range(num_sessions):
+        session_uploads = [(shared_contents, f"grid_session{session_idx}.3ds")]
+        for i in range(num_files):
+            path = synthetic.write_dat(os.path.join(tmp_dir, f"session{session_idx}_{i}.dat"),
+                                       seed=session_idx * num_files + i + 1)
+            session_uploads.append((synthetic.as_upload_contents(path), os.path.basename(path)))
+        uploads.append(session_uploads)
+    return uploads
+
+
+def run_session(session):
+    store = session.upload()
+    shared_id = next(store_entry["dataset_id"] for store_entry in store
+                     if store_entry["experiment_metadata"]["data_type"] == "spectra")
+    session.click()
+    return shared_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent sessions uploading and clicking against several worker "
+                                                 "processes sharing one cache, checking they stay apart")
+    parser.add_argument("-n", "--sessions", type=int, default=8)
+    parser.add_argument("-w", "--workers", type=int, default=2)
+    parser.add_argument("--files", type=int, default=2, help="Files of its own each session uploads")
+    parser.add_argument("--clicks", type=int, default=10)
+    parser.add_argument("--nx", type=int, default=32, help="Size of the grid every session uploads")
+    parser.add_argument("--port", type=int, default=8760, help="First worker's port")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = os.path.join(tmp_dir, "cache")
+        context = multiprocessing.get_context("spawn")
+        urls = [f"http://127.0.0.1:{args.port + i}" for i in range(args.workers)]
+        workers = [context.Process(target=serve, args=(args.port + i, cache_dir))
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            uploads = make_uploads(tmp_dir, args.sessions, args.files, args.nx)
+            wait_for_workers(urls)
+            dependencies = json.loads(urllib.request.urlopen(f"{urls[0]}/_dash-dependencies").read())
+
+            sessions = [Session(i, urls, dependencies, uploads[i], args.clicks, {}) for i in range(args.sessions)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+                shared_ids = list(executor.map(run_session, sessions))
+            elapsed = time.perf_counter() - start
+
+            # The grid everyone uploaded is one dataset, stored once and held by every session until they clear
+            cache = ConversionCache(cache_dir)
+            num_entries = sum(not key.startswith(".") for key in os.listdir(cache_dir))
+            holders = cache.get_holders(shared_ids[0])
+            for session in sessions:
+                session.clear()
+            holders_after = cache.get_holders(shared_ids[0])
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+
+    timings = {}
+    for session in sessions:
+        for action, seconds in session.timings.items():
+            timings.setdefault(action, []).extend(seconds)
+
+    print(f"{args.sessions} sessions on {args.workers} workers in {elapsed:.1f} s")
+    for action, seconds in timings.items():
+        seconds = np.array(seconds) * 1e3
+        print(f"{action:<14} {len(seconds):5d} calls  p50 {np.percentile(seconds, 50):8.1f} ms  "
+              f"p95 {np.percentile(seconds, 95):8.1f} ms  max {seconds.max():8.1f} ms")
+    print(f"Shared grid: {len(set(shared_ids))} dataset id(s) across sessions, held by {len(holders)} sessions, "
+          f"{len(holders_after)} after clearing. {num_entries} cache entries for "
+          f"{1 + args.sessions * args.files} distinct files")
+    if len(set(shared_ids)) != 1 or len(holders) != args.sessions or holders_after or \
+            num_entries != 1 + args.sessions * args.files:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
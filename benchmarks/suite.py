@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks import synthetic
+
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), "results.jsonl")
+X_CHANNEL = "Bias (V)"
+Y_CHANNEL = "Current (A)"
+
+SIZES = {"small": {"grid_nx": 32, "num_sweep": 256, "scan_nx": 256, "selections": [1, 10, 100]},
+         "medium": {"grid_nx": 64, "num_sweep": 512, "scan_nx": 512, "selections": [1, 10, 100, 1000]},
+         "large": {"grid_nx": 128, "num_sweep": 1024, "scan_nx": 1024, "selections": [1, 10, 100, 1000, 5000]}}
+
+
+def measure(func, repeats, setup=None):
+    # Best wall time of repeats, then once more under tracemalloc for the peak (kept apart, as tracing slows it down)
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def make_result(name, seconds, peak_mem_bytes, work=None, unit=None, payload_bytes=None):
+    return {"name": name,
+            "seconds": seconds,
+            "throughput": None if work is None else work / seconds,
+            "unit": unit,
+            "peak_mem_bytes": peak_mem_bytes,
+            "payload_bytes": payload_bytes}
+
+
+def bench_convert(tmp_dir, size, repeats):
+    from dataloader.filetypes import nanonis
+
+    paths = {"3ds": synthetic.write_3ds(os.path.join(tmp_dir, "synthetic.3ds"), nx=size["grid_nx"],
+                                        ny=size["grid_nx"], num_sweep=size["num_sweep"]),
+             "dat": synthetic.write_dat(os.path.join(tmp_dir, "synthetic.dat"), num_sweep=size["num_sweep"]),
+             "sxm": synthetic.write_sxm(os.path.join(tmp_dir, "synthetic.sxm"), nx=size["scan_nx"],
+                                        ny=size["scan_nx"])}
+    converters = {"3ds": nanonis.convert_3ds, "dat": nanonis.convert_dat, "sxm": nanonis.convert_sxm}
+
+    results, entries = [], {}
+    for filetype, path in paths.items():
+        seconds, peak = measure(lambda: converters[filetype](path), repeats)
+        results.append(make_result(f"convert_{filetype}", seconds, peak, os.path.getsize(path) / 1e6, "MB/s"))
+        entries[filetype] = converters[filetype](path)
+
+    return results, entries, paths
+
+
+def bench_image_plot(entries, repeats):
+    import data
+    import plotting
+
+    results = []
+    for filetype, img_channel in [("sxm", entries["sxm"]["signal_metadata"]["img_channels"][0]), ("3ds", "topo")]:
+        for render_mode in ["heatmap", "raster"]:
+            fig = plotting.make_image_spec_position_plot([entries[filetype]], img_channel, render_mode=render_mode)
+            seconds, peak = measure(
+                lambda: plotting.make_image_spec_position_plot([entries[filetype]], img_channel,
+                                                               render_mode=render_mode),
+                repeats, setup=data._rendered_images.clear)  # Cold render, not a cache hit
+            results.append(make_result(f"image_plot_{filetype}_{render_mode}", seconds, peak,
+                                       payload_bytes=len(fig.to_json())))
+
+    return results
+
+
+def bench_spectra_fig(entries, size, repeats):
+    import plotting
+
+    grid = entries["3ds"]
+    num_points = size["grid_nx"] ** 2
+    rng = np.random.default_rng(0)
+
+    results = []
+    for num_selected in size["selections"]:
+        point_idxs = rng.choice(num_points, size=min(num_selected, num_points), replace=False)
+        selection = [{"customdata": 0, "pointIndex": int(point_idx)} for point_idx in point_idxs]
+        make_fig = lambda: plotting.make_spectra_fig([grid], X_CHANNEL, [Y_CHANNEL], selection, None, "orig")
+
+        fig, _ = make_fig()
+        seconds, peak = measure(make_fig, repeats)
+        results.append(make_result(f"spectra_fig_{len(point_idxs)}", seconds, peak, len(point_idxs), "spectra/s",
+                                   payload_bytes=len(fig.to_json())))
+
+    return results
+
+
+def call_callback(client, callback_map, output, values, changed):
+    # A POST to Dash's update route, shaped like the one the browser sends. Returns (response, bytes in, bytes out)
+    from plotly.utils import PlotlyJSONEncoder
+
+    key = next(key for key in callback_map if key.strip(".").startswith(output))
+    callback = callback_map[key]
+    outputs = [dict(zip(("id", "property"), out.split("@")[0].rsplit(".", 1))) for out in key.strip(".").split("...")]
+    payload = {"output": key,
+               "outputs": outputs if len(outputs) > 1 else outputs[0],
+               "inputs": [dict(arg, value=values.get(f"{arg['id']}.{arg['property']}")) for arg in callback["inputs"]],
+               "state": [dict(arg, value=values.get(f"{arg['id']}.{arg['property']}")) for arg in callback["state"]],
+               "changedPropIds": [changed]}
+    body = json.dumps(payload, cls=PlotlyJSONEncoder)
+
+    response = client.post("/_dash-update-component", data=body, content_type="application/json")
+    if response.status_code != 200:
+        raise RuntimeError(f"{output} returned {response.status_code}")
+    return response.get_json()["response"], len(body), len(response.data)
+
+
+def bench_callbacks(paths, repeats):
+    # Whole round trips through the app, for the payload sizes the browser actually sends and receives
+    import app
+    import data
+
+    client = app.app.server.test_client()
+    values = {"upload-data-box.contents": [synthetic.as_upload_contents(paths[filetype]) for filetype in paths],
+              "upload-data-box.filename": [os.path.basename(paths[filetype]) for filetype in paths],
+              "image-render-mode.value": "raster",
+              "spectra-x-channel-dropdown.value": X_CHANNEL,
+              "spectra-y-channel-dropdown.value": [Y_CHANNEL],
+              "tabs-spectra.value": "orig",
+              "spectra-smoothing.value": "none",
+              "upload-jobs.data": None}
+
+    results, start_timings = [], []
+
+    def upload():
+        # Start the upload, then poll it like the browser would until it's done. The start is timed on its own too,
+        # as it's what brings back the dropdowns and spectra positions (from each file's header)
+        values["uploaded-data.data"] = None
+        start = time.perf_counter()
+        response, bytes_in, bytes_out = call_callback(client, app.app.callback_map, "upload-jobs.data", values,
+                                                      "upload-data-box.contents")
+        start_timings.append(time.perf_counter() - start)
+        values["upload-jobs.data"] = response["upload-jobs"]["data"]
+        while True:
+            time.sleep(app.UPLOAD_POLL_MS / 1e3 / 10)
+            response, poll_in, poll_out = call_callback(client, app.app.callback_map, "uploaded-data.data", values,
+                                                        "upload-poll.n_intervals")
+            bytes_in, bytes_out = bytes_in + poll_in, bytes_out + poll_out
+            if "uploaded-data" in response:
+                values["uploaded-data.data"] = response["uploaded-data"]["data"]
+                values["upload-previews.data"] = response["upload-previews"]["data"]
+            if response["upload-poll"]["disabled"]:
+                return bytes_in, bytes_out
+
+    def clear_cache():  # So every upload is converted, rather than a cache hit
+        shutil.rmtree(data.conversion_cache.cache_dir)
+        os.makedirs(data.conversion_cache.cache_dir)
+
+    seconds, peak = measure(upload, repeats, setup=clear_cache)
+    results.append(make_result("callback_load_files", seconds, peak, payload_bytes=sum(upload())))
+    results.append(make_result("callback_start_upload", min(start_timings), None))
+
+    grid_entry = data.resolve_datastore(values["uploaded-data.data"])[0]
+    values["image-channel-dropdown.value"] = "topo"
+    pos = np.asarray(grid_entry["signal_metadata"]["pos_xy"]).reshape(-1, 2)
+    click = {"points": [{"customdata": 0, "pointIndex": 0, "x": float(pos[0, 0]), "y": float(pos[0, 1])}]}
+    box = {"points": [], "range": {"x": [pos[:, 0].min(), pos[:, 0].max()], "y": [pos[:, 1].min(), pos[:, 1].max()]}}
+    events = {"image": ("fig-image.figure", "image-channel-dropdown.value", {}),
+              "spectra_click": ("fig-spectra.figure", "fig-image.clickData", {"fig-image.clickData": click}),
+              "spectra_box": ("fig-spectra.figure", "fig-image.selectedData", {"fig-image.selectedData": box})}
+    for name, (output, changed, event_values) in events.items():
+        event_values = dict(values, **event_values, **{"spectra-state.data": None})
+        call = lambda: call_callback(client, app.app.callback_map, output, event_values, changed)
+        seconds, peak = measure(call, repeats)
+        _, bytes_in, bytes_out = call()
+        results.append(make_result(f"callback_{name}", seconds, peak, payload_bytes=bytes_in + bytes_out))
+
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous_run(results_path, size):
+    if not os.path.exists(results_path):
+        return None
+    previous = None
+    with open(results_path) as f:
+        for line in f:
+            run = json.loads(line)
+            if run["size"] == size:
+                previous = run
+    return previous
+
+
+def compare(result, previous, threshold):
+    # Relative change of each measure against the last run, flagging anything worse by more than threshold
+    if previous is None:
+        return ""
+    changes = []
+    for key, label in [("seconds", "time"), ("peak_mem_bytes", "mem"), ("payload_bytes", "payload")]:
+        if result[key] and previous.get(key):
+            change = result[key] / previous[key] - 1
+            flag = " REGRESSION" if change > threshold else ""
+            changes.append(f"{label} {change:+.0%}{flag}")
+    return ", ".join(changes)
+
+
+def print_results(results, previous, threshold):
+    for result in results:
+        throughput = f"{result['throughput']:10.1f} {result['unit']:<9}" if result["throughput"] else " " * 21
+        payload = f"{result['payload_bytes'] / 1e3:9.1f} kB" if result["payload_bytes"] else " " * 12
+        peak = f"{result['peak_mem_bytes'] / 1e6:8.1f} MB peak" if result["peak_mem_bytes"] is not None else " " * 16
+        print(f"{result['name']:<28} {result['seconds'] * 1e3:9.1f} ms {throughput} {peak} {payload}  "
+              f"{compare(result, previous.get(result['name']), threshold)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversion, figure and callback benchmarks on synthetic files. Each "
+                                                 "run is appended to a results file and compared with the last one")
+    parser.add_argument("-s", "--size", choices=list(SIZES), default="small")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("--results", default=RESULTS_PATH, help="Where runs are kept (JSON lines)")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Relative slowdown counted as a regression")
+    parser.add_argument("--no-save", action="store_true", help="Compare only, don't add this run to the results")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit non-zero if anything regressed")
+    args = parser.parse_args()
+    size = SIZES[args.size]
+
+    import data
+    from dataloader.cache import ConversionCache
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data.conversion_cache = ConversionCache(os.path.join(tmp_dir, "cache"))  # Never touch the real cache
+
+        results, entries, paths = bench_convert(tmp_dir, size, args.repeats)
+        results += bench_image_plot(entries, args.repeats)
+        results += bench_spectra_fig(entries, size, args.repeats)
+        results += bench_callbacks(paths, args.repeats)
+
+    previous_run = load_previous_run(args.results, args.size)
+    previous = {result["name"]: result for result in previous_run["results"]} if previous_run else {}
+    if previous_run is not None:
+        print(f"Compared with {previous_run['commit']} at {time.ctime(previous_run['time'])}")
+    print_results(results, previous, args.threshold)
+
+    if not args.no_save:
+        run = {"time": time.time(),
+               "commit": get_commit(),
+               "size": args.size,
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "results": results}
+        with open(args.results, "a") as f:
+            f.write(json.dumps(run) + "\n")
+
+    regressed = any("REGRESSION" in compare(result, previous.get(result["name"]), args.threshold) for result in results)
+    if args.fail_on_regression and regressed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
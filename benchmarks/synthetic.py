@@ -0,0 +1,219 @@
+import argparse
+import base64
+import os
+import struct
+
+import numpy as np
+
+GRID_FIXED_PARAMETERS = ["Sweep Start", "Sweep End"]
+GRID_EXPERIMENTAL_PARAMETERS = ["X (m)", "Y (m)", "Z (m)", "Z offset (m)"]
+
+
+def write_3ds(path, nx=16, ny=16, num_sweep=256, channels=("Current (A)", "LIX 1 omega (A)"), size=1e-8, seed=0):
+    num_param = len(GRID_FIXED_PARAMETERS) + len(GRID_EXPERIMENTAL_PARAMETERS)
+    header = [f'Grid dim="{nx} x {ny}"',
+              f"Grid settings={size / 2:E};{size / 2:E};{size:E};{size:E};0.000000E+0",
+              'Sweep Signal="Bias (V)"',
+              f'Fixed parameters="{";".join(GRID_FIXED_PARAMETERS)}"',
+              f'Experiment parameters="{";".join(GRID_EXPERIMENTAL_PARAMETERS)}"',
+              f"# Parameters (4 byte)={num_param}",
+              f"Experiment size (bytes)={num_sweep * len(channels) * 4}",
+              f"Points={num_sweep}",
+              f'Channels="{";".join(channels)}"',
+              "Delay before measuring (s)=0.000000E+0",
+              'Experiment="Grid Spectroscopy"',
+              'Start time="01.01.2022 00:00:00"',
+              'End time="01.01.2022 01:00:00"',
+              'User=""',
+              'Comment=""',
+              ":HEADER_END:",
+              ""]
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.meshgrid(np.linspace(0, size, ny), np.linspace(0, size, nx), indexing="ij")
+    bias = np.linspace(-1, 1, num_sweep)
+
+    body = np.empty((ny, nx, num_param + num_sweep * len(channels)), dtype=">f4")
+    body[..., 0] = bias[0]
+    body[..., 1] = bias[-1]
+    body[..., 2] = xx
+    body[..., 3] = yy
+    body[..., 4] = rng.normal(scale=1e-10, size=(ny, nx))
+    body[..., 5] = 0
+    for i in range(len(channels)):
+        start = num_param + i * num_sweep
+        body[..., start:start + num_sweep] = np.sinh(bias) + rng.normal(scale=0.05, size=(ny, nx, num_sweep))
+
+    with open(path, "wb") as f:
+        f.write("\r\n".join(header).encode())
+        body.tofile(f)
+
+    return path
+
+
+def write_dat(path, num_sweep=256, x=1e-9, y=2e-9, seed=0):
+    header = ["Experiment\tbias spectroscopy",
+              "Saved Date\t01.01.2022 00:00:00",
+              "Start time\t01.01.2022 00:00:00",
+              f"X (m)\t{x:E}",
+              f"Y (m)\t{y:E}",
+              "",
+              "[DATA]",
+              "Bias calc (V)\tCurrent (A)"]
+
+    bias = np.linspace(-1, 1, num_sweep)
+    current = np.sinh(bias) + np.random.default_rng(seed).normal(scale=0.05, size=num_sweep)
+    rows = [f"{b:E}\t{c:E}" for b, c in zip(bias, current)]
+
+    with open(path, "w", newline="") as f:
+        f.write("\r\n".join(header + rows) + "\r\n")
+
+    return path
+
+
+def write_sxm(path, nx=256, ny=256, channels=("Z", "Current"), size=1e-8, seed=0):
+    header = {"NANONIS_VERSION": "2",
+              "SCANIT_TYPE": "              FLOAT            MSBFIRST",
+              "REC_DATE": "01.01.2022",
+              "REC_TIME": "00:00:00",
+              "SCAN_PIXELS": f"{nx} {ny}",
+              "SCAN_TIME": "1.000E+0 1.000E+0",
+              "SCAN_RANGE": f"{size:E} {size:E}",
+              "SCAN_OFFSET": "0.000000E+0 0.000000E+0",
+              "BIAS": "1.000E+0",
+              "ACQ_TIME": "10.0",
+              "COMMENT": ""}
+
+    lines = []
+    for key, val in header.items():
+        lines += [f":{key}:", val]
+    lines += [":DATA_INFO:", "\tChannel\tName\tUnit\tDirection\tCalibration\tOffset"]
+    lines += [f"\t{14 + i}\t{channel}\tm\tboth\t1.000E+0\t0.000E+0" for i, channel in enumerate(channels)]
+    lines += ["", ":SCANIT_END:", "", "", ""]
+
+    body = np.random.default_rng(seed).normal(size=(len(channels), 2, ny, nx)).astype(">f4")
+    with open(path, "wb") as f:
+        f.write("\n".join(lines).encode())
+        f.write(b"\x1a\x04")
+        body.tofile(f)
+
+    return path
+
+
+def _mtrx_str(val):
+    return struct.pack("<L", len(val)) + val.encode("utf-16-le")
+
+
+def _mtrx_val(val):
+    if isinstance(val, bool):
+        return b"LOOB" + struct.pack("<L", val)
+    elif isinstance(val, int):
+        return b"GNOL" + struct.pack("<l", val)
+    else:
+        return b"BUOD" + struct.pack("<d", val)
+
+
+def _mtrx_block(tag, block, timestamp=True):
+    return tag + struct.pack("<L", len(block)) + (b"\0" * 8 if timestamp else b"") + block
+
+
+def _mtrx_params(params):
+    # {group: {name: (value, unit)}} as an experiment element parameters block
+    block = b"\0" * 4 + struct.pack("<L", len(params))
+    for group, props in params.items():
+        block += _mtrx_str(group) + struct.pack("<L", len(props))
+        for prop, (val, unit) in props.items():
+            block += _mtrx_str(prop) + _mtrx_str(unit) + b"\0" * 4 + _mtrx_val(val)
+    return _mtrx_block(b"APEE", block)
+
+
+def _mtrx_channels(channels):
+    # Channel names, each with a linear transfer function from the raw integers
+    dict_block = b"\0" * 8 + struct.pack("<L", 0) + struct.pack("<L", len(channels))
+    xfer_block = b""
+    for i, (channel, unit) in enumerate(channels):
+        dict_block += b"\0" * 4 + struct.pack("<L", i) + b"\0" * 8 + _mtrx_str(channel) + _mtrx_str(unit)
+        xfer_block += b"\0" * 4 + struct.pack("<L", i) + _mtrx_str("TFF_Linear1D") + _mtrx_str(unit)
+        xfer_block += struct.pack("<L", 2) + _mtrx_str("Offset") + _mtrx_val(0.0) + _mtrx_str("Factor") + _mtrx_val(1e9)
+    dict_block += struct.pack("<L", 0)
+    return _mtrx_block(b"TCID", dict_block, timestamp=False) + _mtrx_block(b"REFX", xfer_block, timestamp=False)
+
+
+def _mtrx_data_file(path, raw):
+    data = _mtrx_block(b"CSED", b"\0" * 20 + struct.pack("<ii", len(raw), len(raw)), timestamp=False)
+    data += _mtrx_block(b"ATAD", np.asarray(raw, dtype="<i4").tobytes(), timestamp=False)
+    with open(path, "wb") as f:
+        f.write(b"ONTMATRX0101" + b"TLKB" + struct.pack("<L", 4 + len(data)) + struct.pack("<Q", 1640995200)
+                + b"\0" * 4 + data)
+
+
+def write_mtrx_session(out_dir, num_images=1, num_curves=100, nx=128, num_sweep=256, size=1e-8, seed=0):
+    # An Omicron Matrix session: one index file, then Z images and I(V) curves. Returns the data file paths
+    chain = os.path.join(out_dir, "default_2022Jan01-000000_STM-STM_Spectroscopy")
+    rng = np.random.default_rng(seed)
+    index = b"ONTMATRX0101"
+    index += _mtrx_params({"XYScanner": {"X_Retrace": (True, ""), "Y_Retrace": (False, ""), "Points": (nx, ""),
+                                         "Lines": (nx, ""), "Width": (size, "m"), "Height": (size, "m"),
+                                         "X_Offset": (0.0, "m"), "Y_Offset": (0.0, "m"), "Angle": (0.0, "Degree"),
+                                         "Enable_Subgrid": (False, "")},
+                           "Spectroscopy": {"Device_1_Start": (-1.0, "Volt"), "Device_1_End": (1.0, "Volt"),
+                                            "Device_1_Points": (num_sweep, ""),
+                                            "Enable_Device_1_Ramp_Reversal": (True, "")}})
+    index += _mtrx_channels([("Z", "m"), ("I(V)", "A")])
+
+    paths = []
+    for i in range(num_images + num_curves):
+        if i < num_images:
+            fname = f"{os.path.basename(chain)}--{i + 1}_1.Z_mtrx"
+            raw = rng.integers(-1000, 1000, size=2 * nx * nx)
+        else:
+            fname = f"{os.path.basename(chain)}--{num_images}_{i - num_images + 1}.I(V)_mtrx"
+            x, y = rng.uniform(-size / 2, size / 2, size=2)
+            index += _mtrx_block(b"KRAM", _mtrx_str(f"MTRX$STS_LOCATION-1,1;{x:E},{y:E}%%0-0-0-0%%"))
+            raw = (np.tile(np.sinh(np.linspace(-1, 1, num_sweep)), 2) * 1000).astype(int)
+
+        # Like a real session, parameters keep being logged between files
+        index += _mtrx_params({"Regulator": {"Setpoint_1": (float(rng.uniform(1e-10, 1e-9)), "A")}})
+        index += _mtrx_block(b"FERB", b"\0" * 4 + _mtrx_str(fname))
+
+        _mtrx_data_file(os.path.join(out_dir, fname), raw)
+        paths.append(os.path.join(out_dir, fname))
+
+    with open(f"{chain}_0001.mtrx", "wb") as f:
+        f.write(index)
+
+    return paths
+
+
+def as_upload_contents(path):
+    # The same "data:...;base64,..." string dcc.Upload hands to start_upload
+    with open(path, "rb") as f:
+        return "data:application/octet-stream;base64," + base64.b64encode(f.read()).decode("ascii")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic files, e.g. to try the app or CLI on big inputs")
+    parser.add_argument("out_dir")
+    parser.add_argument("-t", "--filetypes", nargs="+", choices=["3ds", "dat", "sxm", "mtrx"], default=["3ds", "sxm"])
+    parser.add_argument("-n", "--num-files", type=int, default=1, help="Of each type (curves for Matrix)")
+    parser.add_argument("--nx", type=int, default=64, help="Grid/scan pixels per side")
+    parser.add_argument("--num-sweep", type=int, default=512)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for filetype in args.filetypes:
+        if filetype == "mtrx":
+            write_mtrx_session(args.out_dir, num_curves=args.num_files, nx=args.nx, num_sweep=args.num_sweep)
+            continue
+        for i in range(args.num_files):
+            path = os.path.join(args.out_dir, f"synthetic_{i:04d}.{filetype}")
+            if filetype == "3ds":
+                write_3ds(path, nx=args.nx, ny=args.nx, num_sweep=args.num_sweep, seed=i)
+            elif filetype == "dat":
+                write_dat(path, num_sweep=args.num_sweep, seed=i)
+            else:
+                write_sxm(path, nx=args.nx, ny=args.nx, seed=i)
+
+
+if __name__ == '__main__':
+    main()
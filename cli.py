@@ -0,0 +1,144 @@
+import argparse
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+import numpy as np
+import pandas as pd
+
+import data
+import processing
+from dataloader import formats
+from dataloader.derived import DERIVED_TABS
+
+SPECTRA_TABS = ["orig"] + DERIVED_TABS
+POINT_CHUNK_SIZE = 4096  # Spectra read at a time when averaging a grid, so memory doesn't scale with the grid
+
+
+def walk_files(in_dir):
+    for root, dirs, fnames in os.walk(in_dir):
+        dirs.sort()
+        for fname in sorted(fnames):
+            if formats.is_supported(fname):
+                yield os.path.join(root, fname)
+
+
+def get_mean_spectra(entry, x_channel, y_channel, tab):
+    num_points = np.asarray(entry["signal_metadata"]["pos_xy"]).size // 2
+    sums, sumsqs, xdata = None, None, None
+    for start in range(0, num_points, POINT_CHUNK_SIZE):
+        xdata, block = processing.gather_spectra(entry, x_channel, y_channel,
+                                                 np.arange(start, min(start + POINT_CHUNK_SIZE, num_points)), None, tab)
+        if block is None:
+            return None, None, None
+        sums = block.sum(axis=0) if sums is None else sums + block.sum(axis=0)
+        sumsqs = (block ** 2).sum(axis=0) if sumsqs is None else sumsqs + (block ** 2).sum(axis=0)
+
+    mean, std = processing.summarise_running(sums, sumsqs, num_points)
+    return xdata, mean, std
+
+
+def write_spectra(entry, out_prefix):
+    # Against the first x channel, which is the sweep signal for both grids and point spectra
+    x_channel = entry["signal_metadata"]["spectra_x_channels"][0]
+    written = []
+    for tab in SPECTRA_TABS:
+        columns = {}
+        for y_channel in entry["signal_metadata"]["spectra_y_channels"]:
+            if y_channel == x_channel:
+                continue
+            xdata, mean, std = get_mean_spectra(entry, x_channel, y_channel, tab)
+            if mean is None:
+                continue
+            columns[x_channel] = xdata[:len(mean)]
+            columns[f"{y_channel} mean"] = mean
+            columns[f"{y_channel} std"] = std
+
+        if columns:
+            fname = f"{out_prefix}_{tab}.csv"
+            pd.DataFrame(columns).to_csv(fname, index=False)
+            written.append(fname)
+
+    return written
+
+
+def write_images(entry, out_prefix):
+    written = []
+    res = entry["signal_metadata"]["image_points_res"]
+    for img_channel in entry["signal_metadata"]["img_channels"]:
+        img = np.asarray(entry["signals"]["img"][img_channel], dtype=float).reshape(res[::-1])
+        with np.errstate(invalid="ignore"):
+            min_cutoff, max_cutoff = np.nanmin(img), np.nanmax(img)
+        if not max_cutoff > min_cutoff:  # Blank, or a fixed parameter of a grid
+            continue
+
+        fname = f"{out_prefix}_{img_channel.replace(' ', '_').replace('/', '-')}.png"
+        data.sxm2pil(img, min_cutoff, max_cutoff).save(fname)
+        written.append(fname)
+
+    return written
+
+
+def process_file(path, in_dir, out_dir):
+    # Runs in the worker processes. Only a short summary goes back, so nothing of the file outlives this call
+    start = time.perf_counter()
+    out_prefix = os.path.join(out_dir, os.path.splitext(os.path.relpath(path, in_dir))[0])
+    os.makedirs(os.path.dirname(out_prefix), exist_ok=True)
+
+    try:
+        entry = data.convert_file(path, lazy=formats.is_lazy(path))  # The original stays on disk
+        written = []
+        if entry["signal_metadata"]["spectra_y_channels"]:
+            written += write_spectra(entry, out_prefix)
+        if entry["signal_metadata"]["img_channels"]:
+            written += write_images(entry, out_prefix)
+        error = None
+    except Exception as e:
+        written, error = [], str(e)
+
+    return {"path": path, "bytes": os.path.getsize(path), "written": written, "error": error,
+            "seconds": time.perf_counter() - start}
+
+
+def process_dir(in_dir, out_dir, workers=None, max_pending=None):
+    # Generator of per-file summaries as they finish. Only a bounded number of files are in flight at once
+    max_pending = max_pending or 4 * (workers or os.cpu_count())
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for path in walk_files(in_dir):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from (future.result() for future in done)
+            pending.add(executor.submit(process_file, path, in_dir, out_dir))
+
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert every supported file under a directory, writing mean spectra "
+                                                 "(and derivatives) as .csv and image channels as .png")
+    parser.add_argument("in_dir")
+    parser.add_argument("out_dir")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Defaults to the number of CPUs")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the summary")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    num_files, num_bytes, num_errors = 0, 0, 0
+    for result in process_dir(args.in_dir, args.out_dir, args.workers):
+        num_files += 1
+        num_bytes += result["bytes"]
+        if result["error"] is not None:
+            num_errors += 1
+            print(f"Could not process {result['path']}: {result['error']}")
+        elif not args.quiet:
+            print(f"{result['path']}: {len(result['written'])} outputs in {result['seconds']:.2f} s")
+
+    elapsed = time.perf_counter() - start
+    print(f"{num_files} files ({num_bytes / 1024 ** 2:.1f} MB) in {elapsed:.1f} s, "
+          f"{num_files / elapsed:.1f} files/s, {num_bytes / 1024 ** 2 / elapsed:.1f} MB/s, {num_errors} failed")
+
+
+if __name__ == '__main__':
+    main()
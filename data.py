@@ -1,61 +1,427 @@
 import base64
+import hashlib
+import io
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from typing import TYPE_CHECKING
 
-import nanonispy as napy
 import numpy as np
-import pandas as pd
-from PIL import Image
-from nOmicron.utils.plotting import nanomap
 
-from dataloader.filetypes import nanonis, omicron
+from dataloader import derived, formats, maps
+from dataloader.cache import ConversionCache
+from dataloader.pyramid import build_pyramid
+from instrumentation import timed
+from registry import DatasetRegistry
 from utils import get_ext
 
+if TYPE_CHECKING:
+    import nanonispy as napy  # Only for annotations, it's imported when a Nanonis file is actually read
 
-def make_tmpfile(contents: str, orig_name: str):
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+dataset_registry = DatasetRegistry(max_entries=int(os.environ.get("SPECTRA_MAX_DATASETS", 32)))
+conversion_cache = ConversionCache(os.environ.get("SPECTRA_CACHE_DIR", os.path.join(os.path.dirname(__file__), "cache")),
+                                   max_bytes=int(os.environ.get("SPECTRA_CACHE_MAX_BYTES", 10 * 1024 ** 3)),
+                                   ref_ttl=int(os.environ.get("SPECTRA_SESSION_TTL_S", 7 * 24 * 3600)))
 
-    f = open(orig_name, "wb")
-    f.write(decoded)
-    f.close()
+INGEST_WORKERS = os.cpu_count()
+_ingest_executor = None
 
+RENDERED_IMAGE_CACHE_SIZE = 128
+_rendered_images = OrderedDict()
+_rendered_images_lock = threading.Lock()
 
-def del_tmpfile_dir():
-    for file in os.listdir("tmp"):
-        os.remove(f"tmp/{file}")
+_derived_lock = threading.Lock()  # Only held to find the lock for one channel (see get_derived_lock)
 
+CANCEL_CHECK_S = 0.5  # How often a running upload checks whether it has been cancelled
+UPLOAD_CHUNK_CHARS = 4 * 1024 * 1024  # Multiple of 4, so every chunk is valid base64 on its own
+PREVIEW_HEAD_BYTES = 256 * 1024  # Start of each upload read for its header (see add_previews), a few kB in practice
+PREVIEW_TTL_S = 3600
+PREVIEW_ID_PATTERN = r"preview-[0-9a-f]{32}\.\w+"
 
-def make_empty_data_store():
-    del_tmpfile_dir()
-    return []
+
+def make_tmpfile(contents: str, orig_name: str, tmp_dir=None):
+    # Each upload gets its own directory so identical filenames from different users can't collide, unless it
+    # needs to sit next to other files of the same upload (Matrix index files). The original name is kept as
+    # nanonispy uses it for the extension check and the experiment name
+    tmp_dir = tempfile.mkdtemp(prefix="spectra-upload-") if tmp_dir is None else tmp_dir
+    tmp_path = os.path.join(tmp_dir, os.path.basename(orig_name))
+
+    # Decode in chunks rather than holding a second full copy of the upload in memory
+    data_start = contents.index(",") + 1
+    with open(tmp_path, "wb") as f:
+        for chunk_start in range(data_start, len(contents), UPLOAD_CHUNK_CHARS):
+            f.write(base64.b64decode(contents[chunk_start:chunk_start + UPLOAD_CHUNK_CHARS]))
+
+    return tmp_path
+
+
+def get_content_hash(contents: str):
+    # Hashing the base64 text identifies the file just as well, and means a cache hit never has to decode it
+    content_hash = hashlib.sha256()
+    data_start = contents.index(",") + 1
+    for chunk_start in range(data_start, len(contents), UPLOAD_CHUNK_CHARS):
+        content_hash.update(contents[chunk_start:chunk_start + UPLOAD_CHUNK_CHARS].encode("ascii"))
+
+    return content_hash.hexdigest()
 
 
-def add_file_to_datastore(data, filename: str, old_datastore):
-    tmp_path = f"tmp/{filename}"
-    make_tmpfile(data, tmp_path)
+def read_upload_head(contents: str, num_bytes=PREVIEW_HEAD_BYTES):
+    # Only decodes the start of the upload, whatever its size
+    data_start = contents.index(",") + 1
+    return base64.b64decode(contents[data_start:data_start + -(-num_bytes // 3) * 4])
 
-    if get_ext(tmp_path) == "3ds":  # Use some code to generate function automatically??
-        new_entry = nanonis.convert_3ds(tmp_path)
-    elif get_ext(tmp_path) == "dat":
-        new_entry = nanonis.convert_dat(tmp_path)
-    elif get_ext(tmp_path) == "sxm":
-        new_entry = nanonis.convert_sxm(tmp_path)
+
+def del_tmpfile(tmp_path: str):
+    # Files that need their neighbours share one directory with the rest of their upload, which deletes it once the
+    # whole upload is done (see iter_files_to_datastore)
+    if formats.needs_neighbours(tmp_path):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
     else:
-        raise ValueError("File Format Not Supported!")
-    #N.B for matrix, will need a _mtrx index file in directory. Skip it
+        shutil.rmtree(os.path.dirname(tmp_path), ignore_errors=True)
+
+
+def make_empty_data_store():
+    return []
+
 
-    return old_datastore + [new_entry]
+@timed
+def convert_file(tmp_path: str, lazy=False):
+    # Each format's reader is only imported the first time one of its files is converted
+    return formats.convert(tmp_path, lazy=lazy)
+
+
+def try_convert_file(tmp_path: str):
+    # Runs in the worker processes, so one bad file hands back its error instead of killing the batch
+    try:
+        return convert_file(tmp_path), None
+    except Exception as e:
+        return None, f"{os.path.basename(tmp_path)}: {e}"
+    finally:
+        del_tmpfile(tmp_path)
+
+
+def try_convert_file_in_place(tmp_path: str):
+    # For files that need the others in their directory, which is cleared up once the whole upload is done
+    try:
+        return convert_file(tmp_path), None
+    except Exception as e:
+        return None, f"{os.path.basename(tmp_path)}: {e}"
+
+
+def try_convert_file_lazy(tmp_path: str):
+    # Memory-mapped, so must be done in this process. The file is only deleted once the dataset is evicted
+    try:
+        return convert_file(tmp_path, lazy=True), None
+    except Exception as e:
+        del_tmpfile(tmp_path)
+        return None, f"{os.path.basename(tmp_path)}: {e}"
+
+
+def get_ingest_executor():
+    global _ingest_executor
+    if _ingest_executor is None:
+        _ingest_executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+    return _ingest_executor
+
+
+def get_cache_key(filename: str, content_hash: str):
+    # Also the id of the dataset once registered (see register_dataset)
+    return f"{content_hash}.{get_ext(filename)}"
+
+
+def is_cache_key(key):
+    # As made by get_cache_key. Extensions can be e.g. "I(V)_mtrx", or anything for files recognised by their first bytes
+    content_hash, _, ext = str(key).partition(".")
+    if re.fullmatch("[0-9a-f]{64}", content_hash) is None or any(char in ext for char in "/\\\0"):
+        return False  # From the browser, so never anything that could reach outside the cache
+    return formats.is_supported(f".{ext}") or re.fullmatch(r"\w+", ext) is not None
+
+
+def load_cached_entry(filename: str, content_hash: str, count=True, session_id=None):
+    # session_id takes a reference on the entry, so it stays cached for as long as that session is using it
+    load = conversion_cache.get if count else conversion_cache.load
+    cache_key = get_cache_key(filename, content_hash)
+    cached_entry = load(cache_key)
+    if cached_entry is not None and session_id is not None and not conversion_cache.acquire(cache_key, session_id):
+        cached_entry = None  # Evicted in the meantime
+    if cached_entry is not None:
+        # Same bytes may have been uploaded under another name
+        cached_entry["experiment_metadata"]["experiment_name"] = os.path.basename(filename)
+        cached_entry["cache_key"] = cache_key  # So anything derived from it can be cached alongside
+    return cached_entry
+
+
+def register_dataset(entry, on_evict=None):
+    # Cached entries are registered under their cache key, so the same file uploaded by several sessions is only held
+    # once, and any worker process can load it back from the cache if it doesn't have it (see get_dataset)
+    entry.setdefault("derived", {})  # Shared by every view of the entry (see resolve_datastore)
+    entry.setdefault("derived_locks", {})
+    dataset_id = dataset_registry.add(entry, on_evict=on_evict, dataset_id=entry.get("cache_key"))
+    entry["dataset_id"] = dataset_id  # So anything caching per dataset can key on it
+    return dataset_id
+
+
+def get_dataset(dataset_id: str):
+    try:
+        return dataset_registry.get(dataset_id)
+    except KeyError:
+        # Evicted here, or registered by another worker process. Nothing is lost if it was cached
+        if re.fullmatch(PREVIEW_ID_PATTERN, str(dataset_id)):
+            return load_preview(dataset_id)
+        if not is_cache_key(dataset_id):
+            raise  # Not a cache key, and as it's from the browser it's never trusted as a path
+        cached_entry = conversion_cache.load(dataset_id)
+        if cached_entry is None:
+            raise
+        cached_entry["cache_key"] = dataset_id
+        register_dataset(cached_entry)
+        return dataset_registry.get(dataset_id)
+
+
+def get_previews_dir():
+    # Next to the conversion cache like the upload jobs, so a preview made by one worker process can be shown by any
+    previews_dir = os.path.join(conversion_cache.cache_dir, ".previews")
+    os.makedirs(previews_dir, exist_ok=True)
+    return previews_dir
+
+
+def get_preview_path(preview_id: str):
+    if not re.fullmatch(PREVIEW_ID_PATTERN, str(preview_id)):
+        raise KeyError(f"{preview_id} is not a preview")
+    return os.path.join(get_previews_dir(), preview_id)
+
+
+def load_preview(preview_id: str):
+    # Scanned again from the header saved by add_previews
+    try:
+        with open(get_preview_path(preview_id), "rb") as f:
+            entry = formats.scan(f.read(), preview_id)
+    except (OSError, ValueError):
+        entry = None
+    if entry is None:
+        raise KeyError(f"Preview {preview_id} has gone")
+    entry["dataset_id"] = dataset_registry.add(entry, dataset_id=preview_id)
+    return dataset_registry.get(preview_id)
+
+
+def prune_previews():
+    previews_dir = get_previews_dir()
+    for fname in os.listdir(previews_dir):
+        try:
+            if time.time() - os.path.getmtime(os.path.join(previews_dir, fname)) > PREVIEW_TTL_S:
+                os.remove(os.path.join(previews_dir, fname))
+        except OSError:
+            continue
+
+
+@timed
+def add_previews(list_of_contents, list_of_names):
+    # (upload index, store entry) for every file whose header says enough to show it before it's converted: its
+    # channels for the dropdowns and, for spectra, where they were taken. Their signals are None until the real
+    # dataset replaces them
+    prune_previews()
+    previews = []
+    for i, (contents, fname) in enumerate(zip(list_of_contents, list_of_names)):
+        head = read_upload_head(contents)
+        try:
+            entry = formats.scan(head, fname)
+        except Exception:
+            continue  # Left to the conversion to report
+        if entry is None:
+            continue
+
+        preview_id = f"preview-{uuid.uuid4().hex}.{get_ext(fname)}"
+        preview_path = get_preview_path(preview_id)
+        with open(f"{preview_path}.tmp", "wb") as f:
+            f.write(head)
+        os.replace(f"{preview_path}.tmp", preview_path)
+
+        entry["experiment_metadata"]["experiment_name"] = os.path.basename(fname)
+        entry["dataset_id"] = dataset_registry.add(entry, dataset_id=preview_id)
+        previews.append((i, make_store_entry(preview_id, entry)))
+
+    return previews
+
+
+def release_session(session_id: str):
+    # Lets go of everything a session uploaded, which can then be evicted once no other session is using it
+    conversion_cache.release_holder(session_id)
+
+
+@timed
+def register_entry(new_entry, tmp_path: str, content_hash: str, session_id=None):
+    # Swap fresh conversions for their memory-mapped cached copy, so the upload itself is no longer needed
+    conversion_cache.put(get_cache_key(tmp_path, content_hash), new_entry, holder=session_id)
+    cached_entry = load_cached_entry(tmp_path, content_hash, count=False)
+
+    if cached_entry is not None:
+        new_entry, on_evict = cached_entry, None
+        del_tmpfile(tmp_path)
+    elif formats.is_lazy(tmp_path):
+        on_evict = partial(del_tmpfile, tmp_path)
+    else:
+        on_evict = None
+
+    return make_store_entry(register_dataset(new_entry, on_evict=on_evict), new_entry)
+
+
+def add_file_to_datastore(data, filename: str, old_datastore, session_id=None):
+    old_datastore, errors = add_files_to_datastore([data], [filename], old_datastore, parallel=False,
+                                                   session_id=session_id)
+    if errors:
+        raise ValueError(errors[0])
+
+    return old_datastore
+
+
+@timed
+def add_files_to_datastore(list_of_contents, list_of_names, old_datastore, parallel=True, executor=None,
+                           session_id=None):
+    # Everything at once, appended in the order the files were dropped
+    results = sorted(iter_files_to_datastore(list_of_contents, list_of_names, parallel, executor,
+                                             session_id=session_id), key=lambda result: result[0])
+    old_datastore += [store_entry for _, store_entry, error in results if error is None]
+    return old_datastore, [error for _, _, error in results if error is not None]
+
+
+def iter_files_to_datastore(list_of_contents, list_of_names, parallel=True, executor=None, is_cancelled=None,
+                            session_id=None):
+    # (upload index, store entry, error) for each file as soon as it's ready, so whatever finishes first can be shown
+    # first. Stops early once is_cancelled() is true, cleaning up after anything it hadn't got to. Every file ends up
+    # held by session_id in the shared pool (see ConversionCache)
+    is_cancelled = is_cancelled or (lambda: False)
+
+    # Some files (e.g. Matrix data files) are only readable next to their companions, so they all share a directory
+    shared_dir = tempfile.mkdtemp(prefix="spectra-upload-") if any(
+        formats.needs_neighbours(fname) for fname in list_of_names) else None
+
+    uploads, pending, futures, local_executor = [], {}, {}, None
+    try:
+        # Anything uploaded before skips decoding and conversion entirely
+        for i, (contents, fname) in enumerate(zip(list_of_contents, list_of_names)):
+            if is_cancelled():
+                return
+            if formats.is_companion_file(fname):
+                if shared_dir is not None:
+                    make_tmpfile(contents, fname, shared_dir)
+                continue
+
+            content_hash = get_content_hash(contents)
+            cached_entry = load_cached_entry(fname, content_hash, session_id=session_id)
+            if cached_entry is not None:
+                yield i, make_store_entry(register_dataset(cached_entry), cached_entry), None
+                continue
+
+            tmp_path = make_tmpfile(contents, fname, shared_dir if formats.needs_neighbours(fname) else None)
+            uploads.append((i, tmp_path))
+            pending[tmp_path] = (i, content_hash)
+
+        eager_paths = [tmp_path for _, tmp_path in uploads
+                       if not formats.is_lazy(tmp_path) and not formats.needs_neighbours(tmp_path)]
+        use_pool = parallel and len(eager_paths) > 1
+
+        # Eager conversions go to the pool first, so they run while the lazy/shared ones, which have to stay in this
+        # process, are done one at a time on a thread of their own. Whichever finishes first is handed back first
+        if use_pool:
+            executor = get_ingest_executor() if executor is None else executor
+            futures.update({executor.submit(try_convert_file, tmp_path): tmp_path for tmp_path in eager_paths})
+        local_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-convert")
+        for _, tmp_path in uploads:
+            if formats.is_lazy(tmp_path):
+                futures[local_executor.submit(try_convert_file_lazy, tmp_path)] = tmp_path
+            elif formats.needs_neighbours(tmp_path):
+                futures[local_executor.submit(try_convert_file_in_place, tmp_path)] = tmp_path
+            elif not use_pool:
+                futures[local_executor.submit(try_convert_file, tmp_path)] = tmp_path
+
+        # Woken up now and then even with nothing finished, so a cancel is seen mid-file
+        remaining = set(futures)
+        while remaining:
+            finished, remaining = wait(remaining, timeout=CANCEL_CHECK_S, return_when=FIRST_COMPLETED)
+            for future in sorted(finished, key=lambda future: pending[futures[future]][0]):
+                if is_cancelled():
+                    return
+                tmp_path = futures[future]
+                yield finish_upload(tmp_path, *pending.pop(tmp_path), *future.result(), session_id)
+            if is_cancelled():
+                return
+    finally:
+        # Files not got to are deleted here, anything already being converted once it's done
+        for tmp_path in pending:
+            future = next((future for future, path in futures.items() if path == tmp_path), None)
+            if future is None or future.cancel():
+                del_tmpfile(tmp_path)
+            else:
+                future.add_done_callback(partial(discard_conversion, tmp_path))
+        if local_executor is not None:
+            local_executor.shutdown(wait=False)
+        if shared_dir is not None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def discard_conversion(tmp_path: str, _):
+    # A file converted after its upload was cancelled. Lazy ones still have their upload to delete
+    del_tmpfile(tmp_path)
+
+
+def finish_upload(tmp_path: str, i: int, content_hash: str, new_entry, error, session_id=None):
+    if error is not None:
+        return i, None, error
+    return i, register_entry(new_entry, tmp_path, content_hash, session_id), None
+
+
+def make_store_entry(dataset_id, entry):
+    # Only the small metadata goes to the browser, signals stay in the registry
+    signal_metadata = {key: val for key, val in entry["signal_metadata"].items()
+                       if key not in ("pos_xy", "spatial_index")}
+    return {"dataset_id": dataset_id,
+            "experiment_metadata": dict(entry["experiment_metadata"]),
+            "signal_metadata": signal_metadata}
+
+
+@timed
+def resolve_datastore(datastore):
+    # Datasets are shared between sessions, so each gets a view with its own file names (the same file can be
+    # uploaded under different names) and its own spectral maps. Everything else, signals and derived channels
+    # included, is the shared copy
+    datasets = []
+    for store_entry in datastore:
+        try:
+            dataset = get_dataset(store_entry["dataset_id"])
+        except KeyError:
+            # Gone from this process and the cache both, so only uploading it again brings it back
+            raise KeyError(f"{store_entry['experiment_metadata']['experiment_name']} is no longer loaded, "
+                           f"please re-upload it")
+        view = dict(dataset, experiment_metadata=store_entry["experiment_metadata"])
+        datasets.append(add_maps_to_view(view, store_entry["maps"]) if store_entry.get("maps") else view)
+    return datasets
 
 
 def load_img(filename: str):
+    import nanonispy as napy
     return napy.read.Scan(filename)
 
 
 def load_grid(filename: str):
+    import nanonispy as napy
     return napy.read.Grid(filename)
 
 
-def sxm2pil(img: np.ndarray, min_cutoff=None, max_cutoff=None, cmap=nanomap):
+def sxm2pil(img: np.ndarray, min_cutoff=None, max_cutoff=None, cmap=None):
+    from PIL import Image
+    if cmap is None:
+        from nOmicron.utils.plotting import nanomap as cmap
+
     img = img.copy()
 
     if min_cutoff is None:
@@ -69,7 +435,124 @@ def sxm2pil(img: np.ndarray, min_cutoff=None, max_cutoff=None, cmap=nanomap):
     return pillow_img
 
 
-def sxm2dict(sxm: napy.read.Scan):
+@timed
+def render_image(img: np.ndarray, min_cutoff, max_cutoff, key):
+    # Colourmapped PNG of an image as a data URI. key should identify the dataset, channel, cutoffs and the
+    # resolution/crop of img, so flicking back to a channel already seen costs nothing
+    with _rendered_images_lock:
+        if key in _rendered_images:
+            _rendered_images.move_to_end(key)
+            return _rendered_images[key]
+
+    png = io.BytesIO()
+    sxm2pil(img, min_cutoff, max_cutoff).save(png, format="PNG", compress_level=1)
+    uri = "data:image/png;base64," + base64.b64encode(png.getvalue()).decode("ascii")
+
+    with _rendered_images_lock:
+        _rendered_images[key] = uri
+        while len(_rendered_images) > RENDERED_IMAGE_CACHE_SIZE:
+            _rendered_images.popitem(last=False)
+
+    return uri
+
+
+def get_derived_lock(entry, key):
+    # One per derived channel or map of each dataset, so a large grid being worked out only holds up whoever is after
+    # that same channel, not every other session
+    with _derived_lock:
+        return entry.setdefault("derived_locks", {}).setdefault(key, threading.Lock())
+
+
+@timed
+def get_derived_channel(entry, x_channel: str, y_channel: str, tab: str, smoothing=None):
+    # Derivative/integral of every spectrum of a channel, worked out the first time it is asked for and kept, so
+    # switching tabs afterwards is only a lookup. Saved next to the entry in the conversion cache when it came from
+    # there, so it's memory-mapped and outlives the process like the rest of the entry
+    derived_key = (x_channel, y_channel, tab, smoothing)
+    derived_channels = entry.setdefault("derived", {})
+    if derived_key in derived_channels:
+        return derived_channels[derived_key]
+
+    with get_derived_lock(entry, derived_key):
+        if derived_key in derived_channels:  # Worked out while waiting for the lock
+            return derived_channels[derived_key]
+
+        xdata = np.asarray(entry["signals"]["spectra_x"][x_channel])
+        ydata = np.asarray(entry["signals"]["spectra_y"][y_channel]).reshape(-1, len(xdata))
+        derived_channel = None
+        if entry.get("cache_key") is not None:
+            array_name = f"derived-{hashlib.sha1(repr(derived_key).encode()).hexdigest()}.npy"
+            derived_channel = conversion_cache.load_array(entry["cache_key"], array_name)
+            if derived_channel is None:
+                derived_channel = conversion_cache.put_array(
+                    entry["cache_key"], array_name, ydata.shape,
+                    partial(derived.derive_chunked, xdata, ydata, tab, smoothing))
+        if derived_channel is None:
+            derived_channel = derived.derive_chunked(xdata, ydata, tab, smoothing)
+
+        derived_channels[derived_key] = derived_channel
+        return derived_channel
+
+
+@timed
+def get_spectral_map(entry, x_channel: str, y_channel: str, kind: str, window, smoothing=None):
+    # (name, map, pyramid) of a per-point reduction of a grid's spectra (see dataloader.maps), None if the entry has no
+    # image to show it in. Kept with the derived channels, in the conversion cache too, so the same map of the same
+    # file is only ever worked out once and any worker process can load it back
+    signal_metadata = entry["signal_metadata"]
+    if signal_metadata["img_channels"] is None or x_channel not in (entry["signals"]["spectra_x"] or {}) or \
+            y_channel not in (entry["signals"]["spectra_y"] or {}):
+        return None  # Only grids have an image to put a map in
+
+    map_name = maps.get_map_name(y_channel, kind, window, smoothing)
+    map_key = ("map", x_channel, map_name)
+    derived_channels = entry.setdefault("derived", {})
+    if map_key in derived_channels:
+        return (map_name, *derived_channels[map_key])
+
+    with get_derived_lock(entry, map_key):
+        if map_key not in derived_channels:
+            xdata = np.asarray(entry["signals"]["spectra_x"][x_channel])
+            ydata = np.asarray(entry["signals"]["spectra_y"][y_channel]).reshape(-1, len(xdata))
+            spectral_map = None
+            if entry.get("cache_key") is not None:
+                array_name = f"map-{hashlib.sha1(repr((x_channel, map_name)).encode()).hexdigest()}.npy"
+                spectral_map = conversion_cache.load_array(entry["cache_key"], array_name)
+                if spectral_map is None:
+                    spectral_map = conversion_cache.put_array(
+                        entry["cache_key"], array_name, (ydata.shape[0],),
+                        partial(maps.compute_map, xdata, ydata, kind, window, smoothing))
+            if spectral_map is None:
+                spectral_map = maps.compute_map(xdata, ydata, kind, window, smoothing)
+
+            derived_channels[map_key] = (spectral_map,
+                                         build_pyramid(spectral_map.reshape(signal_metadata["image_points_res"][::-1])))
+
+    return (map_name, *derived_channels[map_key])
+
+
+def add_maps_to_view(view, map_specs):
+    # The maps a session has made (kept in its store entries, see app.add_spectral_maps) are only added to its own view
+    # of the dataset, never to the shared copy, so other sessions with the same file don't see them
+    signals = dict(view["signals"], img=dict(view["signals"]["img"] or {}),
+                   img_pyramid=dict(view["signals"]["img_pyramid"] or {}))
+    signal_metadata = dict(view["signal_metadata"], img_channels=list(view["signal_metadata"]["img_channels"] or []))
+    for map_spec in map_specs:
+        try:
+            spectral_map = get_spectral_map(view, **map_spec)
+        except (KeyError, TypeError, ValueError):
+            continue  # From the browser, so one that can't be made is left out rather than trusted
+        if spectral_map is None:
+            continue
+
+        map_name, signals["img"][map_name], signals["img_pyramid"][map_name] = spectral_map
+        if map_name not in signal_metadata["img_channels"]:
+            signal_metadata["img_channels"].append(map_name)
+
+    return dict(view, signals=signals, signal_metadata=signal_metadata)
+
+
+def sxm2dict(sxm: "napy.read.Scan"):
     flat_dict = {}
     for outterdict, outterval in sxm.signals.items():
         for innerdict, innerval in sxm.signals[outterdict].items():
@@ -78,7 +561,7 @@ def sxm2dict(sxm: napy.read.Scan):
     return flat_dict
 
 
-def dot3ds_2dict(grid: napy.read.Grid):
+def dot3ds_2dict(grid: "napy.read.Grid"):
     out_dict = grid.header
     out_dict["basename"] = grid.basename
     for key, val in grid.signals.items():
@@ -94,6 +577,7 @@ def dot3ds_2dict(grid: napy.read.Grid):
 
 
 def dot3ds_params2pd(dot3ds_data_dict):
+    import pandas as pd
     all_params = dot3ds_data_dict["fixed_parameters"] + dot3ds_data_dict["experimental_parameters"]
     data = np.array(dot3ds_data_dict["params"])
     df = pd.DataFrame(columns=all_params, data=data).dropna(axis=1, how="all")
@@ -0,0 +1,237 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from dataloader.locks import file_lock
+
+META_FNAME = "meta.json"
+REFS_DIR = "refs"
+LOCK_FNAME = ".lock"
+
+
+class ConversionCache:
+    """Content-addressed store of converted entries on disk, evicted least recently used past max_bytes.
+
+    Each entry is a directory named by the hash of the uploaded bytes, holding a meta.json of the entry with every
+    array swapped for a placeholder, plus one .npy per array. Arrays are loaded memory-mapped, so a hit costs next
+    to nothing however large the file was.
+
+    It doubles as the pool of datasets shared between sessions: the same bytes are only ever stored once, and each
+    session using an entry holds a reference to it (a file under refs/), which keeps it from being evicted until the
+    session lets go or the reference goes stale after ref_ttl seconds. Several processes can share cache_dir, with
+    adding references and evicting done under a file lock.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, ref_ttl=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ref_ttl = ref_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _file_lock(self):
+        return file_lock(os.path.join(self.cache_dir, LOCK_FNAME))
+
+    def get(self, key):
+        entry = self.load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return entry
+
+    def load(self, key):
+        # As get, but without touching the hit/miss counters
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, META_FNAME)) as f:
+                meta = json.load(f)
+            entry = _restore_arrays(meta, entry_dir)
+            os.utime(os.path.join(entry_dir, META_FNAME))  # Mark as recently used
+        except (OSError, ValueError):
+            return None
+
+        return entry
+
+    def put(self, key, entry, holder=None):
+        # holder (a session id) gets a reference to the entry, whether it was just written or already there
+        if os.path.exists(self._entry_dir(key)):
+            if holder is not None:
+                self.acquire(key, holder)
+            return
+
+        # Written to a scratch directory and renamed, so readers never see a half written entry
+        scratch_dir = tempfile.mkdtemp(prefix=f".{key}-", dir=self.cache_dir)
+        try:
+            meta = _extract_arrays(entry, scratch_dir, {})
+            with open(os.path.join(scratch_dir, META_FNAME), "w") as f:
+                json.dump(meta, f, default=_json_default)
+            with self._file_lock():  # Referenced as it appears, so it can't be evicted before its holder gets to it
+                os.rename(scratch_dir, self._entry_dir(key))
+                if holder is not None:
+                    self._add_ref(key, holder)
+        except (OSError, TypeError):
+            shutil.rmtree(scratch_dir, ignore_errors=True)  # Most likely lost a race with another writer
+            if holder is not None:
+                self.acquire(key, holder)
+            return
+
+        self.evict()
+
+    def _ref_path(self, key, holder):
+        if not re.fullmatch(r"[\w-]+", holder):
+            raise ValueError(f"{holder} can't hold a cache entry")  # Usually from the browser, so never a path
+        return os.path.join(self._entry_dir(key), REFS_DIR, holder)
+
+    def _add_ref(self, key, holder):
+        ref_path = self._ref_path(key, holder)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        with open(ref_path, "w"):
+            pass  # (Re)written, so its mtime says when it was last taken
+
+    def acquire(self, key, holder):
+        # True if the entry is there and now held by holder
+        with self._file_lock():
+            if not os.path.isdir(self._entry_dir(key)):
+                return False
+            try:
+                self._add_ref(key, holder)
+            except OSError:
+                return False
+        return True
+
+    def release(self, key, holder):
+        try:
+            os.remove(self._ref_path(key, holder))
+        except OSError:
+            pass
+
+    def release_holder(self, holder):
+        # Lets go of everything holder has a reference to
+        for key in os.listdir(self.cache_dir):
+            if not key.startswith("."):
+                self.release(key, holder)
+
+    def get_holders(self, key):
+        refs_dir = os.path.join(self._entry_dir(key), REFS_DIR)
+        return sorted(os.listdir(refs_dir)) if os.path.isdir(refs_dir) else []
+
+    def _is_held(self, entry_dir):
+        # Clears out references older than ref_ttl on the way, so sessions that were never closed don't pin forever
+        refs_dir = os.path.join(entry_dir, REFS_DIR)
+        if not os.path.isdir(refs_dir):
+            return False
+        held = False
+        for holder in os.listdir(refs_dir):
+            ref_path = os.path.join(refs_dir, holder)
+            try:
+                if time.time() - os.path.getmtime(ref_path) < self.ref_ttl:
+                    held = True
+                else:
+                    os.remove(ref_path)
+            except OSError:
+                continue
+        return held
+
+    def load_array(self, key, name):
+        # Extra arrays kept alongside an entry (e.g. derived channels), None if not written yet or evicted
+        try:
+            return np.load(os.path.join(self._entry_dir(key), name), mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def put_array(self, key, name, shape, fill):
+        # fill(out) writes into a memory-mapped scratch file, so arrays bigger than memory can be built a chunk at a
+        # time. Renamed into place once complete, as with put
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return None
+
+        fd, scratch_path = tempfile.mkstemp(prefix=f".{name}-", suffix=".npy", dir=entry_dir)
+        os.close(fd)
+        try:
+            out = np.lib.format.open_memmap(scratch_path, mode="w+", dtype=float, shape=shape)
+            fill(out)
+            out.flush()
+            del out
+            os.rename(scratch_path, os.path.join(entry_dir, name))
+        except OSError:
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+            return None
+
+        self.evict()
+        return self.load_array(key, name)
+
+    def evict(self):
+        # Least recently used first, skipping anything a session still holds
+        with self._file_lock():
+            entries = []
+            for key in os.listdir(self.cache_dir):
+                entry_dir = self._entry_dir(key)
+                if key.startswith(".") or not os.path.isdir(entry_dir):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_dir, fname)) for fname in os.listdir(entry_dir)
+                               if fname != REFS_DIR)
+                    entries.append((os.path.getmtime(os.path.join(entry_dir, META_FNAME)), size, entry_dir))
+                except OSError:
+                    continue  # Being written by someone else
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if self._is_held(entry_dir):
+                    continue
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total_bytes -= size
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def _extract_arrays(obj, entry_dir, written):
+    if isinstance(obj, np.ndarray):
+        # Entries can hold the same array twice (e.g. .dat spectra_x and spectra_y), only write it once
+        if id(obj) not in written:
+            written[id(obj)] = f"{len(written)}.npy"
+            np.save(os.path.join(entry_dir, written[id(obj)]), obj, allow_pickle=False)
+        return {"__array__": written[id(obj)]}
+    elif isinstance(obj, dict):
+        return {key: _extract_arrays(val, entry_dir, written) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_extract_arrays(val, entry_dir, written) for val in obj]
+    else:
+        return obj
+
+
+def _restore_arrays(obj, entry_dir):
+    if isinstance(obj, dict):
+        if "__array__" in obj:
+            return np.load(os.path.join(entry_dir, obj["__array__"]), mmap_mode="r", allow_pickle=False)
+        return {key: _restore_arrays(val, entry_dir) for key, val in obj.items()}
+    elif isinstance(obj, list):
+        return [_restore_arrays(val, entry_dir) for val in obj]
+    else:
+        return obj
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} can't be cached")
@@ -1,4 +1,6 @@
-from collections import defaultdict
+import numpy as np
+
+from dataloader.spatial import build_spatial_index
 
 ALLOWED_HEADER_KEYS = {"data_type": "experiment_metadata",
                        "filetype": "experiment_metadata",
@@ -14,19 +16,44 @@ ALLOWED_HEADER_KEYS = {"data_type": "experiment_metadata",
                        "spectra_x_channels": "signal_metadata",
                        "spectra_y_channels": "signal_metadata",
                        "img_channels": "signal_metadata",
+                       "array_info": "signal_metadata",
+                       "spatial_index": "signal_metadata",
 
                        "spectra_x": "signals",
                        "spectra_y": "signals",
-                       "img": "signals"}
+                       "img": "signals",
+                       "img_pyramid": "signals"}
 
 
 def convert_to_common(mapping):
-    new_entry = defaultdict(lambda: defaultdict(list))
+    # Plain dicts rather than defaultdicts so entries can be pickled back from worker processes
+    new_entry = {}
     for needed_header, needed_section in ALLOWED_HEADER_KEYS.items():
-        new_entry[needed_section][needed_header] = None
+        new_entry.setdefault(needed_section, {})[needed_header] = None
 
     for item_name, value in mapping.items():
         assert item_name in ALLOWED_HEADER_KEYS.keys()
         new_entry[ALLOWED_HEADER_KEYS[item_name]][item_name] = value
 
+    new_entry["signal_metadata"]["array_info"] = get_array_info(new_entry["signals"])
+    if new_entry["experiment_metadata"]["data_type"] == "spectra" and new_entry["signal_metadata"]["pos_xy"] is not None:
+        new_entry["signal_metadata"]["spatial_index"] = build_spatial_index(new_entry["signal_metadata"]["pos_xy"])
+
     return new_entry
+
+
+def get_array_info(signals):
+    # Record shapes/dtypes so the arrays can be rebuilt from a flat buffer on the other side of any boundary
+    array_info = {}
+    for signal_type, channels in signals.items():
+        if channels is None:
+            continue
+        array_info[signal_type] = {channel: _get_array_info(val) for channel, val in channels.items()}
+
+    return array_info
+
+
+def _get_array_info(val):
+    if isinstance(val, list):  # e.g. the levels of an image pyramid
+        return [_get_array_info(level) for level in val]
+    return {"shape": list(np.shape(val)), "dtype": np.asarray(val).dtype.str}
@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+DERIVED_TABS = ["diff", "double-diff", "integrate"]
+SMOOTHING_OPTIONS = {"none": "None",
+                     "savgol:7": "Savitzky-Golay (7 pt)",
+                     "savgol:15": "Savitzky-Golay (15 pt)",
+                     "gaussian:2": "Gaussian (σ = 2 pt)",
+                     "gaussian:5": "Gaussian (σ = 5 pt)"}
+DERIVED_CHUNK_POINTS = 4096  # Spectra derived at a time, so memory-mapped grids are never read in whole
+
+
+def parse_smoothing(smoothing):
+    if smoothing is None or smoothing == "none":
+        return None, None
+    method, width = smoothing.split(":")
+    return method, float(width)
+
+
+def savgol_coeffs(window, polyorder, deriv):
+    # Least squares polynomial fit over the window, as a filter giving the deriv-th derivative at its centre (in
+    # units of samples)
+    half = int(window) // 2
+    offsets = np.arange(-half, half + 1)
+    vander = offsets[:, None] ** np.arange(polyorder + 1)
+    return np.linalg.pinv(vander)[deriv] * math.factorial(deriv)
+
+
+def gaussian_coeffs(sigma, deriv):
+    half = int(np.ceil(4 * sigma))
+    offsets = np.arange(-half, half + 1)
+    kernel = np.exp(-offsets ** 2 / (2 * sigma ** 2))
+    kernel /= kernel.sum()
+    # Correlating with the kernel's derivatives, flipped, gives the derivatives of the smoothed signal
+    # (rescaled so they are exact on lines and parabolas, which truncating the kernel otherwise throws off)
+    if deriv == 1:
+        kernel = offsets * kernel
+        kernel /= np.sum(offsets * kernel)
+    elif deriv == 2:
+        kernel = (offsets ** 2 / sigma ** 2 - 1) * kernel
+        kernel -= kernel.sum() / len(kernel)
+        kernel *= 2 / np.sum(offsets ** 2 * kernel)
+    return kernel
+
+
+def apply_filter(block, coeffs):
+    # Correlate every row with coeffs, with the ends padded by repeating the edge value so the length is kept
+    half = len(coeffs) // 2
+    padded = np.pad(block, ((0, 0), (half, half)), mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, len(coeffs), axis=-1)
+    return windows @ coeffs
+
+
+def derive(xdata, block, tab, smoothing=None):
+    # Derived spectra for a (n points, n sweep) block. Always on the same x as the input, so no realignment needed
+    xdata = np.asarray(xdata, dtype=float)
+    block = np.asarray(block, dtype=float)
+    method, width = parse_smoothing(smoothing)
+
+    if tab == "integrate":
+        steps = (block[:, 1:] + block[:, :-1]) / 2 * np.diff(xdata)
+        return np.hstack([np.zeros((block.shape[0], 1)), np.cumsum(steps, axis=-1)])
+
+    deriv = {"diff": 1, "double-diff": 2}[tab]
+    if method is None or block.shape[1] < 5:
+        derived = block
+        for _ in range(deriv):
+            derived = np.gradient(derived, xdata, axis=-1)
+        return derived
+
+    # Smoothed filters work in samples, so are scaled by the mean step. Sweeps are evenly spaced in practice
+    step = np.mean(np.diff(xdata)) if len(xdata) > 1 else 1.0
+    if method == "savgol":
+        window = min(int(width) // 2 * 2 + 1, (block.shape[1] - 1) // 2 * 2 + 1)
+        coeffs = savgol_coeffs(window, min(3, window - 1), deriv)
+    elif method == "gaussian":
+        coeffs = gaussian_coeffs(width, deriv)
+    else:
+        raise ValueError(f"Unknown smoothing {smoothing}")
+
+    return apply_filter(block, coeffs) / step ** deriv
+
+
+def derive_chunked(xdata, ydata, tab, smoothing=None, out=None):
+    # As derive, over every spectrum of a (possibly memory-mapped) grid a chunk at a time, written into out
+    out = np.empty(ydata.shape) if out is None else out
+    for start in range(0, ydata.shape[0], DERIVED_CHUNK_POINTS):
+        out[start:start + DERIVED_CHUNK_POINTS] = derive(xdata, ydata[start:start + DERIVED_CHUNK_POINTS], tab,
+                                                         smoothing)
+    return out
@@ -1,17 +1,59 @@
+import os
+
 import numpy as np
 from flatten_dict import flatten
-from nanonispy.read import Grid, Spec, Scan
+from nanonispy.read import Grid, Spec, Scan, _parse_3ds_header, _parse_dat_header, _parse_sxm_header, nanonis_end_tags
 
 import utils
 from dataloader.convert import convert_to_common
+from dataloader.pyramid import build_pyramids
+from instrumentation import timed
 
 IMAGE_FILE_FORMATS = ["sxm"]
 SPECTRA_FILE_FORMATS = ["dat", "3ds"]
 ALL_FORMATS = [IMAGE_FILE_FORMATS + SPECTRA_FILE_FORMATS]
 
 
-def convert_3ds(fname):
-    data = Grid(fname)
+def read_header(head, filetype):
+    # Header text from the first bytes of a file, up to and including the line with its end tag, as nanonispy's
+    # read_raw_header would give. Also returns where the header ends
+    tag_start = head.find(nanonis_end_tags[filetype].encode())
+    header_end = head.find(b"\n", tag_start) + 1
+    if tag_start < 0 or header_end == 0:
+        raise ValueError(f"No end of header in the first {len(head)} bytes")
+    return head[:header_end].decode("utf-8", errors="replace"), header_end
+
+
+class MemmapGrid(Grid):
+    # Same header parsing as nanonispy's Grid, but the body is memory-mapped rather than read in. Channels are
+    # then just views onto the file, so only the pages for the spectra actually plotted are ever read
+
+    def _load_data(self):
+        nx, ny = self.header['dim_px']
+        num_sweep = self.header['num_sweep_signal']
+        num_param = self.header['num_parameters']
+        exp_size_per_pix = num_param + num_sweep * self.header['num_channels']
+
+        # Incomplete grids need nanonispy's zero padding, which needs the whole thing in memory
+        expected_bytes = nx * ny * exp_size_per_pix * np.dtype(self.data_format).itemsize
+        if os.path.getsize(self.fname) - self.byte_offset < expected_bytes:
+            return super()._load_data()
+
+        griddata = np.memmap(self.fname, dtype=self.data_format, mode="r", offset=self.byte_offset,
+                             shape=(ny, nx, exp_size_per_pix))
+
+        data_dict = {"params": np.array(griddata[:, :, :num_param])}  # Small, and needed for every image
+        for i, chann in enumerate(self.header['channels']):
+            data_dict[chann] = griddata[:, :, num_param + i * num_sweep:num_param + (i + 1) * num_sweep]
+
+        return data_dict
+
+
+@timed
+def convert_3ds(fname, lazy=False):
+    data = MemmapGrid(fname) if lazy else Grid(fname)
+    x_idx = len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index("X (m)")
+    y_idx = len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index("Y (m)")
 
     mapping = {"data_type": "spectra",
                "experiment_name": data.basename,
@@ -20,44 +62,29 @@ def convert_3ds(fname):
                "time_end": data.header["end_time"],
                "comment": data.header["comment"],
 
-               "pos_xy": (data.signals["params"][...,
-                          (len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index("X (m)"))
-                          :(len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index(
-                              "Y (m)") + 1)].tolist()),
-               "size_xy": [
-                   np.max(data.signals["params"][..., (
-                           len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index(
-                       "X (m)"))]) -
-                   np.min(data.signals["params"][..., (
-                           len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index(
-                       "X (m)"))])
-                   ,
-                   np.max(data.signals["params"][..., (
-                           len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index(
-                       "Y (m)"))]) -
-                   np.min(data.signals["params"][..., (
-                           len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index(
-                       "Y (m)"))])
-
-               ],   # Normal width/height isn't right :(
+               "pos_xy": data.signals["params"][..., [x_idx, y_idx]],
+               "size_xy": [float(np.ptp(data.signals["params"][..., x_idx])),
+                           float(np.ptp(data.signals["params"][..., y_idx]))],  # Normal width/height isn't right :(
                "image_points_res": list(data.header["dim_px"]),
                "spectra_res": data.header["num_sweep_signal"],
                "spectra_x_channels": utils.ensure_list(data.header["sweep_signal"]),
                "spectra_y_channels": utils.ensure_list(data.header["channels"]),
                "img_channels": ["topo"] + data.header["fixed_parameters"] + data.header["experimental_parameters"],
-               "spectra_x": {data.header["sweep_signal"]: data.signals["sweep_signal"].tolist()},
-               "spectra_y": {channel: data.signals[channel].tolist() for channel in data.header["channels"]},
-               "img": {"topo": data.signals["topo"].ravel().tolist(),
-                       **{channel: data.signals["params"][..., i].ravel().tolist() for i, channel in enumerate(
+               "spectra_x": {data.header["sweep_signal"]: data.signals["sweep_signal"]},
+               "spectra_y": {channel: data.signals[channel] for channel in data.header["channels"]},
+               "img": {"topo": data.signals["topo"].ravel(),
+                       **{channel: data.signals["params"][..., i].ravel() for i, channel in enumerate(
                            data.header["fixed_parameters"] + data.header["experimental_parameters"])}
                        }
                }
+    mapping["img_pyramid"] = build_pyramids(mapping["img"], mapping["image_points_res"])
 
     resource_data = convert_to_common(mapping)
 
     return resource_data
 
 
+@timed
 def convert_dat(fname):
     data = Spec(fname)
 
@@ -67,12 +94,12 @@ def convert_dat(fname):
                "time_start": data.header["Start time"],
                "time_end": data.header["Saved Date"],
 
-               "pos_xy": [data.header["X (m)"], data.header["Y (m)"]],
+               "pos_xy": np.array([data.header["X (m)"], data.header["Y (m)"]], dtype=float),
                "spectra_res": len(list(data.signals.values())[0]),
                "spectra_x_channels": list(data.signals.keys()),
                "spectra_y_channels": list(data.signals.keys()),
-               "spectra_x": {key: val.tolist() for key, val in data.signals.items()},
-               "spectra_y": {key: val.tolist() for key, val in data.signals.items()}
+               "spectra_x": dict(data.signals),
+               "spectra_y": dict(data.signals)
                }
 
     resource_data = convert_to_common(mapping)
@@ -80,6 +107,7 @@ def convert_dat(fname):
     return resource_data
 
 
+@timed
 def convert_sxm(fname):
     data = Scan(fname)
 
@@ -101,9 +129,82 @@ def convert_sxm(fname):
                "size_xy": list(data.header["scan_range"]),
                "image_points_res": list(data.header["scan_pixels"]),
                "img_channels": list(flattened_signal_dict.keys()),
-               "img": {key: val.tolist() for key, val in flattened_signal_dict.items()}
+               "img": flattened_signal_dict
                }
+    mapping["img_pyramid"] = build_pyramids(mapping["img"], mapping["image_points_res"])
 
     resource_data = convert_to_common(mapping)
 
     return resource_data
+
+
+def scan_3ds(head, fname):
+    # Preview of a grid from its header. Positions are the nominal grid from its settings rather than where each
+    # point was actually measured (those are in the body), which is plenty to show where it will be
+    header = _parse_3ds_header(read_header(head, "grid")[0], None)
+    nx, ny = header["dim_px"]
+    (x_centre, y_centre), (width, height) = header["pos_xy"], header["size_xy"]
+    angle = np.deg2rad(header["angle"])
+    yy, xx = np.meshgrid(np.linspace(-height / 2, height / 2, ny), np.linspace(-width / 2, width / 2, nx),
+                         indexing="ij")
+
+    mapping = {"data_type": "spectra",
+               "experiment_name": os.path.basename(fname),
+               "filetype": "3ds",
+               "time_start": header["start_time"],
+               "time_end": header["end_time"],
+               "comment": header["comment"],
+
+               "pos_xy": np.stack([x_centre + xx * np.cos(angle) - yy * np.sin(angle),
+                                   y_centre + xx * np.sin(angle) + yy * np.cos(angle)], axis=-1),
+               "size_xy": [width, height],
+               "image_points_res": [nx, ny],
+               "spectra_res": header["num_sweep_signal"],
+               "spectra_x_channels": utils.ensure_list(header["sweep_signal"]),
+               "spectra_y_channels": utils.ensure_list(header["channels"]),
+               "img_channels": ["topo"] + header["fixed_parameters"] + header["experimental_parameters"]
+               }
+
+    return convert_to_common(mapping)
+
+
+def scan_dat(head, fname):
+    # Column names are the line straight after the header
+    header_raw, header_end = read_header(head, "spec")
+    columns_end = head.find(b"\n", header_end)
+    if columns_end < 0:
+        raise ValueError(f"No column names in the first {len(head)} bytes")
+    header = _parse_dat_header(header_raw)
+    columns = head[header_end:columns_end].decode("utf-8", errors="replace").rstrip("\r").split("\t")
+
+    mapping = {"data_type": "spectra",
+               "experiment_name": os.path.basename(fname),
+               "filetype": "dat",
+               "time_start": header["Start time"],
+               "time_end": header["Saved Date"],
+
+               "pos_xy": np.array([header["X (m)"], header["Y (m)"]], dtype=float),
+               "spectra_x_channels": columns,
+               "spectra_y_channels": columns
+               }
+
+    return convert_to_common(mapping)
+
+
+def scan_sxm(head, fname):
+    header = _parse_sxm_header(read_header(head, "scan")[0])
+
+    mapping = {"data_type": "image",
+               "experiment_name": os.path.basename(fname),
+               "filetype": "sxm",
+               "time_start": f"{header['rec_date']} {header['rec_time']}",
+               "comment": header["comment"],
+
+               "pos_xy": list(header["scan_offset"]),
+               "size_xy": list(header["scan_range"]),
+               "image_points_res": list(header["scan_pixels"]),
+               "img_channels": [f"{channel} ({direction})" for channel in header["data_info"]["Name"]
+                                for direction in ("forward", "backward")]
+               }
+
+    return convert_to_common(mapping)
@@ -1,4 +1,199 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dataloader.convert import convert_to_common
+from dataloader.pyramid import build_pyramids
+
 IMAGE_FILE_FORMATS = ["Z_mtrx", "I_mtrx"]
 SPECTRA_FILE_FORMATS = ["I(V)_mtrx", "I(Z)_mtrx"]
 ALL_FORMATS = [IMAGE_FILE_FORMATS + SPECTRA_FILE_FORMATS]
 
+FILE_ID = b"ONTMATRX0101"
+INDEX_CACHE_SIZE = 8  # Parsed sessions kept around, each is shared by every data file of that session
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def is_data_file(fname):
+    return fname.endswith("_mtrx")
+
+
+def is_index_file(fname):
+    return fname.endswith(".mtrx")
+
+
+def get_index_path(fname):
+    # Data files are <chain>--<run>_<cycle>.<channel>_mtrx, and the parameters of the whole session are in
+    # <chain>_0001.mtrx (carrying on in _0002.mtrx etc. for long sessions)
+    if "--" not in os.path.basename(fname):
+        raise ValueError(f"{os.path.basename(fname)} isn't named like a Matrix data file")
+    return f"{fname[:fname.rindex('--')]}_0001.mtrx"
+
+
+class MatrixIndex:
+    """The parameter tree of a Matrix session, parsed once for all of its data files.
+
+    Parameters in the index file are a running log, so the ones that apply to a data file are whatever had been set
+    by the time the file is referenced. The log is only read as far as the last file asked for, and only the state at
+    files that are actually next to the index (i.e. were uploaded) is kept.
+    """
+
+    def __init__(self, index_path):
+        from access2thematrix import MtrxData
+
+        chain = index_path[:-len("_0001.mtrx")]
+        raw_param = b""
+        link_nr = 1
+        while os.path.exists(f"{chain}_{link_nr:04d}.mtrx"):
+            with open(f"{chain}_{link_nr:04d}.mtrx", "rb") as f:
+                raw_param += f.read() if link_nr == 1 else f.read()[len(FILE_ID):]
+            link_nr += 1
+        if raw_param[:len(FILE_ID)] != FILE_ID:
+            raise ValueError(f"{os.path.basename(index_path)} is not a Matrix index file")
+
+        self._raw_param = raw_param
+        self._pos = len(FILE_ID)
+        self._reader = MtrxData()
+        self._wanted = {fname for fname in os.listdir(os.path.dirname(index_path) or ".") if is_data_file(fname)}
+        self._params = {}
+        self._lock = threading.Lock()
+
+    def get_params(self, fname):
+        # (parameters, channel ids) as they were when fname was written
+        with self._lock:
+            while fname not in self._params and self._pos < len(self._raw_param):
+                self._pos = self._reader._scan_raw_param(self._pos, self._raw_param)
+                bref = self._reader.param["BREF"]
+                if bref in self._wanted and bref not in self._params:
+                    self._params[bref] = (dict(self._reader.param), dict(self._reader.channel_id))
+
+        if fname not in self._params:
+            raise ValueError(f"{fname} is not referenced by its index file")
+        return self._params[fname]
+
+
+def get_index(index_path):
+    if not os.path.exists(index_path):
+        raise ValueError(f"Upload {os.path.basename(index_path)} alongside the Matrix data files")
+
+    stat = os.stat(index_path)
+    key = (index_path, stat.st_size, stat.st_mtime_ns)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = MatrixIndex(index_path)
+            while len(_indexes) > INDEX_CACHE_SIZE:
+                _indexes.popitem(last=False)
+        _indexes.move_to_end(key)
+        return _indexes[key]
+
+
+def read_mtrx(fname):
+    # An access2thematrix reader for fname, set up from the cached index rather than by its open(), which re-reads
+    # and re-parses the index file for every data file
+    from access2thematrix import MtrxData
+
+    params, channel_id = get_index(get_index_path(fname)).get_params(os.path.basename(fname))
+
+    mtrx = MtrxData()
+    last_part = fname[fname.rindex("--") + 2:]
+    mtrx.result_data_file = fname
+    mtrx.session = last_part[:last_part.index("_")]
+    mtrx.cycle = last_part[last_part.index("_") + 1:last_part.index(".")]
+    mtrx.channel_name = last_part[last_part.index(".") + 1:last_part.rindex("_")]
+    mtrx.param, mtrx.channel_id = dict(params), dict(channel_id)
+
+    with open(fname, "rb") as f:
+        mtrx.raw_data = f.read()
+    if mtrx.raw_data[:len(FILE_ID)] != FILE_ID:
+        raise ValueError(f"{os.path.basename(fname)} is not a Matrix data file")
+    mtrx._scan_raw_data(len(FILE_ID), mtrx.raw_data)
+
+    return mtrx
+
+
+def get_common_mapping(mtrx, fname):
+    return {"experiment_name": os.path.basename(fname),
+            "filetype": fname.split(".")[-1],
+            "time_start": mtrx.param.get("BKLT"),
+            "comment": mtrx.param.get("MARK::MTRX.CREATION_COMMENT")}
+
+
+def convert_mtrx(fname):
+    mtrx = read_mtrx(fname)
+    if "(" in mtrx.channel_name:
+        return convert_mtrx_curve(mtrx, fname)
+    else:
+        return convert_mtrx_image(mtrx, fname)
+
+
+def convert_mtrx_image(mtrx, fname):
+    mtrx.scan, mtrx.axis = mtrx._im_data()
+    x_mirrored, y_mirrored = mtrx.axis[2][:2]
+    mtrx.traces = [trace for trace, available in zip(mtrx.ALL_2D_TRACES,
+                                                     [True, x_mirrored, y_mirrored, x_mirrored and y_mirrored])
+                   if available]
+
+    images = {}
+    for trace in mtrx.traces:
+        im, _ = mtrx.select_image(trace)
+        if im.data.size:
+            images[f"{mtrx.channel_name} ({trace})"] = im
+    if not images:
+        raise ValueError(f"No data in {os.path.basename(fname)}")
+
+    first = images[next(iter(images))]
+    ny, nx = first.data.shape
+    mapping = {"data_type": "image",
+               **get_common_mapping(mtrx, fname),
+
+               # Offsets are of the centre, but the image is placed by its lower left corner
+               "pos_xy": [first.x_offset - first.width / 2, first.y_offset - first.height / 2],
+               "size_xy": [first.width, first.height],
+               "image_points_res": [nx, ny],
+               "img_channels": list(images.keys()),
+               "img": {channel: np.resize(im.data.astype(float), (ny, nx)).ravel() for channel, im in images.items()}
+               }
+    mapping["img_pyramid"] = build_pyramids(mapping["img"], mapping["image_points_res"])
+
+    return convert_to_common(mapping)
+
+
+def convert_mtrx_curve(mtrx, fname):
+    mtrx.scan = mtrx._cu_data()
+    if mtrx.object_type != "curve":
+        raise ValueError(f"{os.path.basename(fname)} is a volume CITS, which isn't supported yet")
+    mtrx.axis = None
+    mtrx.traces = mtrx.ALL_1D_TRACES[:mtrx.scan.shape[0] - 1]
+
+    x_name = "{} ({})".format(*mtrx.x_data_name_and_unit)
+    x_data, spectra_y, location = None, {}, None
+    for trace in mtrx.traces:
+        cu, _ = mtrx.select_curve(trace)
+        if x_data is None:
+            x_data = cu.data[0]
+            if hasattr(cu, "referenced_by"):
+                location = cu.referenced_by["Location (m)"]
+        # Unfinished retraces are shorter, so are padded to line up with the trace
+        y_data = np.full(len(x_data), np.nan)
+        y_data[len(x_data) - len(cu.data[1]):] = cu.data[1][:len(x_data)]
+        spectra_y["{} ({}) [{}]".format(*mtrx.channel_name_and_unit, trace)] = y_data
+
+    if location is None:  # Not taken on a scan, so it was wherever the tip was sitting
+        location = [mtrx.param["EEPA::XYScanner.X_Offset"][0], mtrx.param["EEPA::XYScanner.Y_Offset"][0]]
+
+    mapping = {"data_type": "spectra",
+               **get_common_mapping(mtrx, fname),
+
+               "pos_xy": np.array(location, dtype=float),
+               "spectra_res": len(x_data),
+               "spectra_x_channels": [x_name],
+               "spectra_y_channels": list(spectra_y.keys()),
+               "spectra_x": {x_name: x_data},
+               "spectra_y": spectra_y
+               }
+
+    return convert_to_common(mapping)
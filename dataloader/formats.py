@@ -0,0 +1,115 @@
+import importlib
+import os
+import tempfile
+
+MAGIC_BYTES_READ = 64  # Enough of the start of a file to recognise it
+
+
+class FileFormat:
+    """A loadable file type. The module holding its converter is only imported when a file of this type arrives."""
+
+    def __init__(self, name, extensions, converter, magic=None, lazy=False, needs_neighbours=False,
+                 companion_extensions=None, scanner=None):
+        self.name = name
+        self.extensions = extensions  # Matched against the end of the filename, so also covers e.g. "Z_mtrx"
+        self.magic = magic
+        self.lazy = lazy  # Converter takes lazy=True and memory-maps instead of reading
+        self.needs_neighbours = needs_neighbours  # Only readable next to the other files of its upload
+        self.companion_extensions = companion_extensions or []  # Uploaded alongside, but not datasets themselves
+        self._converter = converter
+        self._convert = None
+        self._scanner = scanner  # Reads just the header, for a preview before the file is converted (see scan)
+        self._scan = None
+
+    def matches_name(self, fname):
+        return any(fname.endswith(ext) for ext in self.extensions)
+
+    def matches_magic(self, head):
+        return self.magic is not None and head.startswith(self.magic)
+
+    def convert(self, fname, lazy=False):
+        if self._convert is None:
+            module_name, func_name = self._converter.rsplit(".", 1)
+            self._convert = getattr(importlib.import_module(module_name), func_name)
+
+        return self._convert(fname, lazy=lazy) if self.lazy else self._convert(fname)
+
+    def scan(self, head, fname):
+        if self._scan is None:
+            module_name, func_name = self._scanner.rsplit(".", 1)
+            self._scan = getattr(importlib.import_module(module_name), func_name)
+
+        return self._scan(head, fname)
+
+
+FORMATS = {}
+
+
+def register_format(file_format):
+    FORMATS[file_format.name] = file_format
+    return file_format
+
+
+def get_format(fname):
+    # By extension, falling back on the first bytes of the file for anything misnamed
+    for file_format in FORMATS.values():
+        if file_format.matches_name(fname):
+            return file_format
+
+    if os.path.exists(fname):
+        with open(fname, "rb") as f:
+            head = f.read(MAGIC_BYTES_READ)
+        for file_format in FORMATS.values():
+            if file_format.matches_magic(head):
+                return file_format
+
+    raise ValueError("File Format Not Supported!")
+
+
+def convert(fname, lazy=False):
+    file_format = get_format(fname)
+    if file_format.matches_name(fname):
+        return file_format.convert(fname, lazy=lazy)
+
+    # Recognised by its magic bytes. The readers check extensions themselves, so hand them a properly named link
+    with tempfile.TemporaryDirectory(prefix="spectra-format-") as tmp_dir:
+        link_path = os.path.join(tmp_dir, os.path.basename(fname) + file_format.extensions[0])
+        os.symlink(os.path.abspath(fname), link_path)
+        return file_format.convert(link_path)
+
+
+def scan(head, fname):
+    # Entry with only the metadata (channels, dimensions, positions), from the first bytes of a file. None if its
+    # format can't be previewed like this. Raises if the header runs on past head
+    file_format = next((file_format for file_format in FORMATS.values() if file_format.matches_name(fname)), None) or \
+        next((file_format for file_format in FORMATS.values() if file_format.matches_magic(head)), None)
+    if file_format is None or file_format._scanner is None:
+        return None
+
+    return file_format.scan(head, fname)
+
+
+def is_supported(fname):
+    return any(file_format.matches_name(fname) for file_format in FORMATS.values())
+
+
+def needs_neighbours(fname):
+    return any(file_format.needs_neighbours and file_format.matches_name(fname) for file_format in FORMATS.values())
+
+
+def is_companion_file(fname):
+    return any(fname.endswith(ext) for file_format in FORMATS.values() for ext in file_format.companion_extensions)
+
+
+def is_lazy(fname):
+    return any(file_format.lazy and file_format.matches_name(fname) for file_format in FORMATS.values())
+
+
+register_format(FileFormat("3ds", [".3ds"], "dataloader.filetypes.nanonis.convert_3ds", magic=b"Grid dim=", lazy=True,
+                           scanner="dataloader.filetypes.nanonis.scan_3ds"))
+register_format(FileFormat("dat", [".dat"], "dataloader.filetypes.nanonis.convert_dat", magic=b"Experiment\t",
+                           scanner="dataloader.filetypes.nanonis.scan_dat"))
+register_format(FileFormat("sxm", [".sxm"], "dataloader.filetypes.nanonis.convert_sxm", magic=b":NANONIS_VERSION:",
+                           scanner="dataloader.filetypes.nanonis.scan_sxm"))
+register_format(FileFormat("mtrx", ["_mtrx"], "dataloader.filetypes.omicron.convert_mtrx", magic=b"ONTMATRX0101",
+                           needs_neighbours=True, companion_extensions=[".mtrx"]))
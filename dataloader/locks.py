@@ -0,0 +1,30 @@
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the app is only ever run as a single process
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(path):
+    # Held exclusively by one thread of one process at a time, so worker processes (e.g. under gunicorn) sharing a
+    # directory can take turns at it. Without fcntl it only keeps out other threads of this process
+    if fcntl is None:
+        with _thread_locks_lock:
+            lock = _thread_locks.setdefault(path, threading.Lock())
+        with lock:
+            yield
+        return
+
+    # flock is per open file, so each thread opening its own copy also locks out the others in this process
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,73 @@
+import numpy as np
+
+from dataloader.derived import derive, parse_smoothing
+
+MAP_KINDS = {"value": "Value at",
+             "diff": "Derivative at",
+             "integrate": "Integral over"}
+MAP_CHUNK_POINTS = 4096  # Spectra reduced at a time, so memory-mapped grids are never read in whole
+
+
+def interp_weights(xdata, x):
+    # w such that spectrum @ w is the spectrum linearly interpolated at x (clipped to the sweep)
+    weights = np.zeros(len(xdata))
+    if len(xdata) == 1:
+        weights[0] = 1
+        return weights
+
+    order = np.argsort(xdata)
+    sorted_x = xdata[order]
+    x = np.clip(x, sorted_x[0], sorted_x[-1])
+    right = int(np.clip(np.searchsorted(sorted_x, x, side="right"), 1, len(sorted_x) - 1))
+    span = sorted_x[right] - sorted_x[right - 1]
+    frac = (x - sorted_x[right - 1]) / span if span > 0 else 0
+    weights[order[right - 1]] += 1 - frac
+    weights[order[right]] += frac
+    return weights
+
+
+def integral_weights(xdata, x0, x1):
+    # w such that spectrum @ w is the trapezoid integral of the spectrum from x0 to x1 (within the sweep), ends
+    # interpolated
+    x0, x1 = np.clip(sorted([x0, x1]), xdata.min(), xdata.max())
+    inside = np.sort(xdata[(xdata > x0) & (xdata < x1)])
+    sub_x = np.concatenate([[x0], inside, [x1]])
+    trapezoid = np.zeros(len(sub_x))
+    trapezoid[:-1] += np.diff(sub_x) / 2
+    trapezoid[1:] += np.diff(sub_x) / 2
+    return trapezoid @ np.array([interp_weights(xdata, x) for x in sub_x])
+
+
+def get_map_weights(xdata, kind, window, smoothing=None):
+    # Every map is linear in the spectrum, so it comes down to one weight per sweep point
+    xdata = np.asarray(xdata, dtype=float)
+    if kind == "value":
+        return interp_weights(xdata, window[0])
+    elif kind == "diff":
+        # Rows of the derivative of the identity are how much each sweep point feeds each point of the derivative
+        return derive(xdata, np.eye(len(xdata)), "diff", smoothing) @ interp_weights(xdata, window[0])
+    elif kind == "integrate":
+        if window[0] == window[1]:
+            raise ValueError("An integral needs a window with two different ends")
+        return integral_weights(xdata, *window)
+    else:
+        raise ValueError(f"Unknown map {kind}")
+
+
+def compute_map(xdata, ydata, kind, window, smoothing=None, out=None):
+    # One value per spectrum of a (n points, n sweep) grid, in a single pass a chunk at a time. Only the columns
+    # with any weight are read, which also keeps NaNs elsewhere in a spectrum (e.g. unfinished sweeps) out of it
+    weights = get_map_weights(xdata, kind, window, smoothing)
+    cols = np.flatnonzero(weights)
+    out = np.empty(ydata.shape[0]) if out is None else out
+    for start in range(0, ydata.shape[0], MAP_CHUNK_POINTS):
+        out[start:start + MAP_CHUNK_POINTS] = np.asarray(ydata[start:start + MAP_CHUNK_POINTS, cols],
+                                                         dtype=float) @ weights[cols]
+    return out
+
+
+def get_map_name(y_channel, kind, window, smoothing=None):
+    where = f"{window[0]:g}" if kind != "integrate" else f"{min(window):g} to {max(window):g}"
+    method, width = parse_smoothing(smoothing)
+    smoothed = f", {method} {width:g}" if kind == "diff" and method is not None else ""
+    return f"{y_channel}: {MAP_KINDS[kind]} {where}{smoothed}"
@@ -0,0 +1,23 @@
+import warnings
+
+import numpy as np
+
+PYRAMID_MIN_SIZE = 256  # Stop halving once an image is this small, it's already cheap to send
+
+
+def build_pyramid(img, min_size=PYRAMID_MIN_SIZE):
+    # Successively 2x2 mean-pooled copies of img, not including img itself. Empty for small images
+    levels = []
+    level = np.asarray(img, dtype=np.float32)
+    while max(level.shape) > min_size and min(level.shape) >= 2:
+        ny, nx = level.shape[0] // 2 * 2, level.shape[1] // 2 * 2
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # Unfinished scans are NaN, which is fine to keep
+            level = np.nanmean(level[:ny, :nx].reshape(ny // 2, 2, nx // 2, 2), axis=(1, 3))
+        levels.append(level)
+
+    return levels
+
+
+def build_pyramids(img_dict, image_res):
+    return {channel: build_pyramid(np.asarray(img).reshape(image_res[::-1])) for channel, img in img_dict.items()}
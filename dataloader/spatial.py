@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def build_spatial_index(pos_xy):
+    # Bucket the spectra positions into a regular grid of cells, roughly one point per cell, with the point indices
+    # sorted by cell. The points in a row of cells are then one contiguous slice of "order"
+    pos = np.asarray(pos_xy, dtype=float).reshape(-1, 2)
+    lo, hi = pos.min(axis=0), pos.max(axis=0)
+    num_cells = max(int(np.sqrt(len(pos))), 1)
+    cell_size = np.where(hi > lo, (hi - lo) / num_cells, 1.0)
+
+    cells = np.clip(((pos - lo) / cell_size).astype(int), 0, num_cells - 1)
+    cell_ids = cells[:, 1] * num_cells + cells[:, 0]
+    order = np.argsort(cell_ids, kind="stable")
+    cell_starts = np.searchsorted(cell_ids[order], np.arange(num_cells ** 2 + 1))
+
+    # Typical distance between neighbouring points, used as the tolerance when clicking on the image
+    extent = hi - lo
+    if np.all(extent > 0):
+        spacing = float(np.sqrt(np.prod(extent) / len(pos)))
+    else:
+        spacing = float(extent.max() / max(len(pos) - 1, 1))
+
+    return {"lo": lo, "cell_size": cell_size, "num_cells": num_cells, "order": order, "cell_starts": cell_starts,
+            "spacing": spacing}
+
+
+def _candidates(index, x0, x1, y0, y1):
+    num_cells = index["num_cells"]
+    lo, cell_size = np.asarray(index["lo"]), np.asarray(index["cell_size"])
+    cx0, cy0 = np.clip(((np.array([x0, y0]) - lo) / cell_size).astype(int), 0, num_cells - 1)
+    cx1, cy1 = np.clip(((np.array([x1, y1]) - lo) / cell_size).astype(int), 0, num_cells - 1)
+
+    order, cell_starts = index["order"], index["cell_starts"]
+    rows = [order[cell_starts[cy * num_cells + cx0]:cell_starts[cy * num_cells + cx1 + 1]] for cy in range(cy0, cy1 + 1)]
+    return np.concatenate(rows) if rows else np.array([], dtype=int)
+
+
+def query_box(index, pos_xy, x_range, y_range):
+    (x0, x1), (y0, y1) = sorted(x_range), sorted(y_range)
+    pos = np.asarray(pos_xy, dtype=float).reshape(-1, 2)
+
+    idxs = _candidates(index, x0, x1, y0, y1)
+    inside = (pos[idxs, 0] >= x0) & (pos[idxs, 0] <= x1) & (pos[idxs, 1] >= y0) & (pos[idxs, 1] <= y1)
+    return np.sort(idxs[inside])
+
+
+def query_lasso(index, pos_xy, xs, ys):
+    from matplotlib.path import Path  # Slow to import, and only needed once someone lassos
+    pos = np.asarray(pos_xy, dtype=float).reshape(-1, 2)
+
+    idxs = _candidates(index, min(xs), max(xs), min(ys), max(ys))
+    inside = Path(np.column_stack([xs, ys])).contains_points(pos[idxs])
+    return np.sort(idxs[inside])
+
+
+def query_nearest(index, pos_xy, x, y, max_dist=None):
+    # (point index, distance) of the closest point, or (None, None) if there isn't one within max_dist.
+    # Searches a growing box around (x, y) until it holds a point no further away than the box's half-width
+    pos = np.asarray(pos_xy, dtype=float).reshape(-1, 2)
+    lo, hi = np.asarray(index["lo"]), np.asarray(index["lo"]) + np.asarray(index["cell_size"]) * index["num_cells"]
+    whole = float(np.hypot(*np.maximum(np.abs(hi - [x, y]), np.abs(lo - [x, y]))))  # Far enough to reach any point
+
+    radius = float(np.max(index["cell_size"]))
+    while True:
+        if max_dist is not None:
+            radius = min(radius, max_dist)
+        idxs = _candidates(index, x - radius, x + radius, y - radius, y + radius)
+        if len(idxs):
+            dists = np.hypot(pos[idxs, 0] - x, pos[idxs, 1] - y)
+            best = np.argmin(dists)
+            if dists[best] <= radius:
+                return int(idxs[best]), float(dists[best])
+
+        if radius >= whole or (max_dist is not None and radius >= max_dist):
+            return None, None
+        radius *= 2
@@ -0,0 +1,200 @@
+import importlib.util
+import json
+import os
+import re
+import shutil
+import tempfile
+import uuid
+import zipfile
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+import data
+import processing
+from dataloader.derived import DERIVED_TABS
+
+
+EXPORT_CHUNK_POINTS = 2048  # Spectra exported at a time, so the export never holds a whole grid in memory
+
+
+def get_export_formats():
+    # Only checks the libraries are installed, they are imported when an export is actually written
+    formats = []
+    if importlib.util.find_spec("pyarrow") is not None:
+        formats.append("parquet")
+    if importlib.util.find_spec("h5py") is not None:
+        formats.append("hdf5")
+    return formats
+
+
+def get_pending_export_path(token):
+    # Next to the conversion cache, as the GET can land on a different worker process than the callback did
+    if not re.fullmatch("[0-9a-f]{32}", token):
+        raise KeyError(f"Export {token} is not an export")  # Tokens come from the browser, so never trusted as a path
+    exports_dir = os.path.join(data.conversion_cache.cache_dir, ".exports")
+    os.makedirs(exports_dir, exist_ok=True)
+    return os.path.join(exports_dir, f"{token}.json")
+
+
+def add_pending_export(**export_args):
+    # The download itself is a plain GET of /export/<token>, so the request is parked until then
+    token = uuid.uuid4().hex
+    with open(get_pending_export_path(token), "w") as f:
+        json.dump(export_args, f, cls=PlotlyJSONEncoder)
+    return token
+
+
+def pop_pending_export(token):
+    export_path = get_pending_export_path(token)
+    try:
+        with open(export_path) as f:
+            export_args = json.load(f)
+        os.remove(export_path)
+    except (OSError, ValueError):
+        raise KeyError(f"Export {token} has already been downloaded")
+    return export_args
+
+
+def get_unique_names(data_entries):
+    names, seen = [], {}
+    for entry in data_entries:
+        name = entry["experiment_metadata"]["experiment_name"]
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else f"{name} ({seen[name]})")
+    return names
+
+
+def iter_spectra_chunks(data_entries, plotted, x_channel, y_channels, background, smoothing=None):
+    # (file index, point indices, x, positions, {column: (n points, n sweep) block}) in chunks of points. Derived
+    # columns are from the dataset's precomputed channels, on the same x as the original
+    for file_idx, point_idxs in processing.group_selection(
+            [{"customdata": file_idx, "pointIndex": point_idx} for file_idx, point_idx in plotted]).items():
+        entry = data_entries[file_idx]
+        if x_channel not in entry["signals"]["spectra_x"]:
+            continue
+        xdata = np.asarray(entry["signals"]["spectra_x"][x_channel])
+        pos = np.asarray(entry["signal_metadata"]["pos_xy"], dtype=float).reshape(-1, 2)
+
+        for start in range(0, len(point_idxs), EXPORT_CHUNK_POINTS):
+            chunk_idxs = np.asarray(point_idxs[start:start + EXPORT_CHUNK_POINTS], dtype=int)
+            blocks = {}
+            for y_channel in y_channels:
+                for tab in ["orig"] + DERIVED_TABS:
+                    _, block = processing.gather_spectra(entry, x_channel, y_channel, chunk_idxs, background, tab,
+                                                         smoothing)
+                    column = y_channel if tab == "orig" else f"{y_channel} ({tab})"
+                    if block is None:
+                        block = np.full((len(chunk_idxs), len(xdata)), np.nan)
+                    blocks[column] = block
+
+            yield file_idx, chunk_idxs, xdata, pos[chunk_idxs], blocks
+
+
+def get_params_table(entry):
+    # Grid parameters (positions, z, sweep limits...) per point, as the image channels of the grid hold them
+    if entry["experiment_metadata"]["filetype"] != "3ds":
+        return None
+
+    param_names = entry["signal_metadata"]["img_channels"][1:]  # Everything after topo
+    params = np.column_stack([np.asarray(entry["signals"]["img"][param]) for param in param_names])
+    return data.dot3ds_params2pd({"fixed_parameters": param_names, "experimental_parameters": [], "params": params})
+
+
+def write_parquet(out_path, data_entries, plotted, x_channel, y_channels, background, smoothing=None):
+    # A .zip of one .parquet per table, each written a row group at a time
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = get_unique_names(data_entries)
+    with tempfile.TemporaryDirectory(prefix="spectra-export-") as tmp_dir:
+        writer = None
+        for file_idx, point_idxs, xdata, pos, blocks in iter_spectra_chunks(data_entries, plotted, x_channel,
+                                                                            y_channels, background, smoothing):
+            num_points, num_sweep = len(point_idxs), len(xdata)
+            columns = {"experiment_name": np.repeat(names[file_idx], num_points * num_sweep),
+                       "point": np.repeat(point_idxs, num_sweep),
+                       "x (m)": np.repeat(pos[:, 0], num_sweep),
+                       "y (m)": np.repeat(pos[:, 1], num_sweep),
+                       x_channel: np.tile(xdata, num_points).astype(float)}
+            columns.update({column: block.ravel() for column, block in blocks.items()})
+
+            table = pa.Table.from_pydict(columns)
+            if writer is None:
+                writer = pq.ParquetWriter(os.path.join(tmp_dir, "spectra.parquet"), table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+        if background is not None:
+            background_columns = {background["x_channel"]: background["x"]}
+            background_columns.update({y_channel: background["y"][y_channel]
+                                       for y_channel in y_channels if y_channel in background["y"]})
+            pq.write_table(pa.Table.from_pydict(background_columns),
+                           os.path.join(tmp_dir, "background.parquet"))
+
+        for file_idx in sorted({file_idx for file_idx, _ in plotted}):
+            params = get_params_table(data_entries[file_idx])
+            if params is not None:
+                pq.write_table(pa.Table.from_pandas(params, preserve_index=False),
+                               os.path.join(tmp_dir, f"params_{names[file_idx]}.parquet"))
+
+        with zipfile.ZipFile(out_path, "w", zipfile.ZIP_STORED) as zf:  # Parquet is already compressed
+            for fname in sorted(os.listdir(tmp_dir)):
+                zf.write(os.path.join(tmp_dir, fname), fname)
+
+
+def write_hdf5(out_path, data_entries, plotted, x_channel, y_channels, background, smoothing=None):
+    # /spectra/<file>/<channel> datasets of (n points, n sweep), grown a chunk at a time
+    import h5py
+
+    names = get_unique_names(data_entries)
+    with h5py.File(out_path, "w") as f:
+        for file_idx, point_idxs, xdata, pos, blocks in iter_spectra_chunks(data_entries, plotted, x_channel,
+                                                                            y_channels, background, smoothing):
+            group = f.require_group(f"spectra/{names[file_idx]}")
+            if x_channel not in group:
+                group.create_dataset(x_channel, data=xdata)
+                group.create_dataset("point", shape=(0,), maxshape=(None,), dtype=int, chunks=True)
+                group.create_dataset("pos_xy", shape=(0, 2), maxshape=(None, 2), dtype=float, chunks=True)
+                for column in blocks:
+                    group.create_dataset(column, shape=(0, len(xdata)), maxshape=(None, len(xdata)), dtype=float,
+                                         chunks=(min(EXPORT_CHUNK_POINTS, 256), len(xdata)), compression="gzip")
+
+            for column, block in [("point", point_idxs), ("pos_xy", pos)] + list(blocks.items()):
+                dataset = group[column]
+                dataset.resize(dataset.shape[0] + len(block), axis=0)
+                dataset[-len(block):] = block
+
+        if background is not None:
+            group = f.create_group("background")
+            group.create_dataset(background["x_channel"], data=background["x"])
+            for y_channel in y_channels:
+                if y_channel in background["y"]:
+                    group.create_dataset(y_channel, data=background["y"][y_channel])
+
+        for file_idx in sorted({file_idx for file_idx, _ in plotted}):
+            params = get_params_table(data_entries[file_idx])
+            if params is not None:
+                group = f.create_group(f"params/{names[file_idx]}")
+                for column in params.columns:
+                    group.create_dataset(column, data=params[column].to_numpy())
+
+
+def write_export(fmt, data_entries, plotted, x_channel, y_channels, background, smoothing=None):
+    # Written to a temporary file, so it can be streamed back from disk rather than built in memory
+    tmp_dir = tempfile.mkdtemp(prefix="spectra-export-")
+    try:
+        if fmt == "parquet":
+            out_path = os.path.join(tmp_dir, "spectra.zip")
+            write_parquet(out_path, data_entries, plotted, x_channel, y_channels, background, smoothing)
+        elif fmt == "hdf5":
+            out_path = os.path.join(tmp_dir, "spectra.h5")
+            write_hdf5(out_path, data_entries, plotted, x_channel, y_channels, background, smoothing)
+        else:
+            raise ValueError(f"Export format {fmt} not available")
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # Don't leave half an export behind
+        raise
+
+    return out_path
@@ -0,0 +1,210 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+import numpy as np
+
+# Opt in with SPECTRA_METRICS=1. When off, timed() hands back the function untouched and nothing is hooked into the
+# app, so it costs nothing
+ENABLED = os.environ.get("SPECTRA_METRICS", "0") not in ("", "0")
+LOG_PATH = os.environ.get("SPECTRA_METRICS_LOG", os.path.join(os.path.dirname(__file__), "metrics.log"))
+TRACE_MEMORY = os.environ.get("SPECTRA_METRICS_MEMORY", "0") not in ("", "0")  # Peak memory too, but ~4x slower
+PROFILE_SLOW_MS = float(os.environ.get("SPECTRA_PROFILE_SLOW_MS", 0))  # cProfile every request, keep those slower
+PROFILE_DIR = os.environ.get("SPECTRA_PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+RECENT_CALLS = 200  # Timings kept per function/callback for the percentiles
+
+_stats = {}
+_stats_lock = threading.Lock()
+_request_state = threading.local()
+_log = logging.getLogger("spectra.metrics")
+
+
+class Stat:
+    """Running timings of one function or callback, plus the payload sizes for callbacks."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.recent_s = deque(maxlen=RECENT_CALLS)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.store_bytes = {}
+        self.peak_mem = 0
+
+    def add(self, seconds, bytes_in=0, bytes_out=0, store_bytes=None, peak_mem=0):
+        self.count += 1
+        self.total_s += seconds
+        self.max_s = max(self.max_s, seconds)
+        self.recent_s.append(seconds)
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        for store_id, (store_in, store_out) in (store_bytes or {}).items():
+            prev_in, prev_out = self.store_bytes.get(store_id, (0, 0))
+            self.store_bytes[store_id] = (prev_in + store_in, prev_out + store_out)
+        self.peak_mem = max(self.peak_mem, peak_mem)
+
+    def to_dict(self):
+        out = {"count": self.count,
+               "total_ms": self.total_s * 1e3,
+               "mean_ms": self.total_s / self.count * 1e3,
+               "p50_ms": float(np.percentile(self.recent_s, 50)) * 1e3,
+               "p95_ms": float(np.percentile(self.recent_s, 95)) * 1e3,
+               "max_ms": self.max_s * 1e3}
+        if self.bytes_in or self.bytes_out:
+            out.update({"bytes_in": self.bytes_in,
+                        "bytes_out": self.bytes_out,
+                        "store_bytes": {store_id: {"in": store_in, "out": store_out}
+                                        for store_id, (store_in, store_out) in self.store_bytes.items()},
+                        "peak_mem_bytes": self.peak_mem})
+        return out
+
+
+def record(name, seconds, **kwargs):
+    with _stats_lock:
+        _stats.setdefault(name, Stat()).add(seconds, **kwargs)
+
+
+def get_metrics():
+    with _stats_lock:
+        return {name: stat.to_dict() for name, stat in sorted(_stats.items())}
+
+
+def reset_metrics():
+    with _stats_lock:
+        _stats.clear()
+
+
+def timed(func):
+    # Wall time of every call, under module.function
+    if not ENABLED:
+        return func
+
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def get_store_ids(layout):
+    # Every dcc.Store in the layout, found by walking its children
+    store_ids, to_visit = set(), [layout]
+    while to_visit:
+        component = to_visit.pop()
+        if isinstance(component, (list, tuple)):
+            to_visit += component
+        elif component is not None and hasattr(component, "_type"):
+            if component._type == "Store" and getattr(component, "id", None):
+                store_ids.add(component.id)
+            to_visit.append(getattr(component, "children", None))
+    return store_ids
+
+
+def get_store_bytes(request_json, response_json, store_ids):
+    # {store id: (bytes sent by the browser, bytes sent back)} for the stores a callback touched
+    store_bytes = {}
+    for arg in request_json.get("inputs", []) + request_json.get("state", []):
+        for item in arg if isinstance(arg, list) else [arg]:
+            if item.get("id") in store_ids:
+                store_bytes[item["id"]] = (len(json.dumps(item.get("value"))), 0)
+    for store_id, props in (response_json.get("response") or {}).items():
+        if store_id in store_ids:
+            store_in, _ = store_bytes.get(store_id, (0, 0))
+            store_bytes[store_id] = (store_in, len(json.dumps(props)))
+    return store_bytes
+
+
+def get_callback_name(request_json, app):
+    # The function behind the callback, falling back on the outputs it's registered under
+    output = request_json.get("output", "")
+    callback = app.callback_map.get(output, {}).get("callback")
+    return f"callback.{getattr(callback, '__name__', output)}"
+
+
+def dump_profile(profiler, name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{threading.get_ident()}.prof")
+    profiler.dump_stats(path)
+    return path
+
+
+def instrument_app(app):
+    # Times every callback by hooking the route Dash sends them all through, and adds a /metrics endpoint. Call once
+    # the layout is set. Peak memory (SPECTRA_METRICS_MEMORY) is of the whole process while the callback ran, above
+    # what it started at, so is only meaningful with one request at a time
+    if not ENABLED:
+        return
+
+    if not _log.handlers:
+        handler = RotatingFileHandler(LOG_PATH, maxBytes=5 * 1024 ** 2, backupCount=3)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _log.addHandler(handler)
+        _log.setLevel(logging.INFO)
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    store_ids = get_store_ids(app.layout)
+
+    import flask
+
+    @app.server.before_request
+    def start_callback_timer():
+        if flask.request.path.endswith("/_dash-update-component"):
+            _request_state.start = time.perf_counter()
+            if TRACE_MEMORY:
+                tracemalloc.reset_peak()
+                _request_state.mem_start, _ = tracemalloc.get_traced_memory()
+            _request_state.profiler = cProfile.Profile() if PROFILE_SLOW_MS else None
+            if _request_state.profiler is not None:
+                _request_state.profiler.enable()
+
+    @app.server.after_request
+    def record_callback(response):
+        if getattr(_request_state, "start", None) is None or \
+                not flask.request.path.endswith("/_dash-update-component"):
+            return response
+
+        seconds = time.perf_counter() - _request_state.start
+        _request_state.start = None
+        if _request_state.profiler is not None:
+            _request_state.profiler.disable()
+        peak_mem = tracemalloc.get_traced_memory()[1] - _request_state.mem_start if TRACE_MEMORY else 0
+
+        request_json = flask.request.get_json(silent=True) or {}
+        response_body = b"" if response.direct_passthrough else response.get_data()
+        try:
+            response_json = json.loads(response_body) if response_body else {}
+        except ValueError:
+            response_json = {}
+        name = get_callback_name(request_json, app)
+        store_bytes = get_store_bytes(request_json, response_json, store_ids)
+        record(name, seconds, bytes_in=flask.request.content_length or 0, bytes_out=len(response_body),
+               store_bytes=store_bytes, peak_mem=peak_mem)
+
+        log_entry = {"time": time.time(), "callback": name, "ms": seconds * 1e3, "status": response.status_code,
+                     "bytes_in": flask.request.content_length or 0, "bytes_out": len(response_body),
+                     "store_bytes": store_bytes, "peak_mem_bytes": peak_mem}
+        if _request_state.profiler is not None and seconds * 1e3 >= PROFILE_SLOW_MS:
+            log_entry["profile"] = dump_profile(_request_state.profiler, name)
+        _log.info(json.dumps(log_entry))
+
+        return response
+
+    @app.server.route("/metrics")
+    def metrics():
+        if flask.request.remote_addr not in ("127.0.0.1", "::1"):
+            flask.abort(404)  # Function names and timings are nobody else's business
+        return flask.jsonify(get_metrics())
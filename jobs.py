@@ -0,0 +1,167 @@
+import json
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from plotly.utils import PlotlyJSONEncoder
+
+import data
+from dataloader import formats
+from dataloader.locks import file_lock
+
+JOB_WORKERS = 2  # Uploads converted at once. Each also shares the ingest process pool for its eager files
+FINISHED_JOB_TTL_S = 3600  # Finished jobs are kept this long, so a slow poll can still pick up their end
+
+_job_executor = None
+
+
+class UploadJob:
+    """Conversion of one upload, run in the background so callbacks aren't held up by it.
+
+    Its progress is kept in a file next to the conversion cache rather than in memory, so a poll can be answered by
+    whichever worker process it lands on, not just the one doing the conversion. Files are handed over as they
+    finish: take_job() gives whatever has finished since it was last called.
+    """
+
+    def __init__(self, list_of_contents, list_of_names, session_id=None):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self._contents = list(list_of_contents)
+        self._names = list(list_of_names)
+        save_job_state(self.job_id, {
+            "names": self._names,
+            "status": ["done" if formats.is_companion_file(fname) else "queued" for fname in self._names],
+            "store_entries": [],  # In the order they finished
+            "errors": [],
+            "done": False,
+            "num_taken": 0,
+            "num_errors_taken": 0})
+
+    def is_cancelled(self):
+        return os.path.exists(get_job_path(self.job_id, "cancel"))
+
+    def run(self):
+        try:
+            for i, store_entry, error in data.iter_files_to_datastore(self._contents, self._names,
+                                                                       is_cancelled=self.is_cancelled,
+                                                                       session_id=self.session_id):
+                update_job_state(self.job_id, lambda state: finish_file(state, i, store_entry, error))
+        except Exception as e:
+            error = str(e)
+            update_job_state(self.job_id, lambda state: state["errors"].append(error))
+        finally:
+            self._contents = None  # Uploads can be GBs, don't hang on to them
+            update_job_state(self.job_id, lambda state: finish_job(state, self.is_cancelled()))
+
+
+def finish_file(state, i, store_entry, error):
+    if error is None:
+        state["store_entries"].append(store_entry)
+        state["status"][i] = "done"
+    else:
+        state["errors"].append(error)
+        state["status"][i] = "failed"
+
+
+def finish_job(state, cancelled):
+    unfinished = "cancelled" if cancelled else "failed"
+    state["status"] = [unfinished if status == "queued" else status for status in state["status"]]
+    state["done"] = True
+
+
+def get_jobs_dir():
+    # Next to the conversion cache, so every worker process sharing the cache sees the same jobs (the cache skips
+    # anything starting with a dot)
+    jobs_dir = os.path.join(data.conversion_cache.cache_dir, ".jobs")
+    os.makedirs(jobs_dir, exist_ok=True)
+    return jobs_dir
+
+
+def get_job_path(job_id, ext="json"):
+    if not re.fullmatch("[0-9a-f]{32}", str(job_id)):
+        raise KeyError(f"Upload {job_id} is not a job")  # Ids come from the browser, so never trusted as a path
+    return os.path.join(get_jobs_dir(), f"{job_id}.{ext}")
+
+
+def save_job_state(job_id, state):
+    # Written whole and renamed into place, so readers never see half of it
+    job_path = get_job_path(job_id)
+    with open(f"{job_path}.tmp", "w") as f:
+        json.dump(state, f, cls=PlotlyJSONEncoder)
+    os.replace(f"{job_path}.tmp", job_path)
+
+
+def load_job_state(job_id):
+    try:
+        with open(get_job_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise KeyError(f"Upload {job_id} is no longer tracked")
+
+
+def update_job_state(job_id, update):
+    # update(state) changes it in place. Locked, as the job and the polls both write to it
+    with file_lock(get_job_path(job_id, "lock")):
+        state = load_job_state(job_id)
+        result = update(state)
+        save_job_state(job_id, state)
+    return result
+
+
+def take_job(job_id):
+    # (store entries, errors, done) new since the last take
+    def take(state):
+        store_entries = state["store_entries"][state["num_taken"]:]
+        errors = state["errors"][state["num_errors_taken"]:]
+        state["num_taken"], state["num_errors_taken"] = len(state["store_entries"]), len(state["errors"])
+        return store_entries, errors, state["done"]
+
+    return update_job_state(job_id, take)
+
+
+def get_job_progress(job_id):
+    state = load_job_state(job_id)
+    return list(zip(state["names"], state["status"]))
+
+
+def cancel_job(job_id):
+    # Picked up by the job between files, whichever process it's running in
+    load_job_state(job_id)
+    with open(get_job_path(job_id, "cancel"), "w"):
+        pass
+
+
+def prune_jobs():
+    # Forgets jobs that finished over FINISHED_JOB_TTL_S ago
+    jobs_dir = get_jobs_dir()
+    for fname in os.listdir(jobs_dir):
+        job_id, ext = os.path.splitext(fname)
+        if ext != ".json":
+            continue
+        try:
+            if time.time() - os.path.getmtime(os.path.join(jobs_dir, fname)) < FINISHED_JOB_TTL_S or \
+                    not load_job_state(job_id)["done"]:
+                continue
+        except (OSError, KeyError):
+            continue
+        for ext in ("json", "lock", "cancel"):
+            try:
+                os.remove(get_job_path(job_id, ext))
+            except OSError:
+                pass
+
+
+def get_job_executor():
+    global _job_executor
+    if _job_executor is None:
+        _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="upload-job")
+    return _job_executor
+
+
+def submit_upload(list_of_contents, list_of_names, session_id=None):
+    prune_jobs()
+    job = UploadJob(list_of_contents, list_of_names, session_id)
+    get_job_executor().submit(job.run)
+    return job.job_id
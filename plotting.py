@@ -1,12 +1,19 @@
-import itertools
-
 import numpy as np
-from nOmicron.utils.plotting import nanomap
-from plotly import graph_objects as go, express as px
+from dash import Patch
+from plotly import colors, graph_objects as go
 
+import processing
 import utils
+from data import render_image
+from instrumentation import timed
 from utils import mpl_to_plotly
 
+WEBGL_TRACE_THRESHOLD = 100  # Spectra on the figure before switching to WebGL traces
+AGGREGATE_TRACE_THRESHOLD = 1000  # ... and before collapsing them into one trace per file/channel
+WEBGL_MARKER_THRESHOLD = 5000  # Spectra position markers on the image before switching to WebGL
+MAX_MARKERS = 20000  # ... and before only drawing every n-th one. Selections are resolved server side regardless
+IMAGE_DISPLAY_PX = 640  # Width of the image panel, no point sending more pixels than this
+
 
 def make_empty_image_plot():
     image_fig = go.Figure()
@@ -18,7 +25,61 @@ def make_empty_image_plot():
     return image_fig
 
 
-def make_image_spec_position_plot(data, img_channel):
+def get_image_level(img, pyramid, extent, view=None, display_px=IMAGE_DISPLAY_PX):
+    # Coarsest pyramid level that still has at least one pixel per screen pixel across the visible part of the
+    # image, cropped to what is visible. Returns the image and the x/y coordinates of its pixel centres
+    (x0, x1), (y0, y1) = extent
+    if view is None:
+        (vx0, vx1), (vy0, vy1) = extent
+    else:
+        (vx0, vx1), (vy0, vy1) = sorted(view[0]), sorted(view[1])
+    frac_x = np.clip((min(vx1, x1) - max(vx0, x0)) / (x1 - x0), 0, 1) if x1 > x0 else 1
+    frac_y = np.clip((min(vy1, y1) - max(vy0, y0)) / (y1 - y0), 0, 1) if y1 > y0 else 1
+
+    level = img
+    for candidate in reversed(pyramid):
+        if candidate.shape[1] * frac_x >= display_px or candidate.shape[0] * frac_y >= display_px:
+            level = candidate
+            break
+
+    xs = np.linspace(x0, x1, level.shape[1])
+    ys = np.linspace(y0, y1, level.shape[0])
+    cols = np.flatnonzero((xs >= vx0) & (xs <= vx1))
+    rows = np.flatnonzero((ys >= vy0) & (ys <= vy1))
+    if len(cols) == 0 or len(rows) == 0:
+        return level, xs, ys
+
+    # Keep a pixel either side so the edges of the view aren't left blank
+    cols = slice(max(cols[0] - 1, 0), cols[-1] + 2)
+    rows = slice(max(rows[0] - 1, 0), rows[-1] + 2)
+    return level[rows, cols], xs[cols], ys[rows]
+
+
+def add_raster_image(image_fig, img, xs, ys, cutoffs, key):
+    # The image as a colourmapped PNG stretched over its extent, rather than a heatmap of raw floats
+    min_cutoff, max_cutoff = cutoffs
+    if not max_cutoff > min_cutoff:
+        max_cutoff = min_cutoff + 1
+
+    dx = (xs[-1] - xs[0]) / max(len(xs) - 1, 1)
+    dy = (ys[-1] - ys[0]) / max(len(ys) - 1, 1)
+    image_fig.add_layout_image(source=render_image(img, min_cutoff, max_cutoff, key + (min_cutoff, max_cutoff)),
+                               xref="x", yref="y",
+                               x=xs[0] - dx / 2, y=ys[-1] + dy / 2,
+                               sizex=xs[-1] - xs[0] + dx, sizey=ys[-1] - ys[0] + dy,
+                               sizing="stretch", layer="below")
+
+
+def set_raster_ranges(image_fig, extents):
+    # Layout images don't count towards autorange, so the axes are set to cover every image whole
+    (x0, x1), (y0, y1) = [(min(extent[axis][0] for extent in extents), max(extent[axis][1] for extent in extents))
+                          for axis in range(2)]
+    image_fig.update_xaxes(range=[x0, x1], showgrid=False)
+    image_fig.update_yaxes(range=[y0, y1], showgrid=False, scaleanchor="x")
+
+
+@timed
+def make_image_spec_position_plot(data, img_channel, view=None, render_mode="heatmap", previews=None):
     # with open('tmp/data.json', 'w') as f:
     #     json.dump(data, f)
 
@@ -29,32 +90,68 @@ def make_image_spec_position_plot(data, img_channel):
     names = utils.extract_all_values(data, "experiment_metadata", "experiment_name")
     res = utils.extract_all_values(data, "signal_metadata", "image_points_res")
 
+    previews = [preview for preview in previews or [] if preview["experiment_metadata"]["data_type"] == "spectra"]
+    num_markers = sum(np.asarray(pos[i]).size // 2 for i in range(len(data))
+                      if data[i]["experiment_metadata"]["data_type"] == "spectra") + \
+        sum(np.asarray(preview["signal_metadata"]["pos_xy"]).size // 2 for preview in previews)
+    scatter = go.Scattergl if num_markers > WEBGL_MARKER_THRESHOLD else go.Scatter
+    marker_step = int(np.ceil(num_markers / MAX_MARKERS)) or 1
+
     # Look through all uploaded files
     image_fig = make_empty_image_plot()
+    raster_extents = []
     for i in range(len(data)):
         # Add images
         if data[i]["signal_metadata"]["img_channels"] is not None:
             if img_channel in data[i]["signal_metadata"]["img_channels"]:
-                imshow = px.imshow(np.array(img_data[i][img_channel]).reshape(res[i][::-1]),
-                                   x=np.linspace(np.array(pos[i])[..., 0].min(),
-                                                 np.array(pos[i])[..., 0].min() + sizes[i][0],
-                                                 res[i][0]),
-                                   y=np.linspace(np.array(pos[i])[..., 1].min(),
-                                                 np.array(pos[i])[..., 1].min() + sizes[i][1],
-                                                 res[i][1]),
-                                   color_continuous_scale=mpl_to_plotly(nanomap),
-                                   origin="lower", aspect="equal")
-                image_fig.add_trace(imshow.data[0])
-                image_fig.update_layout(imshow.layout)
+                pos_i = np.asarray(pos[i])
+                extent = ((pos_i[..., 0].min(), pos_i[..., 0].min() + sizes[i][0]),
+                          (pos_i[..., 1].min(), pos_i[..., 1].min() + sizes[i][1]))
+                pyramid = (data[i]["signals"]["img_pyramid"] or {}).get(img_channel, [])
+                full_img = np.asarray(img_data[i][img_channel]).reshape(res[i][::-1])
+                img, xs, ys = get_image_level(full_img, pyramid, extent, view)
+                if render_mode == "raster":
+                    # Cutoffs from the full image, so the colours don't change as the view is refined
+                    add_raster_image(image_fig, img, xs, ys, (np.nanmin(full_img), np.nanmax(full_img)),
+                                     (data[i].get("dataset_id", i), img_channel, img.shape, xs[0], xs[-1], ys[0], ys[-1]))
+                    # The whole image's, half a pixel out, so resetting the zoom always goes back to all of it
+                    dx, dy = [size / max(num_px - 1, 1) / 2 for size, num_px in zip(sizes[i], full_img.shape[::-1])]
+                    raster_extents.append(((extent[0][0] - dx, extent[0][1] + dx),
+                                           (extent[1][0] - dy, extent[1][1] + dy)))
+                else:
+                    # The colourmap pulls in matplotlib, so isn't imported at startup
+                    from nOmicron.utils.plotting import nanomap
+
+                    image_fig.add_trace(go.Heatmap(z=utils.to_typed_array(img), x=utils.to_typed_array(xs),
+                                                   y=utils.to_typed_array(ys), coloraxis="coloraxis",
+                                                   hovertemplate="x: %{x}<br>y: %{y}<br>color: %{z}<extra></extra>"))
+                    image_fig.update_layout(coloraxis={"colorscale": mpl_to_plotly(nanomap)})
+                    image_fig.update_xaxes(constrain="domain", scaleanchor="y")
+                    image_fig.update_yaxes(constrain="domain")
 
         # Add spectra
         if data[i]["experiment_metadata"]["data_type"] == "spectra":
-            image_fig.add_trace(go.Scatter(x=np.array(pos[i])[..., 0].ravel(), y=np.array(pos[i])[..., 1].ravel(),
-                                           name=names[i],
-                                           mode="markers",
-                                           customdata=np.repeat(i, np.array(pos[i]).size // 2)))
+            pos_i = np.asarray(pos[i]).reshape(-1, 2)[::marker_step]
+            image_fig.add_trace(scatter(x=utils.to_typed_array(pos_i[:, 0]), y=utils.to_typed_array(pos_i[:, 1]),
+                                        name=names[i],
+                                        mode="markers",
+                                        customdata=utils.to_typed_array(np.repeat(i, len(pos_i)),
+                                                                        np.min_scalar_type(i))))
+
+    # Where the spectra of files still being converted are, from their headers. Not clickable until they're loaded
+    for preview in previews:
+        pos_i = np.asarray(preview["signal_metadata"]["pos_xy"]).reshape(-1, 2)[::marker_step]
+        image_fig.add_trace(scatter(x=utils.to_typed_array(pos_i[:, 0]), y=utils.to_typed_array(pos_i[:, 1]),
+                                    name=f"{preview['experiment_metadata']['experiment_name']} (loading)",
+                                    mode="markers",
+                                    marker={"color": "grey", "opacity": 0.5},
+                                    hoverinfo="name"))
+
+    if raster_extents:
+        set_raster_ranges(image_fig, raster_extents)
 
     # image_fig.update_layout(hovermode="x unified")
+    image_fig.update_layout(uirevision=img_channel)  # Keep the zoom when the view is refined
 
     return image_fig
 
@@ -71,66 +168,154 @@ def make_empty_spectra_fig():
     return spectra_fig
 
 
-def make_spectra_fig(data, x_channel, y_channels, selectiondata, background, spectra_fig, tab):
+def make_spectra_state(x_channel, y_channels, tab, smoothing=None):
+    # Lives in dcc.Store('spectra-state'), so later clicks only need to add their own traces to the figure
+    return {"x_channel": x_channel,
+            "y_channels": y_channels,
+            "tab": tab,
+            "smoothing": smoothing,
+            "plotted": [],
+            "num_traces": 0,
+            "mean_x": {},
+            "sums": {},
+            "counts": {y_channel: 0 for y_channel in y_channels},
+            "render_mode": "svg"}
+
+
+def get_render_mode(num_traces):
+    # SVG traces lock the browser up past a few hundred, WebGL ones past a few thousand
+    if num_traces > AGGREGATE_TRACE_THRESHOLD:
+        return "aggregate"
+    elif num_traces > WEBGL_TRACE_THRESHOLD:
+        return "webgl"
+    else:
+        return "svg"
+
+
+def get_new_points(selectiondata, plotted):
+    plotted = {tuple(key) for key in plotted}
+    new_points = []
+    for selected_point in selectiondata:
+        key = (selected_point["customdata"], selected_point["pointIndex"])
+        if key not in plotted:
+            plotted.add(key)
+            new_points.append(key)
+
+    return new_points
+
+
+def is_same_spectra_settings(state, x_channel, y_channels, tab, smoothing=None):
+    return state is not None and (state["x_channel"], state["y_channels"], state["tab"], state.get("smoothing")) == \
+        (x_channel, y_channels, tab, smoothing)
+
+
+@timed
+def make_spectra_traces(data, selectiondata, background, state):
+    # Only points not already on the figure get a trace, and the means are updated from running sums
+    col_pal = colors.qualitative.Alphabet
+    scatter = go.Scatter if state["render_mode"] == "svg" else go.Scattergl
+    sums = {y_channel: utils.decode_array(val) for y_channel, val in state["sums"].items()}
+
+    new_points = get_new_points(selectiondata, state["plotted"])
+    state["plotted"] += new_points
+
+    new_traces = []
+    for data_file_idx, point_idxs in processing.group_selection(
+            [{"customdata": file_idx, "pointIndex": point_idx} for file_idx, point_idx in new_points]).items():
+        name = data[data_file_idx]["experiment_metadata"]["experiment_name"]
+        for y_channel in state["y_channels"]:
+            xdata, block = processing.gather_spectra(data[data_file_idx], state["x_channel"], y_channel, point_idxs,
+                                                     background, state["tab"], state.get("smoothing"))
+            if block is None:
+                continue
+
+            # Add the plots. Past the threshold each block becomes one NaN separated line, with no per-trace hover
+            if state["render_mode"] == "aggregate":
+                new_traces.append(scatter(x=utils.to_typed_array(np.tile(np.append(xdata, np.nan), block.shape[0])),
+                                          y=utils.to_typed_array(
+                                              np.hstack([block, np.full((block.shape[0], 1), np.nan)]).ravel()),
+                                          line=dict(color=col_pal[state["num_traces"] % len(col_pal)], width=1),
+                                          opacity=0.5,
+                                          name=f"{name} ({block.shape[0]} spectra)",
+                                          customdata=[y_channel],
+                                          hoverinfo="skip"))
+            else:
+                typed_xdata = utils.to_typed_array(xdata)
+                for i, ydata in enumerate(block):
+                    new_traces.append(scatter(x=typed_xdata,
+                                              y=utils.to_typed_array(ydata),
+                                              line=dict(color=col_pal[(state["num_traces"] + i) % len(col_pal)]),
+                                              name=name,
+                                              customdata=[y_channel],
+                                              hovertemplate=utils.spectra_hovertemplate))
+            state["num_traces"] += block.shape[0]
+
+            if state["counts"][y_channel] == 0:
+                state["mean_x"][y_channel] = utils.encode_array(xdata)
+                sums[y_channel] = np.zeros(block.shape[1])
+            sums[y_channel] = sums[y_channel] + block.sum(axis=0)
+            state["counts"][y_channel] += block.shape[0]
+
+    state["sums"] = {y_channel: utils.encode_array(val) for y_channel, val in sums.items()}
+
+    # Plot mean of all visible traces in each y channel
+    mean_traces = []
+    for y_channel in state["y_channels"]:
+        count = state["counts"][y_channel]
+        if count:
+            mean = utils.to_typed_array(sums[y_channel] / count)
+            mean_x = utils.to_typed_array(utils.decode_array(state["mean_x"][y_channel]))
+        else:
+            mean, mean_x = None, None
+
+        mean_traces.append(scatter(x=mean_x,
+                                   y=mean,
+                                   name=f"Mean ({y_channel})",
+                                   customdata=[None],  # Otherwise no entry to compare to when building y
+                                   line=dict(width=5, dash="dash"),
+                                   visible=count > 1,
+                                   hovertemplate=utils.spectra_hovertemplate))
+
+    return new_traces, mean_traces, state
+
+
+@timed
+def make_spectra_fig(data, x_channel, y_channels, selectiondata, background, tab, state=None, smoothing=None):
+    # Full redraw. Points plotted under the previous settings are kept and redrawn under the new ones
+    old_points = [] if state is None else [{"customdata": file_idx, "pointIndex": point_idx}
+                                           for file_idx, point_idx in state["plotted"]]
+    state = make_spectra_state(x_channel, y_channels, tab, smoothing)
+    state["render_mode"] = get_render_mode(len(get_new_points(old_points + selectiondata, [])) * len(y_channels))
+
+    spectra_fig = make_empty_spectra_fig()
     if background is not None:
-        spectra_fig = make_empty_spectra_fig()
         spectra_fig.update_layout(title="Spectra (Background Removed)")
 
-    col_pal_iterator = itertools.cycle(px.colors.qualitative.Alphabet)
-    for selected_point in selectiondata:  # Loop through all selected points and all channels
-        for y_channel in y_channels:
-            data_file_idx = selected_point["customdata"]
-            name = data[data_file_idx]["experiment_metadata"]["experiment_name"]
-
-            # Check that we can actually plot our data!
-            if x_channel in data[data_file_idx]["signals"]["spectra_x"].keys() and \
-                    y_channel in data[data_file_idx]["signals"]["spectra_y"].keys():
-                xdata = np.array(data[data_file_idx]["signals"]["spectra_x"][x_channel])
-                ydata = np.array(data[data_file_idx]["signals"]["spectra_y"][y_channel]).reshape(-1, len(xdata))
-
-                # Remove the background
-                if background is not None:
-                    ydata -= background[y_channel]
-
-                if tab == 'orig':
-                    pass
-                elif tab == 'diff':
-                    xdata = xdata
-                    ydata = np.diff(ydata)
-                elif tab == 'double-diff':
-                    xdata = xdata[1:]
-                    ydata = np.diff(np.diff(ydata))
-
-                # Add the plot
-                spectra_fig.add_trace(
-                    go.Scatter(x=xdata,
-                               y=ydata[selected_point["pointIndex"]],
-                               line=dict(color=next(col_pal_iterator)),
-                               name=name,
-                               customdata=[y_channel],
-                               hovertemplate=utils.spectra_hovertemplate))
-
-    # Plot mean of all visible traces in this y channel
-    for y_channel in y_channels:
-        # Remove old mean trace
-        tmp_data = list(spectra_fig.data)
-        for i, entry in enumerate(tmp_data):
-            if entry.name == f"Mean ({y_channel})":
-                tmp_data.pop(i)
-        spectra_fig.data = tuple(tmp_data)
-
-        # Add new mean trace
-        all_y = np.array([trace.y for trace in spectra_fig.data if trace.customdata[0] == y_channel])
-
-        spectra_fig.add_trace(go.Scatter(x=spectra_fig.data[0].x, y=all_y.mean(axis=0),
-                                         name=f"Mean ({y_channel})",
-                                         customdata=[None],  # Otherwise no entry to compare to when building y
-                                         line=dict(width=5, dash="dash"),
-                                         visible=all_y.shape[0] > 1,
-                                         hovertemplate=utils.spectra_hovertemplate))
-
-    spectra_fig.update_layout(xaxis_title=x_channel, yaxis_title=y_channel)
-    return spectra_fig
+    # Means go first, so they sit at known indices for update_spectra_fig to patch
+    new_traces, mean_traces, state = make_spectra_traces(data, old_points + selectiondata, background, state)
+    spectra_fig.add_traces(mean_traces + new_traces)
+
+    spectra_fig.update_layout(xaxis_title=x_channel, yaxis_title=y_channels[-1])
+    return spectra_fig, state
+
+
+@timed
+def update_spectra_fig(data, selectiondata, background, state):
+    # Partial update, only the new traces and the new means are sent to the browser. If the new spectra push the
+    # figure over a rendering threshold, everything is redrawn so all traces are drawn the same way
+    num_traces = state["num_traces"] + len(get_new_points(selectiondata, state["plotted"])) * len(state["y_channels"])
+    if get_render_mode(num_traces) != state["render_mode"]:
+        return make_spectra_fig(data, state["x_channel"], state["y_channels"], selectiondata, background, state["tab"],
+                                state, state.get("smoothing"))
+
+    new_traces, mean_traces, state = make_spectra_traces(data, selectiondata, background, state)
+
+    spectra_patch = Patch()
+    for i, mean_trace in enumerate(mean_traces):
+        spectra_patch["data"][i] = mean_trace.to_plotly_json()
+    spectra_patch["data"].extend([trace.to_plotly_json() for trace in new_traces])
+
+    return spectra_patch, state
 
 
 def make_derivative_fig(spectra_fig):
@@ -0,0 +1,115 @@
+import numpy as np
+
+import data
+from dataloader import derived, spatial
+from instrumentation import timed
+
+
+def group_selection(selectiondata):
+    # {file index: [point indices]} keeping the order points were selected in
+    grouped = {}
+    for selected_point in selectiondata:
+        grouped.setdefault(selected_point["customdata"], []).append(selected_point["pointIndex"])
+
+    return grouped
+
+
+def get_spatial_index(data_entry):
+    # Built at conversion, but entries cached before there was an index need one made here
+    if data_entry["signal_metadata"].get("spatial_index") is None:
+        data_entry["signal_metadata"]["spatial_index"] = spatial.build_spatial_index(
+            data_entry["signal_metadata"]["pos_xy"])
+    return data_entry["signal_metadata"]["spatial_index"]
+
+
+@timed
+def resolve_selection(data, click_data, selected_data):
+    # Turn the figure's click/box/lasso events into the points they cover using each file's spatial index, so this
+    # doesn't depend on every marker being drawn. Same format as Plotly's points, for group_selection
+    spectra_files = [(i, get_spatial_index(data_entry), data_entry["signal_metadata"]["pos_xy"])
+                     for i, data_entry in enumerate(data)
+                     if data_entry["experiment_metadata"]["data_type"] == "spectra"]
+
+    selected = []
+    if selected_data and ("lassoPoints" in selected_data or "range" in selected_data):
+        for file_idx, index, pos_xy in spectra_files:
+            if "lassoPoints" in selected_data:
+                point_idxs = spatial.query_lasso(index, pos_xy, selected_data["lassoPoints"]["x"],
+                                                 selected_data["lassoPoints"]["y"])
+            else:
+                point_idxs = spatial.query_box(index, pos_xy, selected_data["range"]["x"], selected_data["range"]["y"])
+            selected += [{"customdata": file_idx, "pointIndex": int(point_idx)} for point_idx in point_idxs]
+    elif selected_data and selected_data.get("points"):
+        selected = selected_data["points"]
+    elif click_data and click_data.get("points"):
+        clicked = click_data["points"][0]
+        if "customdata" in clicked:  # On a marker, so it's whichever point of that file is there
+            candidates = [(file_idx, index, pos_xy, None) for file_idx, index, pos_xy in spectra_files
+                          if file_idx == clicked["customdata"]]
+        else:  # On the image, so the closest point of any file that is near enough
+            candidates = [(file_idx, index, pos_xy, index["spacing"]) for file_idx, index, pos_xy in spectra_files]
+
+        nearest = None
+        for file_idx, index, pos_xy, max_dist in candidates:
+            point_idx, dist = spatial.query_nearest(index, pos_xy, clicked["x"], clicked["y"], max_dist)
+            if point_idx is not None and (nearest is None or dist < nearest[0]):
+                nearest = (dist, {"customdata": file_idx, "pointIndex": point_idx})
+        if nearest is not None:
+            selected = [nearest[1]]
+
+    return selected or None
+
+
+@timed
+def gather_spectra(data_entry, x_channel, y_channel, point_idxs, background, tab, smoothing=None):
+    # All selected points of one file/channel in a single fancy index, with the background removed from the whole
+    # (n points, n sweep) block at once. Derived tabs are looked up from the dataset's precomputed channels, all on
+    # the same x as the original
+    if x_channel not in data_entry["signals"]["spectra_x"].keys() or \
+            y_channel not in data_entry["signals"]["spectra_y"].keys():
+        return None, None
+
+    xdata = np.asarray(data_entry["signals"]["spectra_x"][x_channel])
+    if tab == 'orig':
+        ydata = np.asarray(data_entry["signals"]["spectra_y"][y_channel]).reshape(-1, len(xdata))
+    else:
+        ydata = data.get_derived_channel(data_entry, x_channel, y_channel, tab, smoothing)
+
+    # Memory-mapped grids only read the selected rows
+    block = ydata[np.asarray(point_idxs, dtype=int)].astype(float)
+
+    if background is not None and background["x_channel"] == x_channel and y_channel in background["y"]:
+        # Kept on whatever sweep it was taken from (see backgrounds), so put onto this file's first. Derivatives and
+        # integrals are linear, so taking the background's off the derived spectra is the same as deriving the
+        # background-removed ones
+        background_y = interp_rows(xdata, background["x"], background["y"][y_channel])
+        if tab != 'orig':
+            background_y = derived.derive(xdata, background_y[None, :], tab, smoothing)[0]
+        block -= background_y
+
+    return xdata, block
+
+
+def interp_rows(x_new, x, rows):
+    # np.interp of every row of rows (..., len(x)) onto x_new at once, held at the end values outside x. Sweeps can
+    # run either way, and the same sweep is handed straight back
+    x_new, x, rows = np.asarray(x_new, dtype=float), np.asarray(x, dtype=float), np.asarray(rows, dtype=float)
+    if x_new.shape == x.shape and np.array_equal(x_new, x):
+        return rows
+    if len(x) == 1:
+        return np.repeat(rows, len(x_new), axis=-1)
+
+    order = np.argsort(x, kind="stable")
+    x, rows = x[order], rows[..., order]
+    right = np.clip(np.searchsorted(x, x_new), 1, len(x) - 1)
+    left = right - 1
+    dx = x[right] - x[left]
+    weight = np.clip(np.divide(x_new - x[left], dx, out=np.zeros_like(x_new), where=dx > 0), 0, 1)
+    return rows[..., left] * (1 - weight) + rows[..., right] * weight
+
+
+def summarise_running(sums, sumsqs, count):
+    # Mean and std from running sums of the spectra and their squares (see cli), without going back to the data
+    mean = sums / count
+    std = np.sqrt(np.maximum(sumsqs / count - mean ** 2, 0))
+    return mean, std
@@ -0,0 +1,89 @@
+import mmap
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+def is_file_backed(arr):
+    base = arr
+    while isinstance(base, np.ndarray):
+        base = base.base
+    return isinstance(base, mmap.mmap)
+
+
+def estimate_nbytes(obj):
+    if isinstance(obj, np.ndarray):
+        return 0 if is_file_backed(obj) else obj.nbytes  # Memory-mapped pages can be dropped by the OS
+    elif isinstance(obj, dict):
+        return sum(estimate_nbytes(val) for val in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(estimate_nbytes(val) for val in obj)
+    elif isinstance(obj, str):
+        return len(obj)
+    else:
+        return 8
+
+
+class DatasetRegistry:
+    """Keeps converted datasets in process, evicting the least recently used once over the byte budget or the cap on
+    how many are held. Memory-mapped arrays don't count towards the bytes, as the OS can drop their pages, but each
+    one keeps a file descriptor open for as long as it's held, hence the cap."""
+
+    def __init__(self, max_bytes=2 * 1024 ** 3, max_entries=32):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._on_evict = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, dataset_id):
+        return dataset_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return sum(self._sizes.values())
+
+    def add(self, entry, on_evict=None, dataset_id=None):
+        # An entry already under dataset_id is kept rather than replaced, so every session after the same dataset
+        # shares the one copy
+        dataset_id = uuid.uuid4().hex if dataset_id is None else dataset_id
+        with self._lock:
+            if dataset_id in self._entries:
+                self._entries.move_to_end(dataset_id)
+                return dataset_id
+            self._entries[dataset_id] = entry
+            self._sizes[dataset_id] = estimate_nbytes(entry)
+            if on_evict is not None:
+                self._on_evict[dataset_id] = on_evict
+            self._evict(keep=dataset_id)
+
+        return dataset_id
+
+    def get(self, dataset_id):
+        with self._lock:
+            if dataset_id not in self._entries:
+                raise KeyError(f"Dataset {dataset_id} is no longer loaded, please re-upload it")
+            self._entries.move_to_end(dataset_id)
+            return self._entries[dataset_id]
+
+    def remove(self, dataset_id):
+        with self._lock:
+            self._entries.pop(dataset_id, None)
+            self._sizes.pop(dataset_id, None)
+            on_evict = self._on_evict.pop(dataset_id, None)
+
+        if on_evict is not None:
+            on_evict()
+
+    def _evict(self, keep=None):
+        while (self.nbytes > self.max_bytes or len(self._entries) > self.max_entries) and len(self._entries) > 1:
+            oldest_id = next(iter(self._entries))
+            if oldest_id == keep:
+                break
+            self.remove(oldest_id)
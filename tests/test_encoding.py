@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from flatten_dict import flatten
+from nanonispy.read import Grid, Scan, Spec
+
+import utils
+from benchmarks import synthetic
+from dataloader.filetypes import nanonis
+
+
+# What the converters stored before they kept typed arrays, as nested lists straight from nanonispy
+
+
+def old_3ds_signals(fname):
+    data = Grid(fname)
+    x_idx = len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index("X (m)")
+    y_idx = len(data.header["fixed_parameters"]) + data.header["experimental_parameters"].index("Y (m)")
+    return {"pos_xy": data.signals["params"][..., x_idx:y_idx + 1].tolist(),
+            "spectra_x": {data.header["sweep_signal"]: data.signals["sweep_signal"].tolist()},
+            "spectra_y": {channel: data.signals[channel].tolist() for channel in data.header["channels"]},
+            "img": {"topo": data.signals["topo"].ravel().tolist(),
+                    **{channel: data.signals["params"][..., i].ravel().tolist() for i, channel in enumerate(
+                        data.header["fixed_parameters"] + data.header["experimental_parameters"])}}}
+
+
+def old_dat_signals(fname):
+    data = Spec(fname)
+    return {"pos_xy": [data.header["X (m)"], data.header["Y (m)"]],
+            "spectra_x": {key: val.tolist() for key, val in data.signals.items()},
+            "spectra_y": {key: val.tolist() for key, val in data.signals.items()}}
+
+
+def old_sxm_signals(fname):
+    data = Scan(fname)
+    flattened_signal_dict = flatten(data.signals, reducer=lambda k1, k2: k2 if k1 is None else f"{k1} ({k2})")
+    return {"img": {key: val.tolist() for key, val in flattened_signal_dict.items()}}
+
+
+def assert_same_as_lists(new_entry, old_signals):
+    # Every array must come back from the browser encoding exactly as the old lists had it, shape and all
+    for signal_type, old_value in old_signals.items():
+        if signal_type == "pos_xy":
+            new_value = new_entry["signal_metadata"]["pos_xy"]
+            # .dat positions used to be left as the header's strings
+            np.testing.assert_array_equal(utils.decode_array(utils.encode_array(new_value)),
+                                          np.asarray(old_value, dtype=float))
+            continue
+
+        assert list(new_entry["signals"][signal_type]) == list(old_value)
+        for channel, old_channel in old_value.items():
+            new_channel = new_entry["signals"][signal_type][channel]
+            decoded = utils.decode_array(utils.encode_array(new_channel))
+            array_info = new_entry["signal_metadata"]["array_info"][signal_type][channel]
+            assert list(decoded.shape) == array_info["shape"]
+            assert np.dtype(array_info["dtype"]).newbyteorder("<") == decoded.dtype  # Sent little-endian
+            np.testing.assert_array_equal(decoded, np.asarray(old_channel))
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_3ds_matches_lists(tmp_path, lazy):
+    fname = synthetic.write_3ds(str(tmp_path / "grid.3ds"), nx=8, ny=6, num_sweep=32)
+    assert_same_as_lists(nanonis.convert_3ds(fname, lazy=lazy), old_3ds_signals(fname))
+
+
+def test_dat_matches_lists(tmp_path):
+    fname = synthetic.write_dat(str(tmp_path / "spec.dat"), num_sweep=64)
+    assert_same_as_lists(nanonis.convert_dat(fname), old_dat_signals(fname))
+
+
+def test_sxm_matches_lists(tmp_path):
+    fname = synthetic.write_sxm(str(tmp_path / "scan.sxm"), nx=32, ny=24)
+    assert_same_as_lists(nanonis.convert_sxm(fname), old_sxm_signals(fname))
+
+
+def test_decode_takes_old_lists():
+    assert np.array_equal(utils.decode_array([[1.0, 2.0], [3.0, 4.0]]), np.array([[1.0, 2.0], [3.0, 4.0]]))
+
+
+def test_encode_big_endian():
+    arr = np.arange(12, dtype=">f4").reshape(3, 4)
+    encoded = utils.encode_array(arr)
+    assert encoded["dtype"] == "<f4"
+    np.testing.assert_array_equal(utils.decode_array(encoded), arr)
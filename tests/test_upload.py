@@ -0,0 +1,54 @@
+import glob
+import os
+import time
+
+import pytest
+
+import data
+from benchmarks import synthetic
+from dataloader.cache import ConversionCache
+from registry import DatasetRegistry
+
+
+@pytest.fixture
+def conversion_cache(tmp_path, monkeypatch):
+    cache = ConversionCache(str(tmp_path / "cache"))
+    monkeypatch.setattr(data, "conversion_cache", cache)
+    return cache
+
+
+def write_mtrx_upload(tmp_path, num_curves=5):
+    # The index file first, as it has to be there before any of the data files can be converted
+    session_dir = tmp_path / "session"
+    session_dir.mkdir()
+    paths = synthetic.write_mtrx_session(str(session_dir), num_images=1, num_curves=num_curves, nx=16, num_sweep=32)
+    return glob.glob(str(session_dir / "*_0001.mtrx")) + paths
+
+
+def test_matrix_upload_keeps_shared_dir(tmp_path, conversion_cache, monkeypatch):
+    pytest.importorskip("access2thematrix")
+    paths = write_mtrx_upload(tmp_path)
+
+    # Slowed down so each file is registered (and its upload deleted) before the next is converted
+    convert_in_place = data.try_convert_file_in_place
+    monkeypatch.setattr(data, "try_convert_file_in_place",
+                        lambda tmp_path: time.sleep(0.2) or convert_in_place(tmp_path))
+
+    datastore, errors = data.add_files_to_datastore([synthetic.as_upload_contents(path) for path in paths],
+                                                    [os.path.basename(path) for path in paths], [])
+    assert errors == []
+    assert [entry["experiment_metadata"]["experiment_name"] for entry in datastore] == \
+        [os.path.basename(path) for path in paths[1:]]
+
+
+def test_matrix_reloaded_from_cache(tmp_path, conversion_cache, monkeypatch):
+    # As happens after an eviction, or on another worker process. Matrix extensions like "I(V)_mtrx" included
+    pytest.importorskip("access2thematrix")
+    paths = write_mtrx_upload(tmp_path, num_curves=2)
+    datastore, errors = data.add_files_to_datastore([synthetic.as_upload_contents(path) for path in paths],
+                                                    [os.path.basename(path) for path in paths], [])
+    assert errors == [] and len(datastore) == 3
+
+    monkeypatch.setattr(data, "dataset_registry", DatasetRegistry())
+    datasets = data.resolve_datastore(datastore)
+    assert [dataset["dataset_id"] for dataset in datasets] == [store_entry["dataset_id"] for store_entry in datastore]
@@ -1,3 +1,5 @@
+import base64
+
 import numpy as np
 
 
@@ -34,16 +36,6 @@ def mpl_to_plotly(cmap, pl_entries=30, rdigits=6):
     return pl_colorscale
 
 
-def combine_selection_events(events):
-    out_dict = {}
-    [out_dict.update(event) for event in events if event is not None]
-
-    if len(out_dict):
-        return out_dict["points"]
-    else:
-        return None
-
-
 def is_button_pressed(new_n_clicks, old_n_clicks):
     if old_n_clicks is None:
         old_n_clicks = 0
@@ -52,6 +44,52 @@ def is_button_pressed(new_n_clicks, old_n_clicks):
     return new_n_clicks != old_n_clicks
 
 
+def get_view_ranges(relayout_data):
+    # ((x0, x1), (y0, y1)) of a zoom/pan relayout event, None if it was reset, or False if it wasn't a view change
+    if relayout_data is None or "xaxis.autorange" in relayout_data:
+        return None
+
+    ranges = []
+    for axis in ("xaxis", "yaxis"):
+        if f"{axis}.range" in relayout_data:
+            ranges.append(tuple(relayout_data[f"{axis}.range"]))
+        elif f"{axis}.range[0]" in relayout_data:
+            ranges.append((relayout_data[f"{axis}.range[0]"], relayout_data[f"{axis}.range[1]"]))
+        else:
+            return False
+
+    return tuple(ranges)
+
+
+def encode_array(arr):
+    arr = np.asarray(arr)
+    arr = arr.astype(arr.dtype.newbyteorder("<"), copy=False)
+    return {"dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+            "bdata": base64.b64encode(np.ascontiguousarray(arr).tobytes()).decode("ascii")}
+
+
+def decode_array(encoded):
+    # Also takes plotly.js typed arrays, e.g. from a figure sent back by the browser
+    if not isinstance(encoded, dict):  # Plain lists from older stores
+        return np.asarray(encoded)
+    arr = np.frombuffer(base64.b64decode(encoded["bdata"]), dtype=np.dtype(encoded["dtype"]).newbyteorder("<"))
+    shape = encoded.get("shape", [-1])
+    return arr.reshape([int(dim) for dim in shape.split(",")] if isinstance(shape, str) else shape)
+
+
+def to_typed_array(arr, dtype=np.float32):
+    # A plotly.js typed array (base64 of the raw values) rather than a JSON list of numbers. Plotly only makes these
+    # itself for native byte order arrays in whole figures, not the big-endian ones read from Nanonis files or
+    # anything in a Patch. Display-only data is sent as float32, half the bytes of float64 and plenty on screen
+    # (the browser has no float16 typed array)
+    arr = np.ascontiguousarray(arr, dtype=np.dtype(dtype).newbyteorder("<"))
+    typed_array = {"dtype": arr.dtype.str[1:], "bdata": base64.b64encode(arr).decode("ascii")}
+    if arr.ndim > 1:
+        typed_array["shape"] = ", ".join(str(dim) for dim in arr.shape)
+    return typed_array
+
+
 spectra_hovertemplate = '<br>(%{x:,.3g}, %{y:,.3g})'
 
 